@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Rendering engine benchmark for the Passport Photo Generator.
+
+Renders the same inputs with the PIL and OpenCV engines, checks that the
+outputs stay visually equivalent (PSNR) and prints a throughput comparison.
+Also measures how many signed downloads per second one worker can answer when
+it streams files itself versus handing them to nginx with X-Accel-Redirect.
+
+Usage:
+    cd backend
+    python benchmark.py                       # uses uploads/*.jpg
+    python benchmark.py photo1.jpg photo2.png --iterations 20 --upscale 4
+    python benchmark.py --downloads 5000      # more download requests per delivery mode
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from downloads import deliver_file, signed_download_url, verify_download_signature
+from imaging import (
+    ROOT_DIR,
+    decode_image,
+    detect_face_in_image,
+    process_passport_photo,
+)
+
+UPLOADS_DIR = ROOT_DIR / 'uploads'
+
+MIN_PSNR_DB = 30.0
+
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    """Peak signal-to-noise ratio between two uint8 images"""
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+
+def load_inputs(paths: list[str], upscale: int) -> list[tuple[str, bytes]]:
+    """Read input files, optionally upscaling them to simulate camera-sized frames"""
+    files = [Path(p) for p in paths] if paths else sorted(UPLOADS_DIR.glob('*.jpg'))
+    inputs = []
+    for path in files:
+        data = path.read_bytes()
+        if upscale > 1:
+            img = decode_image(data)
+            img = cv2.resize(img, None, fx=upscale, fy=upscale, interpolation=cv2.INTER_CUBIC)
+            data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()
+        inputs.append((path.name, data))
+    return inputs
+
+
+def time_engine(engine: str, inputs: list[tuple[str, bytes, tuple]], iterations: int) -> list[float]:
+    """Return per-image render latencies in seconds (detection excluded)"""
+    latencies = []
+    for _ in range(iterations):
+        for _, data, face in inputs:
+            start = time.perf_counter()
+            process_passport_photo(data, "Benchmark Name", face, engine=engine)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def serve_download(root: Path, filename: str, url: str, mode: str) -> int:
+    """Run one download through signature check and response, as the ASGI server would; returns body bytes"""
+    query = dict(part.split('=', 1) for part in url.partition('?')[2].split('&') if part)
+    verify_download_signature(filename, int(query['expires']) if 'expires' in query else None, query.get('signature'))
+    response = deliver_file(root, filename, "image/jpeg", mode=mode)
+    
+    sent = 0
+    scope = {"type": "http", "method": "GET", "headers": [], "extensions": {}}
+    async def receive():
+        # The client never disconnects; FileResponse listens for that while it streams
+        await asyncio.Event().wait()
+    async def send(message):
+        nonlocal sent
+        if message["type"] == "http.response.body":
+            sent += len(message.get("body", b""))
+    await response(scope, receive, send)
+    return sent
+
+async def time_downloads(root: Path, filenames: list[str], requests: int, mode: str) -> tuple[float, int]:
+    """Seconds and bytes for the worker to answer `requests` downloads, 32 in flight at a time"""
+    urls = [signed_download_url(filename) for filename in filenames]
+    start = time.perf_counter()
+    sent = 0
+    for offset in range(0, requests, 32):
+        batch = [
+            serve_download(root, filenames[i % len(filenames)], urls[i % len(urls)], mode)
+            for i in range(offset, min(requests, offset + 32))
+        ]
+        sent += sum(await asyncio.gather(*batch))
+    return time.perf_counter() - start, sent
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare PIL and OpenCV rendering engines")
+    parser.add_argument('images', nargs='*', help="Input images (default: uploads/*.jpg)")
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--upscale', type=int, default=4, help="Upscale inputs to simulate phone photos")
+    parser.add_argument('--downloads', type=int, default=2000, help="Download requests per delivery mode (0 skips)")
+    args = parser.parse_args()
+
+    raw_inputs = load_inputs(args.images, args.upscale)
+    if not raw_inputs:
+        print("No input images found")
+        return 1
+
+    # Detect once so both engines render from identical coordinates
+    inputs = []
+    for label, data in raw_inputs:
+        inputs.append((label, data, detect_face_in_image(decode_image(data))))
+
+    print("=== Visual equivalence (PSNR, higher is closer) ===")
+    worst = float('inf')
+    for label, data, face in inputs:
+        pil_bytes, _ = process_passport_photo(data, "Benchmark Name", face, engine="pil")
+        cv_bytes, _ = process_passport_photo(data, "Benchmark Name", face, engine="opencv")
+        score = psnr(decode_image(pil_bytes), decode_image(cv_bytes))
+        worst = min(worst, score)
+        print(f"  {label:<50} {score:6.2f} dB")
+
+    print(f"\n=== Throughput ({args.iterations} iterations x {len(inputs)} images) ===")
+    results = {}
+    for engine in ("pil", "opencv"):
+        latencies = time_engine(engine, inputs, args.iterations)
+        results[engine] = latencies
+        print(
+            f"  {engine:<8} median {statistics.median(latencies) * 1000:7.2f} ms"
+            f"   p95 {sorted(latencies)[int(len(latencies) * 0.95) - 1] * 1000:7.2f} ms"
+            f"   {len(latencies) / sum(latencies):7.1f} img/s"
+        )
+    speedup = statistics.median(results["pil"]) / statistics.median(results["opencv"])
+    print(f"\n  opencv speedup over pil: {speedup:.2f}x")
+    
+    stored = sorted(UPLOADS_DIR.glob('*.jpg'))
+    if args.downloads and stored:
+        # The nginx row is what the worker still does; the proxy streams the bytes outside Python
+        print(f"\n=== Download delivery ({args.downloads} signed requests, {len(stored)} stored photos) ===")
+        filenames = [path.name for path in stored]
+        rates = {}
+        for mode in ("app", "nginx"):
+            elapsed, sent = asyncio.run(time_downloads(UPLOADS_DIR, filenames, args.downloads, mode))
+            rates[mode] = args.downloads / elapsed
+            print(
+                f"  {mode:<8} {rates[mode]:9.0f} req/s   {sent / elapsed / 1e6:8.1f} MB/s through Python"
+                f"   {elapsed / args.downloads * 1e6:7.1f} us/request"
+            )
+        print(f"\n  worker capacity gain with X-Accel-Redirect: {rates['nginx'] / rates['app']:.1f}x")
+
+    if worst < MIN_PSNR_DB:
+        print(f"\n❌ Engines diverge: worst PSNR {worst:.2f} dB < {MIN_PSNR_DB} dB")
+        return 1
+    print(f"\n✅ Engines equivalent: worst PSNR {worst:.2f} dB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Offline bulk processing for the Passport Photo Generator.
+
+Runs the same decode, detection and rendering code as the API over a whole
+directory (or a CSV manifest of path,name rows) using every core, without
+MongoDB or Google Drive. Every finished input is appended to a results
+manifest, so an interrupted run picks up where it stopped.
+
+Usage:
+    cd backend
+    python bulk_process.py photos/ --output out/             # name taken from each file name
+    python bulk_process.py --manifest people.csv --output out/ --workers 8
+    python bulk_process.py photos/ --output out/ --specs us_2x2,schengen_35x45
+"""
+
+import argparse
+import csv
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import cv2
+from fastapi import HTTPException
+
+from imaging import (
+    DEFAULT_PHOTO_SPEC,
+    inspect_image_header,
+    name_error,
+    parse_photo_specs,
+    run_passport_pipeline,
+    sanitize_filename,
+)
+
+INPUT_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+MAX_INPUT_BYTES = 10 * 1024 * 1024
+RESULT_FIELDS = ['source', 'name', 'status', 'output_file', 'file_size', 'error', 'seconds']
+PROGRESS_INTERVAL_SECONDS = 2.0
+
+
+def name_from_path(path: Path) -> str:
+    """Derive a banner name from a file name: john_doe-smith.jpg -> John Doe Smith"""
+    return ' '.join(path.stem.replace('_', ' ').replace('-', ' ').split()).title()
+
+
+def collect_inputs(input_dir: str, manifest: str) -> list[tuple[str, str]]:
+    """Return (source path, name) pairs from a directory walk or a path,name CSV"""
+    if manifest:
+        base = Path(manifest).parent
+        with open(manifest, newline='') as f:
+            rows = [row for row in csv.reader(f) if row and row[0].strip()]
+        if rows and rows[0][0].strip().lower() == 'path':
+            rows = rows[1:]
+        return [
+            (str(base / row[0].strip()), row[1].strip() if len(row) > 1 else name_from_path(Path(row[0].strip())))
+            for row in rows
+        ]
+
+    inputs = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            path = Path(root) / filename
+            if path.suffix.lower() in INPUT_EXTENSIONS:
+                inputs.append((str(path), name_from_path(path)))
+    return inputs
+
+
+def output_filename(source: str, name: str, spec: str = DEFAULT_PHOTO_SPEC) -> str:
+    """Stable per-input output name, so reruns overwrite instead of duplicating"""
+    digest = hashlib.sha1(source.encode()).hexdigest()[:10]
+    if spec == DEFAULT_PHOTO_SPEC:
+        return f"passport_photo_{sanitize_filename(name)}_{digest}.jpg"
+    return f"passport_photo_{sanitize_filename(name)}_{spec}_{digest}.jpg"
+
+
+def load_completed(results_path: Path, output_dir: Path, specs: tuple[str, ...]) -> set[str]:
+    """Sources already rendered by a previous run whose outputs for every spec are still on disk"""
+    if not results_path.exists():
+        return set()
+    completed = set()
+    with open(results_path, newline='') as f:
+        for row in csv.DictReader(f):
+            outputs = [output_filename(row['source'], row['name'], spec) for spec in specs]
+            if row.get('status') == 'ok' and all((output_dir / output).exists() for output in outputs):
+                completed.add(row['source'])
+    return completed
+
+
+def init_worker() -> None:
+    # One process per core already; stop OpenCV from spawning its own threads on top
+    cv2.setNumThreads(1)
+
+
+def process_one(source: str, name: str, output_dir: str, specs: tuple[str, ...]) -> dict:
+    """Render a single input inside a pool worker and return its results row"""
+    start = time.perf_counter()
+    row = {'source': source, 'name': name, 'status': 'failed', 'output_file': '', 'file_size': 0, 'error': ''}
+    try:
+        invalid_name = name_error(name)
+        if invalid_name:
+            raise HTTPException(status_code=400, detail=invalid_name)
+        image_bytes = Path(source).read_bytes()
+        if len(image_bytes) > MAX_INPUT_BYTES:
+            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit.")
+        header = inspect_image_header(image_bytes)
+        result = run_passport_pipeline(image_bytes, name, header, specs=specs)
+
+        # Write to a temporary name first so a killed run never leaves a truncated photo behind
+        filenames = []
+        for rendition in result.renditions():
+            filename = output_filename(source, name, rendition.spec)
+            target = Path(output_dir) / filename
+            partial = target.with_suffix('.jpg.part')
+            partial.write_bytes(rendition.processed_bytes)
+            partial.replace(target)
+            filenames.append(filename)
+        row.update(
+            status='ok',
+            output_file=';'.join(filenames),
+            file_size=sum(rendition.file_size for rendition in result.renditions())
+        )
+    except HTTPException as e:
+        row['error'] = str(e.detail)
+    except Exception as e:
+        row['error'] = f"Image processing failed: {str(e)}"
+    row['seconds'] = f"{time.perf_counter() - start:.3f}"
+    return row
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Render passport photos for a directory or manifest of images")
+    parser.add_argument('input_dir', nargs='?', help="Directory to walk for .jpg/.jpeg/.png inputs")
+    parser.add_argument('--manifest', help="CSV of path,name rows (paths relative to the CSV)")
+    parser.add_argument('--output', required=True, help="Directory for rendered photos and results.csv")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Worker processes (default: all cores)")
+    parser.add_argument('--results', help="Results manifest path (default: <output>/results.csv)")
+    parser.add_argument('--specs', help="Comma-separated photo specs to render from each input (default: standard)")
+    args = parser.parse_args()
+
+    if bool(args.input_dir) == bool(args.manifest):
+        parser.error("Pass either an input directory or --manifest")
+    try:
+        specs = parse_photo_specs(args.specs)
+    except HTTPException as e:
+        parser.error(e.detail)
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results_path = Path(args.results) if args.results else output_dir / 'results.csv'
+
+    inputs = collect_inputs(args.input_dir, args.manifest)
+    completed = load_completed(results_path, output_dir, specs)
+    pending = [(source, name) for source, name in inputs if source not in completed]
+    skipped = len(inputs) - len(pending)
+    print(f"{len(inputs)} inputs, {skipped} already done, {len(pending)} to process on {args.workers} workers")
+    if not pending:
+        return 0
+
+    new_file = not results_path.exists()
+    succeeded = failed = 0
+    start = last_report = time.perf_counter()
+    with open(results_path, 'a', newline='') as results_file, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+        writer = csv.DictWriter(results_file, fieldnames=RESULT_FIELDS)
+        if new_file:
+            writer.writeheader()
+
+        # Keep a bounded window of submissions so huge batches do not queue every future up front
+        queue = iter(pending)
+        in_flight = set()
+        window = args.workers * 2
+        while True:
+            for source, name in queue:
+                in_flight.add(executor.submit(process_one, source, name, str(output_dir), specs))
+                if len(in_flight) >= window:
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                row = future.result()
+                writer.writerow(row)
+                if row['status'] == 'ok':
+                    succeeded += 1
+                else:
+                    failed += 1
+                    print(f"  failed {row['source']}: {row['error']}")
+            results_file.flush()
+
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                last_report = now
+                finished = succeeded + failed
+                rate = finished / (now - start)
+                remaining = (len(pending) - finished) / rate if rate else 0
+                print(f"  [{finished}/{len(pending)}] {rate:.1f} img/s, ~{remaining:.0f}s left")
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"\nProcessed {succeeded + failed} in {elapsed:.1f}s ({(succeeded + failed) / elapsed:.1f} img/s): "
+        f"{succeeded} ok, {failed} failed, {skipped} skipped"
+    )
+    print(f"Results: {results_path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Delivery of stored photo files: HMAC-signed, expiring download URLs and
+responses that hand the actual byte streaming to the reverse proxy.
+
+With DOWNLOAD_DELIVERY=nginx (X-Accel-Redirect) or apache (X-Sendfile) the app
+only checks the signature and returns headers; the proxy streams the file from
+disk. The default "app" mode streams from this process for local development.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import quote, urlencode
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+# "app" (default) streams files from this process; "nginx" and "apache" delegate to the proxy
+DOWNLOAD_DELIVERY = os.environ.get('DOWNLOAD_DELIVERY', 'app').lower()
+if DOWNLOAD_DELIVERY not in ("app", "nginx", "apache"):
+    DOWNLOAD_DELIVERY = "app"
+# Internal nginx location aliased to the uploads directory, e.g. `location /protected-uploads/ { internal; alias ...; }`
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-uploads/')
+
+# When a signing key is set, downloads need a valid, unexpired signature
+DOWNLOAD_SIGNING_KEY = os.environ.get('DOWNLOAD_SIGNING_KEY', '').encode('utf-8')
+DOWNLOAD_URL_TTL_SECONDS = int(os.environ.get('DOWNLOAD_URL_TTL_SECONDS', '900'))
+
+
+def download_signature(filename: str, expires: int) -> str:
+    """URL-safe HMAC-SHA256 over the filename and its expiry time"""
+    digest = hmac.new(DOWNLOAD_SIGNING_KEY, f"{filename}\n{expires}".encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def signed_download_url(filename: str, ttl_seconds: Optional[int] = None) -> str:
+    """Relative download URL; carries an expiring signature when signing is configured"""
+    path = f"/api/download/{quote(filename)}"
+    if not DOWNLOAD_SIGNING_KEY:
+        return path
+    expires = int(time.time()) + (ttl_seconds or DOWNLOAD_URL_TTL_SECONDS)
+    return f"{path}?{urlencode({'expires': expires, 'signature': download_signature(filename, expires)})}"
+
+
+def verify_download_signature(filename: str, expires: Optional[int], signature: Optional[str]) -> None:
+    """Reject missing, forged or expired signatures; a no-op while signing is not configured"""
+    if not DOWNLOAD_SIGNING_KEY:
+        return
+    if expires is None or not signature:
+        raise HTTPException(status_code=403, detail="Download link is missing its signature.")
+    if not hmac.compare_digest(download_signature(filename, expires), signature):
+        raise HTTPException(status_code=403, detail="Download link is invalid.")
+    if expires < time.time():
+        raise HTTPException(status_code=403, detail="Download link has expired.")
+
+
+class DownloadFileResponse(FileResponse):
+    # Passport photos are well under this, so the fallback reads and sends each file in one chunk
+    chunk_size = 256 * 1024
+
+
+def deliver_file(
+    root: Path,
+    name: str,
+    media_type: str,
+    headers: Optional[dict] = None,
+    mode: Optional[str] = None,
+    filename: Optional[str] = None
+) -> Response:
+    """
+    Response for the file at root/name: proxy-streamed in nginx/apache mode, streamed
+    here otherwise. filename is what the client saves it as (defaults to name).
+    """
+    mode = mode or DOWNLOAD_DELIVERY
+    filename = filename or name
+    path = root / name
+    stat_result = path.stat()  # raises FileNotFoundError for callers to map to 404
+    headers = dict(headers or {})
+    if mode == "app":
+        # A known stat skips FileResponse's own; servers with http.response.pathsend get zero-copy sends
+        return DownloadFileResponse(
+            path=str(path), media_type=media_type, filename=filename, headers=headers, stat_result=stat_result
+        )
+
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    if mode == "nginx":
+        headers["X-Accel-Redirect"] = DOWNLOAD_ACCEL_PREFIX + quote(name)
+    else:
+        headers["X-Sendfile"] = str(path.resolve())
+    # Empty body; the proxy replaces it with the file and sets Content-Length itself
+    return Response(status_code=200, media_type=media_type, headers=headers)
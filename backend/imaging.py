@@ -0,0 +1,994 @@
+"""
+Image processing for the Passport Photo Generator: header inspection, decode,
+face detection and passport photo rendering.
+
+Kept free of the API's MongoDB and Google Drive setup so the same code can be
+imported by process-pool workers and offline tools.
+"""
+
+from fastapi import HTTPException
+from dotenv import load_dotenv
+import os
+import logging
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+import io
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+import re
+import json
+import struct
+import threading
+import warnings
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from itertools import chain
+
+from memory_profiling import memory_stage
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+logger = logging.getLogger(__name__)
+
+# Passport photo output specification
+PHOTO_SIZE = 600
+PHOTO_DPI = 300
+BANNER_ALPHA = 180
+
+# Rendering engine: "pil" (default) or "opencv" (single decode, numpy banner, cv2 encode)
+RENDER_ENGINE = os.environ.get('RENDER_ENGINE', 'pil').lower()
+if RENDER_ENGINE not in ("pil", "opencv"):
+    logger.warning(f"Unknown RENDER_ENGINE '{RENDER_ENGINE}', falling back to 'pil'")
+    RENDER_ENGINE = "pil"
+
+# Decompression-bomb guard: maximum decoded pixels per upload, checked from the header only
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(50_000_000)))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# Oversized images are rejected explicitly in inspect_image_header, so Pillow's warning is redundant
+warnings.filterwarnings('ignore', category=Image.DecompressionBombWarning)
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG"}
+# Multi-picture JPEGs written by many phone cameras; the first picture is an ordinary JPEG
+JPEG_FORMAT_ALIASES = {"MPO": "JPEG"}
+
+# Client face hints: ROI padding (fraction of the box) and minimum overlap to accept the hint
+FACE_HINT_PADDING = float(os.environ.get('FACE_HINT_PADDING', '0.5'))
+FACE_HINT_MIN_IOU = float(os.environ.get('FACE_HINT_MIN_IOU', '0.3'))
+
+# Large JPEGs: detect on the embedded EXIF thumbnail first, then confirm on a full-resolution ROI (0 disables)
+THUMBNAIL_DETECTION_MIN_PIXELS = int(os.environ.get('THUMBNAIL_DETECTION_MIN_PIXELS', str(4_000_000)))
+
+# Keep each render's un-annotated base image so a name can be corrected without reprocessing
+KEEP_BASE_IMAGES = os.environ.get('KEEP_BASE_IMAGES', 'on').lower() != 'off'
+
+# Lighter previews encoded from each finished photo next to the JPEG master: comma-separated "webp", "avif"
+# AVIF speed 8 keeps encoding under ~100 ms per photo at a few percent larger output than the default 6
+PREVIEW_SAVE_OPTIONS = {"avif": {"quality": 55, "speed": 8}, "webp": {"quality": 80}}
+PREVIEW_MEDIA_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+Image.init()
+PREVIEW_FORMATS = []
+for _format in filter(None, os.environ.get('PREVIEW_FORMATS', '').lower().replace(' ', '').split(',')):
+    if _format not in PREVIEW_SAVE_OPTIONS or _format.upper() not in Image.SAVE:
+        logger.warning(f"Preview format '{_format}' is not supported by this Pillow build, skipping")
+    elif _format not in PREVIEW_FORMATS:
+        PREVIEW_FORMATS.append(_format)
+PREVIEW_FORMATS = tuple(PREVIEW_FORMATS)
+
+# Photo compliance report: "off", "report" (default, stored with metadata) or "enforce" (reject before rendering)
+COMPLIANCE_MODE = os.environ.get('COMPLIANCE_MODE', 'report').lower()
+COMPLIANCE_SAMPLE_SIZE = 256
+
+def _optional_float(key: str) -> Optional[float]:
+    value = os.environ.get(key)
+    return float(value) if value else None
+
+COMPLIANCE_MIN_SHARPNESS = _optional_float('COMPLIANCE_MIN_SHARPNESS')
+COMPLIANCE_MIN_BRIGHTNESS = _optional_float('COMPLIANCE_MIN_BRIGHTNESS')
+COMPLIANCE_MAX_BRIGHTNESS = _optional_float('COMPLIANCE_MAX_BRIGHTNESS')
+COMPLIANCE_MIN_FACE_RATIO = _optional_float('COMPLIANCE_MIN_FACE_RATIO')
+COMPLIANCE_MAX_CENTER_OFFSET = _optional_float('COMPLIANCE_MAX_CENTER_OFFSET')
+COMPLIANCE_MAX_BACKGROUND_STD = _optional_float('COMPLIANCE_MAX_BACKGROUND_STD')
+
+# ============= PHOTO SPECS =============
+
+def _mm_to_px(mm: float, dpi: int = PHOTO_DPI) -> int:
+    return round(mm / 25.4 * dpi)
+
+@dataclass(frozen=True)
+class PhotoSpec:
+    """Output format for one country/document photo standard"""
+    key: str
+    label: str
+    width: int  # output pixels
+    height: int
+    dpi: int
+    head_ratio: float  # detected face box height as a fraction of the frame height
+    headroom: float  # extra room above the face as a fraction of its height (the crop shifts up by half)
+    
+    @property
+    def aspect_ratio(self) -> float:
+        return self.width / self.height
+
+# Official head sizes are chin-to-crown; the Haar face box covers roughly 80% of that height
+PHOTO_SPECS = {
+    spec.key: spec for spec in (
+        PhotoSpec("standard", "Passport photo 600x600", PHOTO_SIZE, PHOTO_SIZE, PHOTO_DPI, 1 / 1.5, 0.3),
+        PhotoSpec("us_2x2", "US passport/visa 2x2 in", 2 * PHOTO_DPI, 2 * PHOTO_DPI, PHOTO_DPI, 0.48, 0.35),
+        PhotoSpec("schengen_35x45", "Schengen visa 35x45 mm", _mm_to_px(35), _mm_to_px(45), PHOTO_DPI, 0.6, 0.3),
+        PhotoSpec("india_51x51", "India passport/visa 51x51 mm", _mm_to_px(51), _mm_to_px(51), PHOTO_DPI, 0.48, 0.35),
+    )
+}
+DEFAULT_PHOTO_SPEC = "standard"
+
+# ============= IMAGE PROCESSING =============
+
+def sanitize_filename(name: str) -> str:
+    """Sanitize name for use in filename"""
+    # Remove special characters, keep only alphanumeric, spaces, hyphens
+    sanitized = re.sub(r'[^a-zA-Z0-9\s-]', '', name)
+    # Replace spaces with underscores
+    sanitized = sanitized.replace(' ', '_').lower()
+    return sanitized
+
+def name_error(name: str) -> Optional[str]:
+    """Return why a banner name is unacceptable, or None if it is valid"""
+    if not name or len(name) > 50:
+        return "Name is required and must be less than 50 characters."
+    if not re.match(r"^[a-zA-Z0-9\s\-\']+$", name):
+        return "Name contains invalid characters."
+    return None
+
+MODE_BIT_DEPTHS = {"1": 1, "I;16": 16, "I;16B": 16, "I;16L": 16, "I": 32, "F": 32}
+
+@dataclass(frozen=True)
+class ImageHeader:
+    """Facts read from an image header without decoding any pixels"""
+    format: str
+    width: int
+    height: int
+    mode: str
+    bit_depth: int
+    frames: int
+    orientation: int
+    
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+def read_exif_orientation(img: Image.Image) -> int:
+    """Read EXIF orientation from header-parsed metadata, never triggering a pixel load"""
+    raw_exif = img.info.get('exif')
+    if not raw_exif:
+        return 1
+    try:
+        exif = Image.Exif()
+        exif.load(raw_exif)
+        return int(exif.get(0x0112, 1))
+    except Exception:
+        return 1
+
+def inspect_image_header(image_bytes: bytes) -> ImageHeader:
+    """Validate an upload from its header only and reject decompression bombs before decoding"""
+    try:
+        # Image.open is lazy: it parses the header and stops before the pixel data
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            header = ImageHeader(
+                format=JPEG_FORMAT_ALIASES.get(img.format, img.format or "unknown"),
+                width=img.width,
+                height=img.height,
+                mode=img.mode,
+                bit_depth=MODE_BIT_DEPTHS.get(img.mode, 8),
+                frames=getattr(img, 'n_frames', 1),
+                orientation=read_exif_orientation(img)
+            )
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=400, detail="Image dimensions are too large.")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid or corrupted image file.")
+    
+    if header.format not in ALLOWED_IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail="Only JPG and PNG formats are supported.")
+    
+    if header.pixels > MAX_IMAGE_PIXELS:
+        logger.warning(f"Rejected {header.width}x{header.height} image over pixel budget {MAX_IMAGE_PIXELS}")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Image dimensions {header.width}x{header.height} exceed the {MAX_IMAGE_PIXELS // 1_000_000} MP limit."
+        )
+    
+    logger.debug(
+        "Header: %s %dx%d %s %d-bit, %d frame(s), orientation %d",
+        header.format, header.width, header.height, header.mode, header.bit_depth, header.frames, header.orientation
+    )
+    return header
+
+def plan_decode(header: Optional[ImageHeader]) -> int:
+    """Choose cv2.imdecode flags from already-parsed header facts"""
+    flags = cv2.IMREAD_COLOR
+    # cv2 re-parses EXIF to auto-rotate; skip that when the header says no rotation is needed
+    if header is not None and header.orientation == 1:
+        flags |= cv2.IMREAD_IGNORE_ORIENTATION
+    if header is not None and header.frames > 1:
+        logger.debug("Multi-frame %s, decoding first frame only", header.format)
+    return flags
+
+def decode_image(image_bytes: bytes, header: Optional[ImageHeader] = None) -> Optional[np.ndarray]:
+    """Decode image bytes into a BGR numpy array"""
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    return cv2.imdecode(nparr, plan_decode(header))
+
+_cascade_local = threading.local()
+
+def get_face_cascade() -> "cv2.CascadeClassifier":
+    """Load the Haar Cascade once per thread (detectMultiScale is not thread-safe)"""
+    face_cascade = getattr(_cascade_local, 'face_cascade', None)
+    if face_cascade is None:
+        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        _cascade_local.face_cascade = face_cascade
+    return face_cascade
+
+def detect_face_in_image(img: np.ndarray) -> Optional[tuple]:
+    """Detect the largest face in an already decoded BGR image"""
+    # Convert to grayscale
+    return detect_face_in_gray(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+
+def detect_face_in_gray(gray: np.ndarray) -> Optional[tuple]:
+    """Detect the largest face in a full-frame grayscale image"""
+    # Load Haar Cascade for face detection
+    face_cascade = get_face_cascade()
+    
+    # Detect faces
+    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+    
+    if len(faces) == 0:
+        logger.warning("No face detected")
+        return None
+    
+    # Get the largest face
+    largest_face = max(faces, key=lambda rect: rect[2] * rect[3])
+    x, y, w, h = largest_face
+    
+    logger.debug("Face detected at (%d, %d) with size %dx%d", x, y, w, h)
+    return (x, y, w, h, gray.shape[1], gray.shape[0])  # x, y, w, h, img_width, img_height
+
+def detect_face_opencv(image_bytes: bytes) -> Optional[tuple]:
+    """Detect face using OpenCV Haar Cascade"""
+    try:
+        img = decode_image(image_bytes)
+        
+        if img is None:
+            logger.error("Failed to decode image")
+            return None
+        
+        return detect_face_in_image(img)
+        
+    except Exception as e:
+        logger.error(f"Face detection error: {str(e)}")
+        return None
+
+# PIL transpose steps that bring a stored image upright for each EXIF orientation value
+EXIF_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def _jpeg_exif_tiff(view: memoryview) -> Optional[memoryview]:
+    """Locate the TIFF block of a JPEG's EXIF APP1 segment by walking the markers"""
+    if bytes(view[:2]) != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(view) and view[pos] == 0xFF:
+        marker = view[pos + 1]
+        if marker in (0xDA, 0xD9):  # start of scan / end of image: no more metadata
+            return None
+        length = int.from_bytes(view[pos + 2:pos + 4], 'big')
+        if marker == 0xE1 and bytes(view[pos + 4:pos + 10]) == b'Exif\x00\x00':
+            return view[pos + 10:pos + 2 + length]
+        pos += 2 + length
+    return None
+
+def _tiff_thumbnail(tiff: memoryview) -> Optional[memoryview]:
+    """Return the JPEG thumbnail referenced by IFD1 of an EXIF TIFF block"""
+    order = {b'II': '<', b'MM': '>'}.get(bytes(tiff[:2]))
+    if order is None:
+        return None
+    try:
+        ifd0 = struct.unpack_from(order + 'I', tiff, 4)[0]
+        entries = struct.unpack_from(order + 'H', tiff, ifd0)[0]
+        ifd1 = struct.unpack_from(order + 'I', tiff, ifd0 + 2 + 12 * entries)[0]
+        if not ifd1:
+            return None
+        tags = {}
+        for index in range(struct.unpack_from(order + 'H', tiff, ifd1)[0]):
+            tag, value_type, _ = struct.unpack_from(order + 'HHI', tiff, ifd1 + 2 + 12 * index)
+            value_format = 'H' if value_type == 3 else 'I'
+            tags[tag] = struct.unpack_from(order + value_format, tiff, ifd1 + 10 + 12 * index)[0]
+    except struct.error:
+        return None
+    offset, length = tags.get(0x0201), tags.get(0x0202)  # JPEGInterchangeFormat, ...Length
+    if not offset or not length or offset + length > len(tiff):
+        return None
+    return tiff[offset:offset + length]
+
+def read_exif_thumbnail(image_bytes: bytes, header: ImageHeader) -> Optional[np.ndarray]:
+    """Decode a JPEG's embedded EXIF thumbnail as grayscale, oriented like the full decode"""
+    tiff = _jpeg_exif_tiff(memoryview(image_bytes).cast('B'))
+    thumbnail = _tiff_thumbnail(tiff) if tiff is not None else None
+    if thumbnail is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(thumbnail))
+        img = img.convert('L')
+    except Exception:
+        return None
+    if header.orientation in EXIF_TRANSPOSES:
+        img = img.transpose(EXIF_TRANSPOSES[header.orientation])
+    
+    # Thumbnails that are letterboxed or stale (edited photos) do not match the frame; skip them
+    full_width, full_height = (header.height, header.width) if header.orientation in (5, 6, 7, 8) else (header.width, header.height)
+    if abs(img.width / img.height - full_width / full_height) > 0.02 * full_width / full_height:
+        logger.debug("EXIF thumbnail aspect ratio does not match the image, ignoring it")
+        return None
+    return np.asarray(img)
+
+def thumbnail_face_hints(image_bytes: bytes, header: Optional[ImageHeader]):
+    """Lazily yield a face box found on the EXIF thumbnail of a large JPEG, in thumbnail coordinates"""
+    if (
+        header is None
+        or header.format != "JPEG"
+        or not THUMBNAIL_DETECTION_MIN_PIXELS
+        or header.pixels < THUMBNAIL_DETECTION_MIN_PIXELS
+    ):
+        return
+    thumbnail = read_exif_thumbnail(image_bytes, header)
+    if thumbnail is None:
+        return
+    faces = get_face_cascade().detectMultiScale(thumbnail, scaleFactor=1.05, minNeighbors=4, minSize=(20, 20))
+    if len(faces) == 0:
+        logger.debug("No face on the EXIF thumbnail")
+        return
+    x, y, w, h = (int(v) for v in max(faces, key=lambda rect: rect[2] * rect[3]))
+    logger.debug("Face found on %dx%d EXIF thumbnail", thumbnail.shape[1], thumbnail.shape[0])
+    yield (x, y, w, h, thumbnail.shape[1], thumbnail.shape[0])
+
+def parse_face_hint(raw: Optional[str]) -> Optional[tuple]:
+    """Parse a client-reported face box: JSON with x, y, width, height, image_width, image_height"""
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+        hint = tuple(int(round(float(data[key]))) for key in ('x', 'y', 'width', 'height', 'image_width', 'image_height'))
+    except (ValueError, TypeError, KeyError) as e:
+        logger.warning(f"Ignoring malformed face hint: {str(e)}")
+        return None
+    x, y, w, h, img_width, img_height = hint
+    if w <= 0 or h <= 0 or img_width <= 0 or img_height <= 0:
+        logger.warning("Ignoring face hint with non-positive dimensions")
+        return None
+    return hint
+
+def parse_photo_specs(raw: Optional[str]) -> tuple[str, ...]:
+    """Parse a comma-separated list of photo spec keys; the first one is the primary output"""
+    keys = tuple(dict.fromkeys(key.strip().lower() for key in (raw or '').split(',') if key.strip()))
+    if not keys:
+        return (DEFAULT_PHOTO_SPEC,)
+    unknown = [key for key in keys if key not in PHOTO_SPECS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown photo spec: {', '.join(unknown)}. Available: {', '.join(PHOTO_SPECS)}."
+        )
+    return keys
+
+def _box_iou(a: tuple, b: tuple) -> float:
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union else 0.0
+
+def verify_face_hint(img: np.ndarray, hint: tuple) -> Optional[tuple]:
+    """Confirm a client face box by running the cascade on a padded ROI around it only"""
+    img_height, img_width = img.shape[:2]
+    x, y, w, h, hint_width, hint_height = hint
+    
+    # The client may have measured a resized preview; rescale if the aspect ratio agrees
+    if (hint_width, hint_height) != (img_width, img_height):
+        sx, sy = img_width / hint_width, img_height / hint_height
+        if abs(sx - sy) > 0.02 * max(sx, sy):
+            logger.debug("Face hint dimensions do not match the image, ignoring hint")
+            return None
+        x, y, w, h = int(x * sx), int(y * sy), int(w * sx), int(h * sy)
+    
+    pad = int(max(w, h) * FACE_HINT_PADDING)
+    left, top = max(0, x - pad), max(0, y - pad)
+    right, bottom = min(img_width, x + w + pad), min(img_height, y + h + pad)
+    if right - left < 30 or bottom - top < 30:
+        return None
+    
+    gray = cv2.cvtColor(img[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+    min_side = max(30, int(min(w, h) * 0.5))
+    faces = get_face_cascade().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+    
+    hint_box = (x, y, w, h)
+    best, best_iou = None, 0.0
+    for fx, fy, fw, fh in faces:
+        candidate = (int(fx) + left, int(fy) + top, int(fw), int(fh))
+        iou = _box_iou(candidate, hint_box)
+        if iou > best_iou:
+            best, best_iou = candidate, iou
+    
+    if best is None or best_iou < FACE_HINT_MIN_IOU:
+        logger.debug("Face hint not confirmed (best IoU %.2f)", best_iou)
+        return None
+    
+    logger.debug("Face hint verified at (%d, %d) with size %dx%d", *best)
+    return (*best, img_width, img_height)
+
+def locate_face_with_gray(
+    img: np.ndarray,
+    hint: Optional[tuple] = None,
+    more_hints: Iterable[tuple] = ()
+) -> tuple[Optional[tuple], Optional[np.ndarray]]:
+    """locate_face that also returns the full-frame grayscale when one had to be built"""
+    # Each candidate box costs one small ROI pass; more_hints is only consumed if earlier ones fail
+    tried = False
+    for candidate in chain(() if hint is None else (hint,), more_hints):
+        tried = True
+        verified = verify_face_hint(img, candidate)
+        if verified:
+            return verified, None
+    if tried:
+        logger.debug("Falling back to full-frame face detection")
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return detect_face_in_gray(gray), gray
+
+def locate_face(img: np.ndarray, hint: Optional[tuple] = None) -> Optional[tuple]:
+    """Use a verified client face hint when available, otherwise run full-frame detection"""
+    return locate_face_with_gray(img, hint)[0]
+
+@dataclass
+class ComplianceReport:
+    """Photo quality and framing measurements taken on the passport crop"""
+    sharpness: float  # Laplacian variance of the face, normalised to 200x200
+    brightness_mean: float
+    brightness_std: float
+    shadow_clip_fraction: float
+    highlight_clip_fraction: float
+    face_brightness_mean: float
+    face_to_frame_ratio: float  # face height / crop height
+    face_center_offset_x: float  # -0.5..0.5 of crop width, 0 is centred
+    face_center_offset_y: float
+    background_std: float  # grey-level spread outside the face; low means uniform
+    issues: list[str] = field(default_factory=list)
+
+def assess_compliance(
+    img: np.ndarray,
+    face_coords: tuple,
+    gray: Optional[np.ndarray] = None,
+    spec: Optional[PhotoSpec] = None
+) -> ComplianceReport:
+    """Measure sharpness, exposure, framing and background on the crop the renderer will use"""
+    x, y, w, h, img_width, img_height = face_coords
+    left, top, right, bottom = compute_crop_box(face_coords, img_width, img_height, spec)
+    
+    # Reuse the detector's grayscale when there is one; otherwise convert just the crop
+    if gray is not None:
+        crop_gray = gray[top:bottom, left:right]
+    else:
+        crop_gray = cv2.cvtColor(img[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+    crop_height, crop_width = crop_gray.shape
+    fx, fy = x - left, y - top
+    
+    face_roi = crop_gray[max(0, fy):fy + h, max(0, fx):fx + w]
+    if face_roi.size == 0:
+        face_roi = crop_gray
+    face_small = cv2.resize(face_roi, (200, 200), interpolation=cv2.INTER_AREA)
+    sharpness = float(cv2.Laplacian(face_small, cv2.CV_64F).var())
+    
+    # Exposure and background statistics on a downscaled crop keep the cost flat
+    scale = min(1.0, COMPLIANCE_SAMPLE_SIZE / max(crop_height, crop_width))
+    small = cv2.resize(crop_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else crop_gray
+    histogram = np.bincount(small.ravel(), minlength=256)
+    total = histogram.sum()
+    levels = np.arange(256)
+    brightness_mean = float((histogram * levels).sum() / total)
+    brightness_std = float(np.sqrt((histogram * (levels - brightness_mean) ** 2).sum() / total))
+    
+    # Background: everything outside the face box grown by 20%
+    background = np.ones(small.shape, dtype=bool)
+    grow_x, grow_y = int(w * 0.2), int(h * 0.2)
+    bx0, by0 = int(max(0, fx - grow_x) * scale), int(max(0, fy - grow_y) * scale)
+    bx1, by1 = int((fx + w + grow_x) * scale), int((fy + h + grow_y) * scale)
+    background[by0:by1, bx0:bx1] = False
+    background_pixels = small[background]
+    background_std = float(background_pixels.std()) if background_pixels.size else 0.0
+    
+    report = ComplianceReport(
+        sharpness=round(sharpness, 2),
+        brightness_mean=round(brightness_mean, 2),
+        brightness_std=round(brightness_std, 2),
+        shadow_clip_fraction=round(float(histogram[:11].sum() / total), 4),
+        highlight_clip_fraction=round(float(histogram[245:].sum() / total), 4),
+        face_brightness_mean=round(float(face_small.mean()), 2),
+        face_to_frame_ratio=round(h / crop_height, 3),
+        face_center_offset_x=round((fx + w / 2) / crop_width - 0.5, 3),
+        face_center_offset_y=round((fy + h / 2) / crop_height - 0.5, 3),
+        background_std=round(background_std, 2)
+    )
+    report.issues = compliance_issues(report)
+    return report
+
+def compliance_issues(report: ComplianceReport) -> list[str]:
+    """Compare a report against the configured thresholds; unset thresholds are skipped"""
+    checks = [
+        (COMPLIANCE_MIN_SHARPNESS, report.sharpness < (COMPLIANCE_MIN_SHARPNESS or 0), "Photo is blurry"),
+        (COMPLIANCE_MIN_BRIGHTNESS, report.face_brightness_mean < (COMPLIANCE_MIN_BRIGHTNESS or 0), "Face is too dark"),
+        (COMPLIANCE_MAX_BRIGHTNESS, report.face_brightness_mean > (COMPLIANCE_MAX_BRIGHTNESS or 0), "Face is overexposed"),
+        (COMPLIANCE_MIN_FACE_RATIO, report.face_to_frame_ratio < (COMPLIANCE_MIN_FACE_RATIO or 0), "Face is too small in the frame"),
+        (COMPLIANCE_MAX_CENTER_OFFSET,
+         max(abs(report.face_center_offset_x), abs(report.face_center_offset_y)) > (COMPLIANCE_MAX_CENTER_OFFSET or 0),
+         "Face is not centred"),
+        (COMPLIANCE_MAX_BACKGROUND_STD, report.background_std > (COMPLIANCE_MAX_BACKGROUND_STD or 0), "Background is not plain"),
+    ]
+    return [message for threshold, failed, message in checks if threshold is not None and failed]
+
+def compute_crop_box(
+    face_coords: Optional[tuple],
+    original_width: int,
+    original_height: int,
+    spec: Optional[PhotoSpec] = None
+) -> tuple[int, int, int, int]:
+    """Compute the (left, top, right, bottom) crop box around a face for a photo spec"""
+    spec = spec or PHOTO_SPECS[DEFAULT_PHOTO_SPEC]
+    aspect = spec.aspect_ratio
+    if not face_coords:
+        # No face detected, use the largest centered crop with the spec's aspect ratio
+        crop_width = min(original_width, int(original_height * aspect))
+        crop_height = min(original_height, int(crop_width / aspect))
+        left = (original_width - crop_width) // 2
+        top = (original_height - crop_height) // 2
+        return left, top, left + crop_width, top + crop_height
+    
+    x, y, w, h, img_width, img_height = face_coords
+    
+    # Face occupies head_ratio of the frame height, with headroom above it
+    headroom = int(h * spec.headroom)
+    # Add 15% padding on sides
+    side_padding = int(w * 0.15)
+    
+    # Calculate crop dimensions at the spec's aspect ratio
+    crop_height = int(max((w + 2 * side_padding) / aspect, h / spec.head_ratio))
+    crop_width = int(crop_height * aspect)
+    
+    # Center the crop around the face
+    center_x = x + w // 2
+    center_y = y + h // 2 - headroom // 2  # Shift up for headroom
+    
+    left = max(0, center_x - crop_width // 2)
+    top = max(0, center_y - crop_height // 2)
+    right = min(img_width, left + crop_width)
+    bottom = min(img_height, top + crop_height)
+    
+    # Adjust if crop goes out of bounds
+    if right - left < crop_width:
+        if left == 0:
+            right = min(img_width, left + crop_width)
+        else:
+            left = max(0, right - crop_width)
+    
+    if bottom - top < crop_height:
+        if top == 0:
+            bottom = min(img_height, top + crop_height)
+        else:
+            top = max(0, bottom - crop_height)
+    
+    return int(left), int(top), int(right), int(bottom)
+
+def perceptual_hash(img: np.ndarray, box: tuple[int, int, int, int]) -> str:
+    """64-bit DCT perceptual hash of a crop, as 16 hex digits"""
+    left, top, right, bottom = box
+    small = cv2.resize(img[top:bottom, left:right], (32, 32), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    # Lowest 8x8 frequencies against their median (the DC term would dominate it, so leave it out)
+    dct = cv2.dct(small.astype(np.float32))[:8, :8].ravel()
+    bits = dct > np.median(dct[1:])
+    return np.packbits(bits).tobytes().hex()
+
+@lru_cache(maxsize=1)
+def load_name_font():
+    """Load the font used for the name overlay"""
+    # Try to use a system font
+    try:
+        return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 24)
+    except:
+        try:
+            return ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 24)
+        except:
+            return ImageFont.load_default()
+
+def name_banner_layout(name: str, font, width: int = PHOTO_SIZE, height: int = PHOTO_SIZE) -> tuple[int, int, list]:
+    """Return text position and background rectangle for the name overlay"""
+    # Get text bounding box
+    bbox = font.getbbox(name)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    
+    # Position: bottom center, 40px from bottom
+    text_x = (width - text_width) // 2
+    text_y = height - 40 - text_height
+    
+    # Semi-transparent black rectangle background
+    padding = 10
+    rect_coords = [
+        text_x - padding,
+        text_y - padding,
+        text_x + text_width + padding,
+        text_y + text_height + padding
+    ]
+    return text_x, text_y, rect_coords
+
+def set_jpeg_dpi(jpeg_bytes: bytes, dpi: int) -> bytes:
+    """Patch the JFIF APP0 density fields of an encoded JPEG"""
+    if jpeg_bytes[6:11] != b'JFIF\x00':
+        return jpeg_bytes
+    density = dpi.to_bytes(2, 'big')
+    return jpeg_bytes[:13] + b'\x01' + density + density + jpeg_bytes[18:]
+
+def open_rgb_image(image_bytes: bytes) -> Image.Image:
+    """Open an upload with PIL upright per its EXIF orientation, as cv2 decodes it, and convert it to RGB if necessary"""
+    img = Image.open(io.BytesIO(image_bytes))
+    # Face coordinates come from the cv2 decode, so both engines must crop the same frame
+    orientation = read_exif_orientation(img)
+    if orientation in EXIF_TRANSPOSES:
+        img = img.transpose(EXIF_TRANSPOSES[orientation])
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+def render_passport_photo_pil(
+    image_bytes: bytes,
+    name: str,
+    face_coords: Optional[tuple],
+    spec: Optional[PhotoSpec] = None,
+    source: Optional[Image.Image] = None
+) -> bytes:
+    """Render the passport photo with Pillow, reusing an already opened source image if given"""
+    spec = spec or PHOTO_SPECS[DEFAULT_PHOTO_SPEC]
+    img = source if source is not None else open_rgb_image(image_bytes)
+    return finish_passport_photo_pil(resize_to_spec_pil(img, face_coords, spec), name, spec.dpi)
+
+def resize_to_spec_pil(img: Image.Image, face_coords: Optional[tuple], spec: PhotoSpec) -> Image.Image:
+    """Crop around the face and resize to the spec's output size: the un-annotated base image"""
+    original_width, original_height = img.size
+    logger.debug("Original image size: %dx%d", original_width, original_height)
+    
+    if not face_coords:
+        logger.warning("No face detected, using center crop")
+    
+    # Crop the image
+    img = img.crop(compute_crop_box(face_coords, original_width, original_height, spec))
+    logger.debug("Cropped to: %s", img.size)
+    
+    # Resize to the spec's exact output size with high quality
+    img = img.resize((spec.width, spec.height), Image.Resampling.LANCZOS)
+    logger.debug("Resized to: %s", img.size)
+    return img
+
+def finish_passport_photo_pil(img: Image.Image, name: str, dpi: int) -> bytes:
+    """Draw the name banner on a base image and encode the JPEG; the base itself is left untouched"""
+    return encode_passport_jpeg(annotate_passport_photo_pil(img, name), dpi)
+
+def annotate_passport_photo_pil(img: Image.Image, name: str) -> Image.Image:
+    """Return a copy of the base image with the name banner drawn on it"""
+    # Add name overlay
+    font = load_name_font()
+    text_x, text_y, rect_coords = name_banner_layout(name, font, img.width, img.height)
+    
+    # Create a new image for the overlay with alpha
+    overlay = Image.new('RGBA', img.size, (255, 255, 255, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+    overlay_draw.rectangle(rect_coords, fill=(0, 0, 0, BANNER_ALPHA))
+    
+    # Composite the overlay
+    img_rgba = img.convert('RGBA')
+    img_rgba = Image.alpha_composite(img_rgba, overlay)
+    img = img_rgba.convert('RGB')
+    
+    # Draw text on the final image
+    draw = ImageDraw.Draw(img)
+    draw.text((text_x, text_y), name, fill=(255, 255, 255), font=font)
+    return img
+
+def draw_name_banner(img: np.ndarray, name: str) -> None:
+    """Blend the name banner into a rendered BGR array in place, touching only the banner rows"""
+    height, width = img.shape[:2]
+    font = load_name_font()
+    text_x, text_y, rect_coords = name_banner_layout(name, font, width, height)
+    bbox = font.getbbox(name)
+    
+    # Band of rows covering both the background rectangle and the glyphs
+    band_top = max(0, min(rect_coords[1], text_y + bbox[1]))
+    band_bottom = min(height, max(rect_coords[3] + 1, text_y + bbox[3]))
+    band = img[band_top:band_bottom]
+    
+    # Darken the rectangle exactly like an alpha composite of black at BANNER_ALPHA
+    x0, x1 = max(0, rect_coords[0]), min(width, rect_coords[2] + 1)
+    y0, y1 = rect_coords[1] - band_top, rect_coords[3] + 1 - band_top
+    rect = band[max(0, y0):y1, x0:x1]
+    rect[...] = (rect.astype(np.uint16) * (255 - BANNER_ALPHA) + 127) // 255
+    
+    # Rasterize the text as a coverage mask for the band only and blend white on top
+    mask_img = Image.new('L', (width, band_bottom - band_top), 0)
+    ImageDraw.Draw(mask_img).text((text_x, text_y - band_top), name, fill=255, font=font)
+    mask = np.asarray(mask_img, dtype=np.uint16)[:, :, None]
+    band[...] = band + ((255 - band.astype(np.uint16)) * mask + 127) // 255
+
+def render_passport_photo_opencv(
+    img: np.ndarray,
+    name: str,
+    face_coords: Optional[tuple],
+    spec: Optional[PhotoSpec] = None
+) -> bytes:
+    """Render the passport photo from a decoded BGR array with OpenCV and numpy"""
+    spec = spec or PHOTO_SPECS[DEFAULT_PHOTO_SPEC]
+    return finish_passport_photo_opencv(resize_to_spec_opencv(img, face_coords, spec), name, spec.dpi)
+
+def resize_to_spec_opencv(img: np.ndarray, face_coords: Optional[tuple], spec: PhotoSpec) -> np.ndarray:
+    """Crop around the face and resize to the spec's output size: the un-annotated base image"""
+    original_height, original_width = img.shape[:2]
+    logger.debug("Original image size: %dx%d", original_width, original_height)
+    
+    if not face_coords:
+        logger.warning("No face detected, using center crop")
+    
+    # Crop is a view, no pixels are copied until resize
+    left, top, right, bottom = compute_crop_box(face_coords, original_width, original_height, spec)
+    cropped = img[top:bottom, left:right]
+    logger.debug("Cropped to: (%d, %d)", cropped.shape[1], cropped.shape[0])
+    
+    # INTER_AREA matches Pillow's antialiased LANCZOS closely when shrinking;
+    # cv2's LANCZOS4 has no antialiasing filter and would alias on large downscales
+    interpolation = cv2.INTER_AREA if cropped.shape[0] > spec.height else cv2.INTER_LANCZOS4
+    resized = cv2.resize(cropped, (spec.width, spec.height), interpolation=interpolation)
+    logger.debug("Resized to: (%d, %d)", spec.width, spec.height)
+    return resized
+
+def finish_passport_photo_opencv(img: np.ndarray, name: str, dpi: int) -> bytes:
+    """Draw the name banner on a base array in place and encode the JPEG"""
+    draw_name_banner(img, name)
+    return encode_passport_jpeg(img, dpi)
+
+def annotate_passport_photo_opencv(img: np.ndarray, name: str) -> np.ndarray:
+    """Draw the name banner on a base array in place and return it"""
+    draw_name_banner(img, name)
+    return img
+
+def encode_passport_jpeg(img, dpi: int) -> bytes:
+    """Encode a finished photo (PIL RGB image or BGR array) as the quality-95 JPEG master"""
+    if isinstance(img, Image.Image):
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=95, dpi=(dpi, dpi))
+        return output.getvalue()
+    ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return set_jpeg_dpi(encoded.tobytes(), dpi)
+
+def encode_previews(img, formats: tuple[str, ...] = PREVIEW_FORMATS) -> dict[str, bytes]:
+    """Encode a finished photo in each preview format from the same pixels as the JPEG master"""
+    if not formats:
+        return {}
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    previews = {}
+    for fmt in formats:
+        output = io.BytesIO()
+        img.save(output, format=fmt.upper(), **PREVIEW_SAVE_OPTIONS[fmt])
+        previews[fmt] = output.getvalue()
+    return previews
+
+def encode_jpeg_previews(jpeg_bytes: bytes, formats: tuple[str, ...]) -> dict[str, bytes]:
+    """Previews re-encoded from a stored JPEG master, for nodes that did not render the photo themselves"""
+    return encode_previews(open_rgb_image(jpeg_bytes), formats)
+
+def encode_base_image(base) -> bytes:
+    """Losslessly encode an un-annotated base (PIL RGB image or BGR array) as a fast PNG"""
+    if isinstance(base, Image.Image):
+        output = io.BytesIO()
+        base.save(output, format='PNG', compress_level=1)
+        return output.getvalue()
+    ok, encoded = cv2.imencode('.png', base, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return encoded.tobytes()
+
+def rerender_name(
+    base_image: bytes,
+    name: str,
+    dpi: int,
+    engine: Optional[str] = None
+) -> tuple[bytes, dict[str, bytes]]:
+    """Re-apply only the name banner and encode the JPEG and previews, starting from a stored base image"""
+    try:
+        if (engine or RENDER_ENGINE) == "opencv":
+            base = cv2.imdecode(np.frombuffer(base_image, np.uint8), cv2.IMREAD_COLOR)
+            if base is None:
+                raise ValueError("Failed to decode base image")
+            annotated = annotate_passport_photo_opencv(base, name)
+        else:
+            annotated = annotate_passport_photo_pil(open_rgb_image(base_image), name)
+        return encode_passport_jpeg(annotated, dpi), encode_previews(annotated)
+    except Exception as e:
+        logger.error(f"Re-render error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Re-render failed: {str(e)}")
+
+def process_passport_photo(
+    image_bytes: bytes,
+    name: str,
+    face_coords: Optional[tuple] = None,
+    engine: Optional[str] = None,
+    decoded: Optional[np.ndarray] = None,
+    spec: Optional[PhotoSpec] = None
+) -> tuple[bytes, int]:
+    """Process image to passport photo specifications"""
+    try:
+        engine = engine or RENDER_ENGINE
+        
+        if engine == "opencv":
+            img = decoded if decoded is not None else decode_image(image_bytes)
+            if img is None:
+                raise ValueError("Failed to decode image")
+            # If no face coordinates provided, detect on the same decoded array
+            if face_coords is None:
+                face_coords = detect_face_in_image(img)
+            output_bytes = render_passport_photo_opencv(img, name, face_coords, spec)
+        else:
+            # If no face coordinates provided, try to detect
+            if face_coords is None:
+                face_coords = detect_face_opencv(image_bytes)
+            output_bytes = render_passport_photo_pil(image_bytes, name, face_coords, spec)
+        
+        file_size = len(output_bytes)
+        
+        logger.debug("Final image size: %d bytes", file_size)
+        return output_bytes, file_size
+        
+    except Exception as e:
+        logger.error(f"Image processing error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
+
+@dataclass
+class Rendition:
+    spec: str
+    processed_bytes: bytes
+    file_size: int
+    base_image: Optional[bytes] = None  # un-annotated PNG, kept so the name can be changed later
+    previews: dict[str, bytes] = field(default_factory=dict)  # format -> bytes, same pixels as the master
+
+def render_photo_specs(
+    image_bytes: bytes,
+    name: str,
+    face_coords: tuple,
+    specs: tuple[str, ...],
+    engine: Optional[str] = None,
+    decoded: Optional[np.ndarray] = None
+) -> list[Rendition]:
+    """Render several photo specs from one decoded source, each cropped from the same face coordinates"""
+    try:
+        engine = engine or RENDER_ENGINE
+        
+        if engine == "opencv":
+            img = decoded if decoded is not None else decode_image(image_bytes)
+            if img is None:
+                raise ValueError("Failed to decode image")
+            resize, annotate = partial(resize_to_spec_opencv, img), annotate_passport_photo_opencv
+        else:
+            with memory_stage("decode_pil"):
+                source = open_rgb_image(image_bytes)
+            resize, annotate = partial(resize_to_spec_pil, source), annotate_passport_photo_pil
+        
+        renditions = []
+        for key in specs:
+            spec = PHOTO_SPECS[key]
+            with memory_stage("resize"):
+                base = resize(face_coords, spec)
+            # Encode the base before the banner: the OpenCV path draws into the array in place
+            with memory_stage("base_image"):
+                base_image = encode_base_image(base) if KEEP_BASE_IMAGES else None
+            with memory_stage("annotate"):
+                annotated = annotate(base, name)
+            with memory_stage("encode"):
+                output_bytes = encode_passport_jpeg(annotated, spec.dpi)
+            with memory_stage("previews"):
+                previews = encode_previews(annotated)
+            renditions.append(Rendition(key, output_bytes, len(output_bytes), base_image, previews))
+            logger.debug("Rendered %s: %d bytes", key, len(output_bytes))
+        return renditions
+        
+    except Exception as e:
+        logger.error(f"Image processing error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
+
+def no_progress(stage: str) -> None:
+    pass
+
+@dataclass
+class PipelineResult:
+    processed_bytes: bytes
+    file_size: int
+    face_coords: tuple
+    compliance: Optional[ComplianceReport] = None
+    spec: str = DEFAULT_PHOTO_SPEC
+    perceptual_hash: Optional[str] = None
+    base_image: Optional[bytes] = None
+    previews: dict[str, bytes] = field(default_factory=dict)
+    # Further specs requested in the same pass, rendered from the same decode and detection
+    extra_renditions: list[Rendition] = field(default_factory=list)
+    
+    def renditions(self) -> list[Rendition]:
+        """One rendition per requested spec, primary first"""
+        primary = Rendition(self.spec, self.processed_bytes, self.file_size, self.base_image, self.previews)
+        return [primary] + self.extra_renditions
+
+def run_passport_pipeline(
+    image_bytes: bytes,
+    name: str,
+    header: ImageHeader,
+    face_hint: Optional[tuple] = None,
+    progress: Callable[[str], None] = no_progress,
+    specs: tuple[str, ...] = (DEFAULT_PHOTO_SPEC,)
+) -> PipelineResult:
+    """Decode, detect and render one upload; runs inside the processing executor"""
+    # Decode once and share the array between detection and rendering
+    progress("decoding")
+    with memory_stage("decode"):
+        decoded = decode_image(image_bytes, header)
+    if decoded is None:
+        raise HTTPException(status_code=400, detail="Could not decode the uploaded image.")
+    
+    # Detect face, verifying the client-reported or EXIF-thumbnail box on a small ROI when present
+    progress("detecting")
+    with memory_stage("detect"):
+        face_coords, gray = locate_face_with_gray(decoded, face_hint, thumbnail_face_hints(image_bytes, header))
+    if not face_coords:
+        raise HTTPException(
+            status_code=400,
+            detail="No face detected in the photo. Please upload a clear, frontal face photo."
+        )
+    face_coords = tuple(int(v) for v in face_coords)
+    
+    # Quality checks run before rendering so failing photos never reach upload
+    compliance = None
+    if COMPLIANCE_MODE != "off":
+        compliance = assess_compliance(decoded, face_coords, gray, PHOTO_SPECS[specs[0]])
+        if compliance.issues and COMPLIANCE_MODE == "enforce":
+            raise HTTPException(
+                status_code=400,
+                detail=f"Photo failed quality checks: {'; '.join(compliance.issues)}."
+            )
+    
+    # Hash the standard face crop of the source, so re-uploads of one shot match whatever specs they ask for
+    hash_source = gray if gray is not None else decoded
+    photo_hash = perceptual_hash(hash_source, compute_crop_box(face_coords, decoded.shape[1], decoded.shape[0]))
+    gray = hash_source = None
+    
+    # The PIL engine decodes on its own, so drop the cv2 array first to cap peak memory
+    if RENDER_ENGINE != "opencv":
+        decoded = None
+    
+    # Every spec is cropped from the same coordinates, so decode and detection are shared
+    progress("rendering")
+    primary, *extras = render_photo_specs(image_bytes, name, face_coords, specs, decoded=decoded)
+    return PipelineResult(
+        primary.processed_bytes, primary.file_size, face_coords, compliance, primary.spec, photo_hash,
+        primary.base_image, primary.previews, extras
+    )
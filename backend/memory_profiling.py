@@ -0,0 +1,191 @@
+"""
+Opt-in memory instrumentation for finding what drives worker memory peaks.
+
+MEMORY_PROFILING=rss records, per endpoint, how far resident memory (the number
+the OOM killer cares about) rose above its starting level at any point during
+each request. A background thread samples current RSS from /proc/self/statm
+while requests or stages are open; the process-lifetime ru_maxrss is only a
+fallback where /proc is missing, and there it stops showing growth once an
+earlier request has set the peak. MEMORY_PROFILING=tracemalloc additionally
+traces Python and numpy/OpenCV allocations and attributes the traced peak to
+pipeline stages (decode, resize, annotate, encode).
+Pillow's pixel buffers are allocated outside tracemalloc; for the PIL stages the
+peak-RSS growth is the figure to read.
+
+Overlapping requests share one process, so under concurrency a request's or
+stage's numbers include whatever ran alongside it. For clean attribution run a
+single processing worker while profiling.
+"""
+
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+logger = logging.getLogger(__name__)
+
+# "off" (default), "rss" or "tracemalloc"
+MEMORY_PROFILING = os.environ.get('MEMORY_PROFILING', 'off').lower()
+if MEMORY_PROFILING not in ("off", "rss", "tracemalloc"):
+    MEMORY_PROFILING = "off"
+MEMORY_TRACEMALLOC_FRAMES = int(os.environ.get('MEMORY_TRACEMALLOC_FRAMES', '1'))
+# Log the top allocators when one request or stage grows memory by more than this (0 disables)
+MEMORY_DUMP_THRESHOLD_MB = float(os.environ.get('MEMORY_DUMP_THRESHOLD_MB', '256'))
+MEMORY_DUMP_TOP = int(os.environ.get('MEMORY_DUMP_TOP', '15'))
+MEMORY_DUMP_INTERVAL_SECONDS = float(os.environ.get('MEMORY_DUMP_INTERVAL_SECONDS', '60'))
+# How often current RSS is sampled while a request or stage is being measured
+MEMORY_SAMPLE_INTERVAL_SECONDS = float(os.environ.get('MEMORY_SAMPLE_INTERVAL_SECONDS', '0.005'))
+
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048))
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# ru_maxrss is kilobytes on Linux and bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# observe(name, value, **labels); set by the API so pool-free code can report into its metrics
+_observer: Optional[Callable[..., None]] = None
+_dump_lock = threading.Lock()
+_last_dump = 0.0
+
+if MEMORY_PROFILING == "tracemalloc" and not tracemalloc.is_tracing():
+    tracemalloc.start(MEMORY_TRACEMALLOC_FRAMES)
+
+
+def set_memory_observer(observe: Optional[Callable[..., None]]) -> None:
+    global _observer
+    _observer = observe
+
+
+def peak_rss_bytes() -> int:
+    """Process high-water mark of resident memory"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return peak_rss_bytes()
+
+
+class RssWindow:
+    __slots__ = ("start", "peak")
+
+    def __init__(self, rss: int):
+        self.start = rss
+        self.peak = rss
+
+
+class RssSampler:
+    """Samples current RSS on a background thread while any window is open, raising each open window's peak"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._windows: set[RssWindow] = set()
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def open(self) -> RssWindow:
+        window = RssWindow(current_rss_bytes())
+        with self._lock:
+            self._windows.add(window)
+            self._active.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+        return window
+
+    def close(self, window: RssWindow) -> int:
+        """Highest RSS seen during the window above its start, including a final sample"""
+        rss = current_rss_bytes()
+        with self._lock:
+            self._windows.discard(window)
+            if not self._windows:
+                self._active.clear()
+        return max(window.peak, rss) - window.start
+
+    def _run(self) -> None:
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            rss = current_rss_bytes()
+            with self._lock:
+                for window in self._windows:
+                    if rss > window.peak:
+                        window.peak = rss
+
+
+RSS_SAMPLER = RssSampler(MEMORY_SAMPLE_INTERVAL_SECONDS)
+
+
+def dump_top_allocators(reason: str) -> bool:
+    """Log the largest live allocation sites, at most once per MEMORY_DUMP_INTERVAL_SECONDS"""
+    global _last_dump
+    with _dump_lock:
+        now = time.monotonic()
+        if now - _last_dump < MEMORY_DUMP_INTERVAL_SECONDS:
+            return False
+        _last_dump = now
+    lines = [f"Memory threshold crossed by {reason}: rss {current_rss_bytes() / 1e6:.0f} MB, peak {peak_rss_bytes() / 1e6:.0f} MB"]
+    if tracemalloc.is_tracing():
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:MEMORY_DUMP_TOP]:
+            lines.append(f"  {stat.size / 1e6:8.1f} MB in {stat.count:6d} blocks  {stat.traceback}")
+    logger.warning("\n".join(lines))
+    return True
+
+
+def check_threshold(nbytes: int, reason: str) -> None:
+    if MEMORY_DUMP_THRESHOLD_MB and nbytes > MEMORY_DUMP_THRESHOLD_MB * 1024 * 1024:
+        dump_top_allocators(reason)
+
+
+@contextmanager
+def memory_stage(stage: str):
+    """Attribute the traced peak and peak-RSS growth inside the block to a pipeline stage"""
+    if MEMORY_PROFILING != "tracemalloc" or _observer is None:
+        yield
+        return
+    window = RSS_SAMPLER.open()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        traced_peak = max(0, tracemalloc.get_traced_memory()[1] - traced_before)
+        _observer("memory_stage_traced_peak_bytes", traced_peak, stage=stage)
+        _observer("memory_stage_rss_peak_growth_bytes", RSS_SAMPLER.close(window), stage=stage)
+        check_threshold(traced_peak, f"stage {stage}")
+
+
+class MemoryProfilingMiddleware:
+    """ASGI middleware recording, per endpoint, how far RSS rose above its starting level during each request"""
+
+    def __init__(self, app, observe: Callable[..., None]):
+        self.app = app
+        self.observe = observe
+
+    async def __call__(self, scope, receive, send):
+        if MEMORY_PROFILING == "off" or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        window = RSS_SAMPLER.open()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            endpoint = getattr(scope.get("route"), "path", "unmatched")
+            growth = RSS_SAMPLER.close(window)
+            self.observe("request_rss_peak_growth_bytes", growth, endpoint=endpoint)
+            check_threshold(growth, f"{scope['method']} {endpoint}")
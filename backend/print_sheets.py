@@ -0,0 +1,104 @@
+"""
+Printable photo sheets: tiles already-processed passport photos onto a 4x6 in
+page at 300 DPI, with optional cut guides.
+
+Only numpy and OpenCV are needed here, so composition can run in the
+processing executor, including process pools.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+import cv2
+import numpy as np
+from fastapi import HTTPException
+
+from imaging import PHOTO_DPI, set_jpeg_dpi
+
+SHEET_WIDTH_IN = 4
+SHEET_HEIGHT_IN = 6
+CUT_GUIDE_COLOR = (160, 160, 160)
+
+
+@dataclass(frozen=True)
+class SheetLayout:
+    orientation: str = "portrait"  # "portrait" (4x6) or "landscape" (6x4)
+    margin: int = 0  # page margin in pixels
+    gutter: int = 0  # space between photos in pixels
+    cut_guides: bool = True
+    dpi: int = PHOTO_DPI
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """(width, height) of the page in pixels"""
+        width, height = SHEET_WIDTH_IN * self.dpi, SHEET_HEIGHT_IN * self.dpi
+        return (height, width) if self.orientation == "landscape" else (width, height)
+
+    def grid(self, cell_width: int, cell_height: int) -> tuple[int, int]:
+        """(columns, rows) of cells that fit inside the margins"""
+        width, height = self.size
+        columns = max(0, (width - 2 * self.margin + self.gutter) // (cell_width + self.gutter))
+        rows = max(0, (height - 2 * self.margin + self.gutter) // (cell_height + self.gutter))
+        return columns, rows
+
+
+def sheet_copies(photo_count: int, capacity: int, copies: Optional[int]) -> list[int]:
+    """Copies of each photo: as requested, or an even share of the sheet when not given"""
+    if capacity == 0:
+        raise HTTPException(status_code=400, detail="Photos do not fit on the sheet with these margins.")
+    if copies is None:
+        copies = capacity // photo_count
+    if copies < 1 or copies * photo_count > capacity:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{photo_count} photo(s) x {copies} copies do not fit; this layout holds {capacity}."
+        )
+    return [copies] * photo_count
+
+
+def compose_print_sheet(photos: list[bytes], layout: SheetLayout, copies: Optional[int] = None) -> tuple[bytes, int]:
+    """Tile processed photos onto one sheet; returns the JPEG and the number of copies placed"""
+    decoded = [cv2.imdecode(np.frombuffer(photo, dtype=np.uint8), cv2.IMREAD_COLOR) for photo in photos]
+    if any(img is None for img in decoded):
+        raise HTTPException(status_code=422, detail="A stored photo could not be decoded.")
+
+    # Every cell is sized for the largest photo, so mixed specs share one grid
+    cell_height = max(img.shape[0] for img in decoded)
+    cell_width = max(img.shape[1] for img in decoded)
+    columns, rows = layout.grid(cell_width, cell_height)
+    counts = sheet_copies(len(decoded), columns * rows, copies)
+
+    # One padded tile per distinct photo plus a blank one for empty cells
+    pitch_x, pitch_y = cell_width + layout.gutter, cell_height + layout.gutter
+    tiles = np.full((len(decoded) + 1, pitch_y, pitch_x, 3), 255, dtype=np.uint8)
+    for index, img in enumerate(decoded):
+        offset_y = (cell_height - img.shape[0]) // 2
+        offset_x = (cell_width - img.shape[1]) // 2
+        tiles[index, offset_y:offset_y + img.shape[0], offset_x:offset_x + img.shape[1]] = img
+
+    # Gather tiles in reading order and paste the whole grid with a single assignment
+    order = np.repeat(np.arange(len(decoded)), counts)
+    order = np.concatenate([order, np.full(columns * rows - len(order), len(decoded))])
+    grid = tiles[order].reshape(rows, columns, pitch_y, pitch_x, 3).transpose(0, 2, 1, 3, 4)
+    grid = grid.reshape(rows * pitch_y, columns * pitch_x, 3)
+
+    # Centre the grid on the page; the trailing gutter is not part of it
+    width, height = layout.size
+    grid_width, grid_height = columns * pitch_x - layout.gutter, rows * pitch_y - layout.gutter
+    left, top = (width - grid_width) // 2, (height - grid_height) // 2
+    sheet = np.full((height, width, 3), 255, dtype=np.uint8)
+    sheet[top:top + grid_height, left:left + grid_width] = grid[:grid_height, :grid_width]
+
+    if layout.cut_guides:
+        # Full-length lines along every cell edge, drawn as two fancy-indexed writes
+        xs = left + np.arange(columns) * pitch_x
+        ys = top + np.arange(rows) * pitch_y
+        xs = np.clip(np.concatenate([xs, xs + cell_width - 1]), 0, width - 1)
+        ys = np.clip(np.concatenate([ys, ys + cell_height - 1]), 0, height - 1)
+        sheet[:, xs] = CUT_GUIDE_COLOR
+        sheet[ys, :] = CUT_GUIDE_COLOR
+
+    ok, encoded = cv2.imencode('.jpg', sheet, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        raise HTTPException(status_code=500, detail="Print sheet encoding failed.")
+    return set_jpeg_dpi(encoded.tobytes(), layout.dpi), int(sum(counts))
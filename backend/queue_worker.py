@@ -0,0 +1,145 @@
+"""
+Job loop of the standalone processing worker (started by worker.py).
+
+Claims jobs from the MongoDB `processing_queue` collection, runs the same
+passport pipeline as the API, uploads the result and records it back on the
+job, keeping the lease alive while a job runs.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import uuid
+
+from fastapi import HTTPException
+
+from server import (
+    DEFAULT_PHOTO_SPEC,
+    GOOGLE_DRIVE_SERVICE,
+    LOG_LISTENER,
+    QUEUE_LEASE_SECONDS,
+    QUEUE_POLL_SECONDS,
+    ImageHeader,
+    claim_processing_job,
+    client,
+    complete_processing_job,
+    ensure_queue_indexes,
+    fail_processing_job,
+    heartbeat_processing_job,
+    load_photo_hash_index,
+    process_and_store_photo,
+    record_processing_job_stage,
+)
+from structured_logging import bind_request, reset_request
+
+logger = logging.getLogger("worker")
+
+
+async def keep_lease(job_id: str, worker_id: str) -> None:
+    """Heartbeat every third of the lease so a live job is never reclaimed"""
+    while True:
+        await asyncio.sleep(QUEUE_LEASE_SECONDS / 3)
+        try:
+            if not await heartbeat_processing_job(job_id, worker_id):
+                logger.warning(f"Lost lease on job {job_id}; another worker has reclaimed it")
+                return
+        except Exception as e:
+            logger.error(f"Heartbeat failed for job {job_id}: {str(e)}")
+
+
+async def run_job(job: dict, worker_id: str) -> None:
+    job_id = job["_id"]
+    logger.info(f"Processing job {job_id} (attempt {job['attempts']})")
+
+    # Stage writes are chained so they land in order without blocking the pipeline
+    last_write = None
+
+    async def write_stage(previous, stage: str) -> None:
+        if previous is not None:
+            await previous
+        try:
+            await record_processing_job_stage(job_id, worker_id, stage)
+        except Exception as e:
+            logger.error(f"Failed to record stage {stage} for job {job_id}: {str(e)}")
+
+    def report(stage: str) -> None:
+        nonlocal last_write
+        last_write = asyncio.create_task(write_stage(last_write, stage))
+
+    async def flush_stages() -> None:
+        if last_write is not None:
+            await last_write
+
+    heartbeat = asyncio.create_task(keep_lease(job_id, worker_id))
+    try:
+        try:
+            response = await process_and_store_photo(
+                job["image"],
+                job["name"],
+                ImageHeader(**job["header"]),
+                job["original_filename"],
+                tuple(job["face_hint"]) if job.get("face_hint") else None,
+                progress=report,
+                specs=tuple(job.get("specs") or (DEFAULT_PHOTO_SPEC,))
+            )
+        finally:
+            await flush_stages()
+        await complete_processing_job(job_id, worker_id, response)
+        logger.info(f"Job {job_id} succeeded: {response.filename}")
+    except HTTPException as e:
+        # Client errors (no face, bad image) will fail the same way on every attempt
+        retryable = e.status_code >= 500
+        await fail_processing_job(job, worker_id, str(e.detail), e.status_code, retryable)
+        logger.warning(f"Job {job_id} failed: {e.detail}")
+    except Exception as e:
+        await fail_processing_job(job, worker_id, f"Processing failed: {str(e)}", 500, True)
+        logger.error(f"Job {job_id} errored: {str(e)}")
+    finally:
+        heartbeat.cancel()
+
+
+async def worker_slot(worker_id: str, stop: asyncio.Event) -> None:
+    """Claim and run jobs one at a time until asked to stop"""
+    while not stop.is_set():
+        try:
+            job = await claim_processing_job(worker_id)
+        except Exception as e:
+            logger.error(f"Failed to claim job: {str(e)}")
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=QUEUE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        # Log lines of one job carry its id, like an API request's
+        tokens = bind_request(job["_id"])
+        try:
+            await run_job(job, worker_id)
+        finally:
+            reset_request(tokens)
+
+
+async def run_worker(concurrency: int) -> None:
+    """Run concurrency job slots until SIGINT or SIGTERM, then close the database and log writer"""
+    if not GOOGLE_DRIVE_SERVICE:
+        logger.error("Google Drive service not configured; jobs will fail until credentials are set up")
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    await ensure_queue_indexes()
+    # Duplicate reuse checks run here in queue mode, so the worker needs its own copy of the index
+    await load_photo_hash_index()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    logger.info(f"Worker {worker_id} started with {concurrency} slot(s)")
+    # In-flight jobs finish before exit; unfinished ones are reclaimed once their lease expires
+    await asyncio.gather(*(worker_slot(worker_id, stop) for _ in range(concurrency)))
+    client.close()
+    logger.info(f"Worker {worker_id} stopped")
+    LOG_LISTENER.stop()
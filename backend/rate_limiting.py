@@ -0,0 +1,247 @@
+"""
+Per-client token-bucket rate limiting in front of the API.
+
+A client is its IP address, taken from X-Forwarded-For only when the request
+came through a trusted proxy. An API key gets its own budget only when it is on
+the configured allowlist; any other key is ignored, so inventing keys does not
+buy fresh buckets.
+
+Processing, listing and downloads draw from separate buckets, and a request
+costs one token plus one per started megabyte of body, so a 10 MB upload weighs
+more than a small one. Buckets live in this process by default; the MongoDB
+backend shares them between API nodes, at one round trip per limited request.
+"""
+
+import hashlib
+import ipaddress
+import logging
+import math
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi.responses import JSONResponse
+from pymongo import ReturnDocument
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+logger = logging.getLogger(__name__)
+
+# "off" (default), "memory" (per API process) or "mongodb" (shared by every API node)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'off').lower()
+if RATE_LIMIT_BACKEND not in ("off", "memory", "mongodb"):
+    RATE_LIMIT_BACKEND = "off"
+# Tokens per minute for each bucket, which is also its burst size (0 leaves the bucket unlimited)
+RATE_LIMITS = {
+    "processing": int(os.environ.get('RATE_LIMIT_PROCESSING', '60')),
+    "listing": int(os.environ.get('RATE_LIMIT_LISTING', '120')),
+    "downloads": int(os.environ.get('RATE_LIMIT_DOWNLOADS', '600')),
+}
+RATE_LIMIT_COST_UNIT_BYTES = int(os.environ.get('RATE_LIMIT_COST_UNIT_BYTES', str(1024 * 1024)))
+RATE_LIMIT_API_KEY_HEADER = os.environ.get('RATE_LIMIT_API_KEY_HEADER', 'X-API-Key').lower().encode('latin-1')
+# Comma-separated API keys that get their own buckets; stored as digests, unknown keys fall back to the IP
+RATE_LIMIT_API_KEYS = {
+    hashlib.sha256(key.strip().encode('latin-1')).hexdigest()
+    for key in os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key.strip()
+}
+# Addresses or CIDR ranges of reverse proxies whose X-Forwarded-For is believed
+RATE_LIMIT_TRUSTED_PROXIES = tuple(
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '').split(',') if proxy.strip()
+)
+# Buckets and rejection counts kept in memory; least recently seen clients are dropped first
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '10000'))
+
+# (method, path, bucket); a path ending in "/" matches as a prefix
+RATE_LIMITED_ROUTES = (
+    ("POST", "/api/process-passport", "processing"),
+    ("POST", "/api/jobs", "processing"),
+    ("POST", "/api/print-sheet", "processing"),
+    ("PATCH", "/api/photos/", "processing"),
+    ("GET", "/api/photos", "listing"),
+    ("GET", "/api/duplicates", "listing"),
+    ("GET", "/api/download/", "downloads"),
+)
+# A body without Content-Length is charged as a maximum-size upload
+UNSIZED_BODY_BYTES = 10 * 1024 * 1024
+
+
+def route_bucket(method: str, path: str) -> Optional[str]:
+    for route_method, route_path, bucket in RATE_LIMITED_ROUTES:
+        if method == route_method and (path == route_path or route_path.endswith("/") and path.startswith(route_path)):
+            return bucket
+    return None
+
+
+def request_cost(method: str, content_length: Optional[bytes]) -> int:
+    """One token plus one per started cost unit of request body"""
+    if content_length is not None and content_length.isdigit():
+        size = int(content_length)
+    else:
+        size = 0 if method in ("GET", "HEAD") else UNSIZED_BODY_BYTES
+    return 1 + math.ceil(size / RATE_LIMIT_COST_UNIT_BYTES)
+
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in RATE_LIMIT_TRUSTED_PROXIES)
+
+
+def client_ip(scope, forwarded_for: Optional[bytes]) -> str:
+    """Peer address, or the nearest untrusted hop of X-Forwarded-For when the peer is a trusted proxy"""
+    client = scope.get("client")
+    address = client[0] if client else "unknown"
+    if forwarded_for and is_trusted_proxy(address):
+        # Walk back from the proxy; hops further left than the first untrusted one are client-supplied
+        for hop in reversed(forwarded_for.decode('latin-1').split(',')):
+            address = hop.strip()
+            if not is_trusted_proxy(address):
+                break
+    return address
+
+
+def client_key(scope, headers: dict) -> str:
+    """Allowlisted API key (as a digest prefix, never the secret), otherwise the client IP"""
+    api_key = headers.get(RATE_LIMIT_API_KEY_HEADER)
+    if api_key:
+        digest = hashlib.sha256(api_key).hexdigest()
+        if digest in RATE_LIMIT_API_KEYS:
+            return "key:" + digest[:16]
+    return "ip:" + client_ip(scope, headers.get(b"x-forwarded-for"))
+
+
+class RateLimiter(ABC):
+    """Common bookkeeping: bucket sizes and the per-client rejection counts"""
+
+    def __init__(self, limits: dict[str, int], max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        self.limits = {bucket: per_minute for bucket, per_minute in limits.items() if per_minute > 0}
+        self.max_clients = max_clients
+        self.rejections: OrderedDict[tuple[str, str], int] = OrderedDict()
+
+    def record_rejection(self, client: str, bucket: str) -> None:
+        key = (client, bucket)
+        self.rejections[key] = self.rejections.pop(key, 0) + 1
+        while len(self.rejections) > self.max_clients:
+            self.rejections.popitem(last=False)
+
+    def top_rejections(self, limit: int = 50) -> list[dict]:
+        ranked = sorted(self.rejections.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [{"client": client, "bucket": bucket, "rejections": count} for (client, bucket), count in ranked]
+
+    @abstractmethod
+    async def acquire(self, bucket: str, client: str, cost: int) -> float:
+        """Take cost tokens; returns 0 when admitted, otherwise seconds until they would be available"""
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Token buckets held by this process"""
+
+    def __init__(self, limits: dict[str, int], max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        super().__init__(limits, max_clients)
+        # (bucket, client) -> (tokens, refilled at); a dropped bucket simply comes back full
+        self._buckets: OrderedDict[tuple[str, str], tuple[float, float]] = OrderedDict()
+
+    async def acquire(self, bucket: str, client: str, cost: int) -> float:
+        capacity = self.limits[bucket]
+        rate = capacity / 60
+        cost = min(cost, capacity)
+        now = time.monotonic()
+        key = (bucket, client)
+        tokens, refilled_at = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - refilled_at) * rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class MongoRateLimiter(RateLimiter):
+    """
+    Token buckets in a MongoDB collection, refilled and drawn in one atomic
+    pipeline update so concurrent requests on any node see a consistent count.
+    A TTL index drops a bucket once it would have refilled completely.
+    """
+
+    def __init__(self, collection, limits: dict[str, int], max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        super().__init__(limits, max_clients)
+        self.collection = collection
+
+    async def ensure_indexes(self) -> None:
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def acquire(self, bucket: str, client: str, cost: int) -> float:
+        capacity = self.limits[bucket]
+        rate = capacity / 60
+        cost = min(cost, capacity)
+        now = time.time()
+        # Wall clock, since every node refills the same document; clock skew only shifts refill slightly
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$refilled_at", now]}]}]}
+        doc = await self.collection.find_one_and_update(
+            {"_id": f"{bucket}:{client}"},
+            [
+                {"$set": {"tokens": {"$min": [
+                    capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}]}
+                ]}}},
+                {"$set": {"admitted": {"$gte": ["$tokens", cost]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$admitted", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                    "refilled_at": now,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=60)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return 0.0 if doc["admitted"] else (cost - doc["tokens"]) / rate
+
+
+class RateLimitMiddleware:
+    """ASGI middleware answering over-limit requests with 429 and Retry-After before they reach a route"""
+
+    def __init__(self, app, limiter: RateLimiter, count: Callable[..., None]):
+        self.app = app
+        self.limiter = limiter
+        self.count = count
+
+    async def __call__(self, scope, receive, send):
+        bucket = route_bucket(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if bucket not in self.limiter.limits:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        client = client_key(scope, headers)
+        cost = request_cost(scope["method"], headers.get(b"content-length"))
+        try:
+            wait = await self.limiter.acquire(bucket, client, cost)
+        except Exception as e:
+            # Fail open: a shared-backend outage must not take the API down with it
+            logger.error(f"Rate limiter unavailable, admitting request: {str(e)}")
+            self.count("rate_limit_backend_errors_total")
+            wait = 0.0
+        if not wait:
+            await self.app(scope, receive, send)
+            return
+
+        self.limiter.record_rejection(client, bucket)
+        self.count("rate_limit_rejections_total", bucket=bucket)
+        retry_after = max(1, math.ceil(wait))
+        response = JSONResponse(
+            {"detail": f"Rate limit exceeded for {bucket}. Retry in {retry_after}s."},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)}
+        )
+        await response(scope, receive, send)
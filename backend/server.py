@@ -1,36 +1,95 @@
 from fastapi import FastAPI, APIRouter, UploadFile, File, Form, HTTPException, Header
-from fastapi.responses import FileResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, PrivateAttr
+from typing import Awaitable, Callable, List, Literal, Optional
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import io
-import cv2
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont
 from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials as OAuthCredentials
 from google.auth.transport.requests import Request as GoogleAuthRequest
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 import re
+import math
 import time
+import json
+import hashlib
+import shutil
+import threading
+import asyncio
+import contextvars
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import combinations
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+
+from imaging import (
+    DEFAULT_PHOTO_SPEC,
+    PHOTO_SPECS,
+    PREVIEW_FORMATS,
+    PREVIEW_MEDIA_TYPES,
+    RENDER_ENGINE,
+    ComplianceReport,
+    ImageHeader,
+    PipelineResult,
+    encode_jpeg_previews,
+    inspect_image_header,
+    name_error,
+    no_progress,
+    parse_face_hint,
+    parse_photo_specs,
+    rerender_name,
+    run_passport_pipeline,
+    sanitize_filename,
+)
+from downloads import DOWNLOAD_SIGNING_KEY, deliver_file, signed_download_url, verify_download_signature
+from memory_profiling import (
+    MEMORY_BUCKETS,
+    MEMORY_PROFILING,
+    MemoryProfilingMiddleware,
+    current_rss_bytes,
+    peak_rss_bytes,
+    set_memory_observer,
+)
+from print_sheets import SheetLayout, compose_print_sheet
+from rate_limiting import (
+    RATE_LIMIT_BACKEND,
+    RATE_LIMITS,
+    MemoryRateLimiter,
+    MongoRateLimiter,
+    RateLimitMiddleware,
+)
+from structured_logging import (
+    RequestContextMiddleware,
+    configure_logging,
+    init_pool_worker,
+    request_context,
+    run_in_request_context,
+)
+from shared_buffers import SharedBufferPool, read_result_buffers, render_from_shared_memory
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# Configure logging FIRST
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging FIRST: JSON lines written by a background thread, see structured_logging.py
+LOG_LISTENER = configure_logging()
 logger = logging.getLogger(__name__)
 
 # MongoDB connection
@@ -44,9 +103,9 @@ OAUTH_CREDENTIALS_PATH = ROOT_DIR / 'oauth-credentials.json'
 
 # Initialize Google Drive service with OAuth credentials
 GOOGLE_DRIVE_SERVICE = None
+GOOGLE_DRIVE_CREDENTIALS = None
 if OAUTH_CREDENTIALS_PATH.exists():
     try:
-        import json
         from google.oauth2.credentials import Credentials
         from google.auth.transport.requests import Request
         
@@ -68,6 +127,7 @@ if OAUTH_CREDENTIALS_PATH.exists():
             credentials.refresh(Request())
         
         GOOGLE_DRIVE_SERVICE = build('drive', 'v3', credentials=credentials)
+        GOOGLE_DRIVE_CREDENTIALS = credentials
         logger.info("✓ Google Drive OAuth initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize Google Drive OAuth: {str(e)}")
@@ -79,6 +139,75 @@ else:
 UPLOADS_DIR = ROOT_DIR / 'uploads'
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+# Processing executor and admission control (per worker process)
+PROCESSING_WORKERS = int(os.environ.get('PROCESSING_WORKERS', str(os.cpu_count() or 2)))
+ADMISSION_MEMORY_BUDGET_MB = int(os.environ.get('ADMISSION_MEMORY_BUDGET_MB', '1024'))
+ADMISSION_TIMEOUT_SECONDS = float(os.environ.get('ADMISSION_TIMEOUT_SECONDS', '30'))
+
+# "thread" (default) or "process"; process pools receive image buffers through shared memory
+PROCESSING_EXECUTOR_KIND = os.environ.get('PROCESSING_EXECUTOR', 'thread').lower()
+# Room for every spec's JPEG, base PNG and previews; whatever does not fit is pickled back instead
+SHM_OUTPUT_BYTES = int(os.environ.get('SHM_OUTPUT_BYTES', str(4 << 20)))
+SHM_POOL_MAX_IDLE = int(os.environ.get('SHM_POOL_MAX_IDLE', '8'))
+SHM_LEAK_SECONDS = float(os.environ.get('SHM_LEAK_SECONDS', '300'))
+
+# Health snapshot refreshed in the background; /api/readyz returns 503 to shed traffic when overloaded
+HEALTH_REFRESH_SECONDS = float(os.environ.get('HEALTH_REFRESH_SECONDS', '5'))
+HEALTH_MONGO_TIMEOUT_SECONDS = float(os.environ.get('HEALTH_MONGO_TIMEOUT_SECONDS', '2'))
+READINESS_MAX_ADMISSION_QUEUE = int(os.environ.get('READINESS_MAX_ADMISSION_QUEUE', str(PROCESSING_WORKERS * 4)))
+READINESS_MAX_EXECUTOR_BACKLOG = int(os.environ.get('READINESS_MAX_EXECUTOR_BACKLOG', str(PROCESSING_WORKERS * 2)))
+READINESS_MIN_FREE_DISK_MB = int(os.environ.get('READINESS_MIN_FREE_DISK_MB', '512'))
+
+# Idempotency-Key handling for /api/process-passport
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '120'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '60'))
+
+# Asynchronous processing jobs kept in memory
+JOB_STORE_MAX_JOBS = int(os.environ.get('JOB_STORE_MAX_JOBS', '1000'))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', '3600'))
+JOB_SSE_HEARTBEAT_SECONDS = float(os.environ.get('JOB_SSE_HEARTBEAT_SECONDS', '15'))
+
+# Where processing runs: "inline" in this process, or "queue" to hand work to worker.py via MongoDB
+PROCESSING_BACKEND = os.environ.get('PROCESSING_BACKEND', 'inline').lower()
+QUEUE_LEASE_SECONDS = int(os.environ.get('QUEUE_LEASE_SECONDS', '60'))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get('QUEUE_MAX_ATTEMPTS', '3'))
+QUEUE_POLL_SECONDS = float(os.environ.get('QUEUE_POLL_SECONDS', '0.5'))
+QUEUE_RESULT_TIMEOUT_SECONDS = float(os.environ.get('QUEUE_RESULT_TIMEOUT_SECONDS', '120'))
+
+# Printable sheets composed from stored photos, cached in memory by input set and layout
+SHEET_CACHE_MAX_BYTES = int(os.environ.get('SHEET_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+SHEET_MAX_PHOTOS = 12
+
+# Drive-stored photos read by this node (downloads, print sheets, inline replays), cached on local disk.
+# The cache lives under the uploads directory so proxy delivery (X-Accel-Redirect) covers it too.
+DRIVE_CACHE_DIR = UPLOADS_DIR / 'drive_cache'
+DRIVE_CACHE_MAX_BYTES = int(os.environ.get('DRIVE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+DRIVE_DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Near-duplicate detection on perceptual hashes (Hamming distance in bits, out of 64)
+DUPLICATE_HASH_DISTANCE = int(os.environ.get('DUPLICATE_HASH_DISTANCE', '6'))
+DUPLICATE_REUSE = os.environ.get('DUPLICATE_REUSE', 'off').lower() == 'on'
+DUPLICATE_REUSE_DISTANCE = min(int(os.environ.get('DUPLICATE_REUSE_DISTANCE', '2')), DUPLICATE_HASH_DISTANCE)
+# Photos other API nodes and queue workers insert are pulled into this process's index at most this often
+DUPLICATE_INDEX_REFRESH_SECONDS = float(os.environ.get('DUPLICATE_INDEX_REFRESH_SECONDS', '5'))
+
+# Retention of stored photos: "off" (default), "report" (log what would be removed) or "enforce".
+# Rules are storage_mode[:processing_status]=age with d/h/m units and * as a wildcard; the first match
+# wins and photos no rule matches are kept, e.g. "local=30d,*:failed=7d,google_drive:success=365d".
+RETENTION_MODE = os.environ.get('RETENTION_MODE', 'off').lower()
+RETENTION_RULES = os.environ.get('RETENTION_RULES', '')
+RETENTION_SWEEP_INTERVAL_SECONDS = float(os.environ.get('RETENTION_SWEEP_INTERVAL_SECONDS', '3600'))
+RETENTION_SWEEP_BATCH = int(os.environ.get('RETENTION_SWEEP_BATCH', '200'))
+# Drive copies of expired photos go too unless disabled, in batch requests with a pause between them
+RETENTION_DELETE_DRIVE = os.environ.get('RETENTION_DELETE_DRIVE', 'on').lower() == 'on'
+RETENTION_DRIVE_BATCH_SIZE = min(int(os.environ.get('RETENTION_DRIVE_BATCH_SIZE', '20')), 100)
+RETENTION_DRIVE_BATCH_PAUSE_SECONDS = float(os.environ.get('RETENTION_DRIVE_BATCH_PAUSE_SECONDS', '1'))
+# Photo files in the uploads directory with no metadata are orphans once older than this
+RETENTION_ORPHAN_GRACE_SECONDS = int(os.environ.get('RETENTION_ORPHAN_GRACE_SECONDS', str(24 * 3600)))
+# Un-annotated base images expire through a TTL index after this many days (0 keeps them as long as the photo)
+RETENTION_BASE_IMAGE_DAYS = int(os.environ.get('RETENTION_BASE_IMAGE_DAYS', '30'))
+
 # Create the main app without a prefix
 app = FastAPI(title="Passport Photo Generator API")
 
@@ -103,6 +232,21 @@ class PassportPhotoMetadata(BaseModel):
     original_filename: str
     file_size_bytes: int
     processing_status: str = "success"
+    compliance: Optional[ComplianceReport] = None
+    spec: str = DEFAULT_PHOTO_SPEC
+    perceptual_hash: Optional[str] = None  # 64-bit DCT hash of the source face crop, hex
+    format_sizes: Optional[dict[str, int]] = None  # bytes per encoding: the JPEG master plus any previews
+
+class RenditionResponse(BaseModel):
+    spec: str
+    filename: str
+    drive_file_id: Optional[str] = None
+    drive_file_url: Optional[str] = None
+    metadata_id: str
+    image_dimensions: str
+    dpi: int
+    file_size_bytes: int
+    reused: bool = False
 
 class ProcessResponse(BaseModel):
     success: bool
@@ -114,185 +258,119 @@ class ProcessResponse(BaseModel):
     filename: str
     metadata_id: str
     message: str
+    compliance: Optional[ComplianceReport] = None
+    renditions: Optional[list[RenditionResponse]] = None  # one per spec when several were requested
+    reused: bool = False  # an existing near-identical photo was returned instead of a new upload
+    # Rendered JPEGs by filename, held for inline responses only; never serialized or stored
+    _images: dict[str, bytes] = PrivateAttr(default_factory=dict)
+
+def stored_response_fields(response: ProcessResponse) -> dict:
+    """What is persisted of a response; download_url is signed afresh whenever it is handed out again"""
+    return response.model_dump(exclude={"download_url"})
+
+def with_download_url(response: ProcessResponse) -> ProcessResponse:
+    """The response with a download_url signed now, since stored results outlive DOWNLOAD_URL_TTL_SECONDS"""
+    if not DOWNLOAD_SIGNING_KEY:
+        return response
+    return response.model_copy(update={"download_url": signed_download_url(response.filename)})
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str  # "queued", "running", "succeeded" or "failed"
+    stage: str
+    created_at: datetime
+    updated_at: datetime
+    result: Optional[ProcessResponse] = None
+    error: Optional[str] = None
+    status_url: Optional[str] = None
+    events_url: Optional[str] = None
+
+class NameUpdateRequest(BaseModel):
+    name: str
+
+class PrintSheetRequest(BaseModel):
+    filenames: List[str] = Field(min_length=1, max_length=SHEET_MAX_PHOTOS)
+    copies: Optional[int] = Field(None, ge=1)  # per photo; default fills the sheet evenly
+    orientation: Literal["portrait", "landscape"] = "portrait"
+    margin_px: int = Field(0, ge=0, le=300)
+    gutter_px: int = Field(0, ge=0, le=300)
+    cut_guides: bool = True
 
 class ErrorResponse(BaseModel):
     success: bool = False
     error: str
     code: str
 
-# ============= HELPER FUNCTIONS =============
-
-def sanitize_filename(name: str) -> str:
-    """Sanitize name for use in filename"""
-    # Remove special characters, keep only alphanumeric, spaces, hyphens
-    sanitized = re.sub(r'[^a-zA-Z0-9\s-]', '', name)
-    # Replace spaces with underscores
-    sanitized = sanitized.replace(' ', '_').lower()
-    return sanitized
+# ============= METRICS =============
 
-def detect_face_opencv(image_bytes: bytes) -> Optional[tuple]:
-    """Detect face using OpenCV Haar Cascade"""
-    try:
-        # Convert bytes to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            logger.error("Failed to decode image")
-            return None
-        
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Load Haar Cascade for face detection
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        
-        # Detect faces
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-        
-        if len(faces) == 0:
-            logger.warning("No face detected")
-            return None
-        
-        # Get the largest face
-        largest_face = max(faces, key=lambda rect: rect[2] * rect[3])
-        x, y, w, h = largest_face
-        
-        logger.info(f"Face detected at ({x}, {y}) with size {w}x{h}")
-        return (x, y, w, h, img.shape[1], img.shape[0])  # x, y, w, h, img_width, img_height
-        
-    except Exception as e:
-        logger.error(f"Face detection error: {str(e)}")
-        return None
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
-def process_passport_photo(image_bytes: bytes, name: str, face_coords: Optional[tuple] = None) -> tuple[bytes, int]:
-    """Process image to passport photo specifications"""
-    try:
-        # Open image with PIL
-        img = Image.open(io.BytesIO(image_bytes))
-        
-        # Convert to RGB if necessary
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        original_width, original_height = img.size
-        logger.info(f"Original image size: {original_width}x{original_height}")
-        
-        # If no face coordinates provided, try to detect
-        if face_coords is None:
-            face_coords = detect_face_opencv(image_bytes)
-        
-        if face_coords:
-            x, y, w, h, img_width, img_height = face_coords
-            
-            # Calculate crop box with proper headroom and padding
-            # Face should occupy 70-80% of frame height
-            target_face_height = 600 * 0.75  # 450px
-            scale_factor = target_face_height / h
-            
-            # Add 30% headroom above face
-            headroom = int(h * 0.3)
-            # Add 15% padding on sides
-            side_padding = int(w * 0.15)
-            
-            # Calculate crop dimensions (square)
-            crop_size = int(max(w + 2 * side_padding, h + headroom + h * 0.2))
-            
-            # Center the crop around the face
-            center_x = x + w // 2
-            center_y = y + h // 2 - headroom // 2  # Shift up for headroom
-            
-            left = max(0, center_x - crop_size // 2)
-            top = max(0, center_y - crop_size // 2)
-            right = min(img_width, left + crop_size)
-            bottom = min(img_height, top + crop_size)
-            
-            # Adjust if crop goes out of bounds
-            if right - left < crop_size:
-                if left == 0:
-                    right = min(img_width, left + crop_size)
-                else:
-                    left = max(0, right - crop_size)
-            
-            if bottom - top < crop_size:
-                if top == 0:
-                    bottom = min(img_height, top + crop_size)
-                else:
-                    top = max(0, bottom - crop_size)
-            
-            # Crop the image
-            img = img.crop((left, top, right, bottom))
-            logger.info(f"Cropped to: {img.size}")
-        else:
-            # No face detected, use center crop as fallback
-            logger.warning("No face detected, using center crop")
-            min_dim = min(original_width, original_height)
-            left = (original_width - min_dim) // 2
-            top = (original_height - min_dim) // 2
-            right = left + min_dim
-            bottom = top + min_dim
-            img = img.crop((left, top, right, bottom))
-        
-        # Resize to exactly 600x600px with high quality
-        img = img.resize((600, 600), Image.Resampling.LANCZOS)
-        logger.info(f"Resized to: {img.size}")
-        
-        # Add name overlay
-        draw = ImageDraw.Draw(img)
-        
-        # Try to use a system font
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 24)
-        except:
+class MetricsRegistry:
+    """Minimal in-process counters, gauges and histograms served by /api/metrics"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._gauge_callbacks = {}
+        self._histograms = {}
+    
+    @staticmethod
+    def _key(name: str, labels: dict) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+    
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+    
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+    
+    def register_gauge(self, name: str, callback) -> None:
+        """Register a gauge whose value is computed when metrics are read"""
+        self._gauge_callbacks[name] = callback
+    
+    def observe(self, name: str, value: float, buckets: tuple = DEFAULT_BUCKETS, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = {"buckets": buckets, "counts": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+                self._histograms[key] = hist
+            index = next((i for i, bound in enumerate(hist["buckets"]) if value <= bound), len(hist["buckets"]))
+            hist["counts"][index] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            gauges = dict(self._gauges)
+            histograms = {}
+            for key, hist in self._histograms.items():
+                cumulative, running = {}, 0
+                for bound, count in zip(list(hist["buckets"]) + ["+Inf"], hist["counts"]):
+                    running += count
+                    cumulative[str(bound)] = running
+                histograms[key] = {"buckets": cumulative, "sum": hist["sum"], "count": hist["count"]}
+            counters = dict(self._counters)
+        for name, callback in self._gauge_callbacks.items():
             try:
-                font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 24)
-            except:
-                font = ImageFont.load_default()
-        
-        # Get text bounding box
-        bbox = draw.textbbox((0, 0), name, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
-        # Position: bottom center, 40px from bottom
-        text_x = (600 - text_width) // 2
-        text_y = 600 - 40 - text_height
-        
-        # Draw semi-transparent black rectangle background
-        padding = 10
-        rect_coords = [
-            text_x - padding,
-            text_y - padding,
-            text_x + text_width + padding,
-            text_y + text_height + padding
-        ]
-        
-        # Create a new image for the overlay with alpha
-        overlay = Image.new('RGBA', img.size, (255, 255, 255, 0))
-        overlay_draw = ImageDraw.Draw(overlay)
-        overlay_draw.rectangle(rect_coords, fill=(0, 0, 0, 180))
-        
-        # Composite the overlay
-        img_rgba = img.convert('RGBA')
-        img_rgba = Image.alpha_composite(img_rgba, overlay)
-        img = img_rgba.convert('RGB')
-        
-        # Draw text on the final image
-        draw = ImageDraw.Draw(img)
-        draw.text((text_x, text_y), name, fill=(255, 255, 255), font=font)
-        
-        # Save to bytes with high quality
-        output = io.BytesIO()
-        img.save(output, format='JPEG', quality=95, dpi=(300, 300))
-        output_bytes = output.getvalue()
-        file_size = len(output_bytes)
-        
-        logger.info(f"Final image size: {file_size} bytes")
-        return output_bytes, file_size
-        
-    except Exception as e:
-        logger.error(f"Image processing error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
+                gauges[name] = callback()
+            except Exception as e:
+                logger.error(f"Metrics gauge {name} failed: {str(e)}")
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+METRICS = MetricsRegistry()
+observe_memory = partial(METRICS.observe, buckets=MEMORY_BUCKETS)
+# Stage attribution only sees work running in this process (inline or thread executors)
+set_memory_observer(observe_memory)
+METRICS.register_gauge("process_rss_bytes", current_rss_bytes)
+METRICS.register_gauge("process_peak_rss_bytes", peak_rss_bytes)
+
+# ============= HELPER FUNCTIONS =============
 
 def upload_to_google_drive(image_bytes: bytes, filename: str) -> tuple[str, str]:
     """Upload file to Google Drive using service account"""
@@ -334,84 +412,1711 @@ def upload_to_google_drive(image_bytes: bytes, filename: str) -> tuple[str, str]
         logger.error(f"Google Drive upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to upload to Google Drive: {str(e)}")
 
-# ============= API ENDPOINTS =============
+def update_google_drive_file(file_id: str, image_bytes: bytes) -> None:
+    """Replace the content of an existing Drive file, keeping its id and link"""
+    if not GOOGLE_DRIVE_SERVICE:
+        raise HTTPException(status_code=500, detail="Google Drive service not configured.")
+    media = MediaIoBaseUpload(io.BytesIO(image_bytes), mimetype='image/jpeg', resumable=True)
+    GOOGLE_DRIVE_SERVICE.files().update(fileId=file_id, media_body=media).execute()
 
-@api_router.get("/health")
-async def health_check():
-    """Health check endpoint"""
+def delete_google_drive_files(file_ids: list[str]) -> dict[str, Optional[str]]:
+    """Delete Drive files in one batch request; maps each id to its error, or None once it is gone"""
+    if not GOOGLE_DRIVE_SERVICE:
+        raise HTTPException(status_code=500, detail="Google Drive service not configured.")
+    results = {}
+    def record(file_id, response, exception):
+        # A file that is already gone counts as deleted
+        if exception is not None and not (isinstance(exception, HttpError) and exception.resp.status == 404):
+            results[file_id] = str(exception)
+        else:
+            results[file_id] = None
+    batch = GOOGLE_DRIVE_SERVICE.new_batch_http_request(callback=record)
+    for file_id in dict.fromkeys(file_ids):
+        batch.add(GOOGLE_DRIVE_SERVICE.files().delete(fileId=file_id), request_id=file_id)
+    batch.execute()
+    return results
+
+def download_google_drive_file(file_id: str, path: Path) -> None:
+    """Stream a file's content from Google Drive to a local path, one chunk at a time"""
+    if not GOOGLE_DRIVE_SERVICE:
+        raise HTTPException(status_code=500, detail="Google Drive service not configured.")
+    with open(path, 'wb') as f:
+        downloader = MediaIoBaseDownload(
+            f, GOOGLE_DRIVE_SERVICE.files().get_media(fileId=file_id), chunksize=DRIVE_DOWNLOAD_CHUNK_BYTES
+        )
+        done = False
+        while not done:
+            _, done = downloader.next_chunk()
+
+# ============= PROCESSING PIPELINE =============
+
+def create_processing_executor():
+    if PROCESSING_EXECUTOR_KIND == "process":
+        # spawn keeps pool workers free of the API's threads and event loop; they import only imaging
+        return ProcessPoolExecutor(
+            max_workers=PROCESSING_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_pool_worker
+        )
+    return ThreadPoolExecutor(max_workers=PROCESSING_WORKERS, thread_name_prefix="passport")
+
+PROCESSING_EXECUTOR = create_processing_executor()
+_executor_inflight = 0
+SHARED_BUFFERS = SharedBufferPool(SHM_POOL_MAX_IDLE, SHM_LEAK_SECONDS)
+
+async def run_in_processing_executor(fn, *args, **kwargs):
+    """Run CPU-bound work off the event loop, tracking executor queue depth"""
+    global _executor_inflight
+    _executor_inflight += 1
     try:
-        # Check MongoDB connection
-        await db.command('ping')
-        mongo_status = "connected"
-    except Exception as e:
-        logger.error(f"MongoDB health check failed: {str(e)}")
-        mongo_status = "disconnected"
+        loop = asyncio.get_running_loop()
+        call = partial(fn, *args, **kwargs)
+        # Keep the request's logging context (request id, detail sampling) in the worker
+        if PROCESSING_EXECUTOR_KIND == "process":
+            call = partial(run_in_request_context, request_context(), call)
+        else:
+            call = partial(contextvars.copy_context().run, call)
+        return await loop.run_in_executor(PROCESSING_EXECUTOR, call)
+    finally:
+        _executor_inflight -= 1
+
+METRICS.register_gauge("processing_executor_inflight", lambda: _executor_inflight)
+METRICS.register_gauge("processing_executor_queue_depth", lambda: max(0, _executor_inflight - PROCESSING_WORKERS))
+METRICS.register_gauge("shm_segments_in_use", lambda: SHARED_BUFFERS.stats().in_use)
+METRICS.register_gauge("shm_segments_idle", lambda: SHARED_BUFFERS.stats().idle)
+METRICS.register_gauge("shm_mapped_bytes", lambda: SHARED_BUFFERS.stats().mapped_bytes)
+METRICS.register_gauge("shm_segments_created_total", lambda: SHARED_BUFFERS.stats().created_total)
+METRICS.register_gauge("shm_segments_reused_total", lambda: SHARED_BUFFERS.stats().reused_total)
+METRICS.register_gauge("shm_segments_leaked_total", lambda: SHARED_BUFFERS.stats().leaked_total)
+
+async def run_pipeline_in_process_pool(
+    image_bytes: bytes,
+    name: str,
+    header: ImageHeader,
+    face_hint: Optional[tuple],
+    specs: tuple[str, ...]
+) -> PipelineResult:
+    """Hand the upload to a pool worker through shared memory; only descriptors are pickled"""
+    global _executor_inflight
+    input_shm = SHARED_BUFFERS.acquire(len(image_bytes))
+    output_shm = SHARED_BUFFERS.acquire(SHM_OUTPUT_BYTES)
+    input_shm.buf[:len(image_bytes)] = image_bytes
     
+    def release_segments(_=None) -> None:
+        SHARED_BUFFERS.release(input_shm)
+        SHARED_BUFFERS.release(output_shm)
+    
+    global PROCESSING_EXECUTOR
+    executor = PROCESSING_EXECUTOR
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        executor,
+        run_in_request_context,
+        request_context(),
+        render_from_shared_memory,
+        (input_shm.name, len(image_bytes)),
+        (output_shm.name, output_shm.size),
+        name,
+        asdict(header),
+        face_hint,
+        specs
+    )
+    _executor_inflight += 1
+    try:
+        output_layout, result, error = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # The worker may still be writing; segments go back to the pool only once it is done
+        future.add_done_callback(release_segments)
+        raise
+    except BrokenProcessPool:
+        release_segments()
+        # A worker died (e.g. OOM-killed); replace the pool so later requests can run
+        if PROCESSING_EXECUTOR is executor:
+            logger.error("Processing pool broke, starting a new one")
+            METRICS.inc("processing_pool_restarts_total")
+            PROCESSING_EXECUTOR = create_processing_executor()
+            executor.shutdown(wait=False)
+        raise HTTPException(status_code=503, detail="Processing worker crashed. Please try again.")
+    except BaseException:
+        release_segments()
+        raise
+    finally:
+        _executor_inflight -= 1
+    
+    try:
+        if error:
+            raise HTTPException(status_code=error[0], detail=error[1])
+        result = read_result_buffers(result, output_layout, output_shm.buf)
+    finally:
+        release_segments()
+    return result
+
+async def run_pipeline(
+    image_bytes: bytes,
+    name: str,
+    header: ImageHeader,
+    face_hint: Optional[tuple],
+    progress: Callable[[str], None],
+    specs: tuple[str, ...] = (DEFAULT_PHOTO_SPEC,)
+) -> PipelineResult:
+    """Decode, detect and render on the configured processing executor"""
+    if PROCESSING_EXECUTOR_KIND == "process":
+        # Stage callbacks cannot cross the process boundary
+        progress("processing")
+        return await run_pipeline_in_process_pool(image_bytes, name, header, face_hint, specs)
+    return await run_in_processing_executor(run_passport_pipeline, image_bytes, name, header, face_hint, progress, specs)
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key onto one in-flight computation"""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: dict[str, asyncio.Task] = {}
+    
+    def __len__(self) -> int:
+        return len(self._flights)
+    
+    async def do(self, key: str, fn, progress: Callable[[str], None] = no_progress):
+        task = self._flights.get(key)
+        if task is not None:
+            METRICS.inc("singleflight_coalesced_total", flight=self.name)
+            progress("waiting_for_identical_request")
+        else:
+            # Run as its own task so a disconnecting first caller does not cancel the others
+            task = asyncio.ensure_future(fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+            METRICS.inc("singleflight_leaders_total", flight=self.name)
+        return await asyncio.shield(task)
+
+PIPELINE_FLIGHTS = SingleFlight("pipeline")
+METRICS.register_gauge("singleflight_inflight", lambda: len(PIPELINE_FLIGHTS))
+
+def estimate_peak_memory(header: ImageHeader, input_size: int, specs: tuple[str, ...] = (DEFAULT_PHOTO_SPEC,)) -> int:
+    """Estimate peak bytes held while one upload goes through decode, detect and render"""
+    pixels = header.pixels
+    decoded = pixels * 3 * max(1, header.bit_depth // 8)  # cv2 BGR decode (16-bit PNGs decode wide first)
+    gray = pixels  # full-frame grayscale for detection
+    if RENDER_ENGINE == "opencv":
+        # One shared BGR array; the crop is a view
+        peak = decoded + gray
+    else:
+        # PIL decodes again (plus a convert('RGB') copy for non-RGB modes) after the cv2 array is dropped
+        pil_copies = 2 if header.mode != 'RGB' else 1
+        peak = max(decoded + gray, pixels * 3 * pil_copies)
+    # Per spec: RGB, RGBA, overlay and output copies, plus the request body and encode buffer
+    render = sum(PHOTO_SPECS[key].width * PHOTO_SPECS[key].height for key in specs) * (3 + 4 + 4 + 3)
+    return peak + render + input_size * 2
+
+class AdmissionTimeout(Exception):
+    pass
+
+class MemoryAdmissionController:
+    """FIFO admission against a per-worker budget of estimated decoded-pixel memory"""
+    
+    def __init__(self, budget_bytes: int, timeout: float):
+        self.budget_bytes = budget_bytes
+        self.timeout = timeout
+        self.used_bytes = 0
+        self._waiters = deque()  # (bytes, future), served strictly in arrival order
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+    
+    def _grant_waiters(self) -> None:
+        # Head-of-line: a large request at the front is never overtaken by smaller ones
+        while self._waiters:
+            need, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self.used_bytes + need > self.budget_bytes:
+                break
+            self._waiters.popleft()
+            self.used_bytes += need
+            future.set_result(True)
+    
+    async def acquire(self, need: int) -> int:
+        # A request larger than the whole budget may still run, but only on its own
+        need = min(need, self.budget_bytes)
+        start = time.perf_counter()
+        if not self._waiters and self.used_bytes + need <= self.budget_bytes:
+            self.used_bytes += need
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append((need, future))
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if future.done() and not future.cancelled():
+                    # Granted just as we gave up: hand the reservation back
+                    self.release(need)
+                else:
+                    future.cancel()
+                    self._grant_waiters()
+                if isinstance(e, asyncio.TimeoutError):
+                    METRICS.inc("admission_timeouts_total")
+                    raise AdmissionTimeout() from e
+                raise
+        METRICS.observe("admission_wait_seconds", time.perf_counter() - start)
+        METRICS.inc("admission_admitted_total")
+        return need
+    
+    def release(self, reserved: int) -> None:
+        self.used_bytes -= reserved
+        self._grant_waiters()
+    
+    @asynccontextmanager
+    async def reserve(self, need: int):
+        try:
+            reserved = await self.acquire(need)
+        except AdmissionTimeout:
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy processing other photos. Please try again shortly.",
+                headers={"Retry-After": str(max(1, math.ceil(self.timeout)))}
+            )
+        try:
+            yield
+        finally:
+            self.release(reserved)
+
+ADMISSION = MemoryAdmissionController(ADMISSION_MEMORY_BUDGET_MB * 1024 * 1024, ADMISSION_TIMEOUT_SECONDS)
+METRICS.register_gauge("admission_memory_budget_bytes", lambda: ADMISSION.budget_bytes)
+METRICS.register_gauge("admission_memory_used_bytes", lambda: ADMISSION.used_bytes)
+METRICS.register_gauge("admission_queue_depth", lambda: ADMISSION.queue_depth)
+
+# Per-client request budgets, checked by RateLimitMiddleware before a request reaches admission
+if RATE_LIMIT_BACKEND == "mongodb":
+    RATE_LIMITER = MongoRateLimiter(db.rate_limits, RATE_LIMITS)
+else:
+    RATE_LIMITER = MemoryRateLimiter(RATE_LIMITS)
+
+# ============= HEALTH =============
+
+def drive_token_status() -> dict:
+    """Drive OAuth state from the in-memory credentials; no network call"""
+    if not GOOGLE_DRIVE_SERVICE:
+        return {"status": "disabled"}
+    if GOOGLE_DRIVE_CREDENTIALS is None:
+        return {"status": "enabled (OAuth)"}
+    expiry = GOOGLE_DRIVE_CREDENTIALS.expiry  # naive UTC, as google-auth stores it
+    expires_in = (expiry.replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds() if expiry else None
     return {
-        "status": "healthy",
-        "mongodb": mongo_status,
-        "google_drive": "enabled (OAuth)" if GOOGLE_DRIVE_SERVICE else "disabled"
+        "status": "enabled (OAuth)",
+        "token_valid": GOOGLE_DRIVE_CREDENTIALS.valid,
+        "token_expires_in_seconds": round(expires_in) if expires_in is not None else None,
+        # The client refreshes an expired token on its next call when it holds a refresh token
+        "refreshable": bool(GOOGLE_DRIVE_CREDENTIALS.refresh_token)
     }
 
-@api_router.post("/process-passport")
-async def process_passport(
-    file: UploadFile = File(...),
-    name: str = Form(...)
-):
-    """Process uploaded image and upload to Google Drive"""
+def processing_load() -> dict:
+    return {
+        "admission_queue_depth": ADMISSION.queue_depth,
+        "executor_backlog": max(0, _executor_inflight - PROCESSING_WORKERS),
+        "executor_inflight": _executor_inflight
+    }
+
+class HealthMonitor:
+    """
+    Dependency health refreshed on an interval by one background task, so probes
+    read a snapshot instead of each pinging MongoDB. Load is read live, because it
+    is in memory anyway and readiness must react to overload immediately.
+    """
+    
+    def __init__(self, interval: float, mongo_timeout: float):
+        self.interval = interval
+        self.mongo_timeout = mongo_timeout
+        self.snapshot: dict = {}
+        self._refreshed_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def refresh(self) -> None:
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(db.command('ping'), timeout=self.mongo_timeout)
+            mongodb = {"status": "connected", "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+            METRICS.observe("health_mongo_ping_seconds", time.perf_counter() - start)
+        except Exception as e:
+            logger.error(f"MongoDB health check failed: {str(e) or type(e).__name__}")
+            mongodb = {"status": "disconnected", "latency_ms": None, "error": str(e) or type(e).__name__}
+        usage = await asyncio.to_thread(shutil.disk_usage, UPLOADS_DIR)
+        self.snapshot = {
+            "checked_at": datetime.now(timezone.utc).isoformat(),
+            "mongodb": mongodb,
+            "google_drive": drive_token_status(),
+            "disk": {"free_bytes": usage.free, "total_bytes": usage.total}
+        }
+        self._refreshed_at = time.monotonic()
+    
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Health refresh failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+    
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+    
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    @property
+    def age(self) -> Optional[float]:
+        return None if self._refreshed_at is None else time.monotonic() - self._refreshed_at
+    
+    def not_ready_reasons(self) -> list[str]:
+        """Empty when this worker should receive traffic"""
+        reasons = []
+        age = self.age
+        if age is None:
+            reasons.append("health not checked yet")
+        elif age > 3 * self.interval + self.mongo_timeout:
+            reasons.append(f"health snapshot is {age:.0f}s old")
+        elif self.snapshot["mongodb"]["status"] != "connected":
+            reasons.append("mongodb unreachable")
+        if self.snapshot and self.snapshot["disk"]["free_bytes"] < READINESS_MIN_FREE_DISK_MB * 1024 * 1024:
+            reasons.append("low disk space in uploads directory")
+        load = processing_load()
+        if load["admission_queue_depth"] > READINESS_MAX_ADMISSION_QUEUE:
+            reasons.append(f"{load['admission_queue_depth']} uploads waiting for memory")
+        if load["executor_backlog"] > READINESS_MAX_EXECUTOR_BACKLOG:
+            reasons.append(f"{load['executor_backlog']} tasks queued for the processing executor")
+        return reasons
+
+HEALTH = HealthMonitor(HEALTH_REFRESH_SECONDS, HEALTH_MONGO_TIMEOUT_SECONDS)
+METRICS.register_gauge("ready", lambda: 0 if HEALTH.not_ready_reasons() else 1)
+
+# ============= IDEMPOTENCY =============
+
+_idempotency_events: dict[str, asyncio.Event] = {}
+
+def request_fingerprint(image_bytes: bytes, name: str, specs: tuple[str, ...] = (DEFAULT_PHOTO_SPEC,)) -> str:
+    """Stable hash of a processing request's inputs"""
+    digest = hashlib.sha256(image_bytes)
+    digest.update(b"\0" + name.encode('utf-8'))
+    # Default-spec requests keep the fingerprint they had before specs existed
+    if specs != (DEFAULT_PHOTO_SPEC,):
+        digest.update(b"\0" + ",".join(specs).encode('utf-8'))
+    return digest.hexdigest()
+
+async def ensure_idempotency_indexes() -> None:
+    await db.idempotency_keys.create_index("key", unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+
+async def _claim_idempotency_key(key: str, fingerprint: str) -> Optional[str]:
+    """Atomically claim a key, or take over a claim whose owner died mid-request; returns the owner token"""
+    now = datetime.now(timezone.utc)
+    locked_until = now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+    owner = uuid.uuid4().hex
     try:
-        # Check if Google Drive is configured
-        if not GOOGLE_DRIVE_SERVICE:
+        await db.idempotency_keys.insert_one({
+            "key": key,
+            "fingerprint": fingerprint,
+            "status": "in_progress",
+            "owner": owner,
+            "created_at": now,
+            "locked_until": locked_until
+        })
+        return owner
+    except DuplicateKeyError:
+        pass
+    taken = await db.idempotency_keys.find_one_and_update(
+        {"key": key, "fingerprint": fingerprint, "status": "in_progress", "locked_until": {"$lt": now}},
+        {"$set": {"owner": owner, "locked_until": locked_until}}
+    )
+    return owner if taken is not None else None
+
+async def _keep_idempotency_lock(key: str, owner: str) -> None:
+    """Extend the claim every third of the lock so a slow but live request is never taken over"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_LOCK_SECONDS / 3)
+        try:
+            result = await db.idempotency_keys.update_one(
+                {"key": key, "owner": owner, "status": "in_progress"},
+                {"$set": {"locked_until": datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}}
+            )
+            if result.matched_count == 0:
+                logger.warning(f"Lost the claim on Idempotency-Key {key}")
+                return
+        except Exception as e:
+            logger.error(f"Failed to extend the claim on Idempotency-Key {key}: {str(e)}")
+
+async def _wait_for_idempotency_key(key: str, timeout: float) -> None:
+    # Same-process duplicates wake as soon as the owner finishes; others poll Mongo
+    event = _idempotency_events.get(key)
+    if event is None:
+        await asyncio.sleep(timeout)
+        return
+    try:
+        await asyncio.wait_for(event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+
+async def run_idempotent(key: str, fingerprint: str, execute) -> ProcessResponse:
+    """Run execute() once per Idempotency-Key; duplicates wait for or replay its ProcessResponse"""
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        owner = await _claim_idempotency_key(key, fingerprint)
+        if owner:
+            break
+        existing = await db.idempotency_keys.find_one({"key": key}, {"_id": 0})
+        if existing is None:
+            # The first attempt failed and released the key; try to claim it ourselves
+            continue
+        if existing["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+        if existing["status"] == "completed":
+            METRICS.inc("idempotency_replays_total")
+            logger.info(f"Replaying stored response for Idempotency-Key {key}")
+            return with_download_url(ProcessResponse(**existing["response"]))
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still being processed.")
+        METRICS.inc("idempotency_waits_total")
+        await _wait_for_idempotency_key(key, min(0.5, remaining))
+    
+    event = _idempotency_events.setdefault(key, asyncio.Event())
+    heartbeat = asyncio.create_task(_keep_idempotency_lock(key, owner))
+    try:
+        response = await execute()
+        result = await db.idempotency_keys.update_one(
+            {"key": key, "owner": owner},
+            {"$set": {
+                "status": "completed",
+                "response": stored_response_fields(response),
+                "completed_at": datetime.now(timezone.utc)
+            }}
+        )
+        if result.matched_count == 0:
+            # Our lock lapsed and another request took the key over; its result is the one recorded
+            METRICS.inc("idempotency_lost_claims_total")
+            logger.warning(f"Lost the claim on Idempotency-Key {key}; not recording this response")
+        return response
+    except BaseException:
+        # Release the key so a retry can run the pipeline again
+        try:
+            await db.idempotency_keys.delete_one({"key": key, "owner": owner, "status": "in_progress"})
+        except Exception as e:
+            logger.error(f"Failed to release Idempotency-Key {key}: {str(e)}")
+        raise
+    finally:
+        heartbeat.cancel()
+        event.set()
+        _idempotency_events.pop(key, None)
+
+# ============= BACKGROUND JOBS =============
+
+JOB_TERMINAL_STATUSES = ("succeeded", "failed")
+
+class ProcessingJob:
+    """In-memory state of one asynchronous processing job"""
+    
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+        self.status = "queued"
+        self.stage = "queued"
+        self.created_at = datetime.now(timezone.utc)
+        self.updated_at = self.created_at
+        self.result: Optional[ProcessResponse] = None
+        self.error: Optional[str] = None
+        self.events: list[dict] = [{"stage": "queued", "at": self.created_at.isoformat()}]
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in JOB_TERMINAL_STATUSES
+    
+    def update(self, stage: str, status: Optional[str] = None) -> None:
+        self.stage = stage
+        if status:
+            self.status = status
+        self.updated_at = datetime.now(timezone.utc)
+        self.events.append({"stage": stage, "at": self.updated_at.isoformat()})
+        # Wake every subscriber, then arm a fresh event for the next change
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+    
+    async def wait_for_change(self, after: int, timeout: float) -> None:
+        if len(self.events) > after or self.finished:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def to_response(self) -> JobStatusResponse:
+        return JobStatusResponse(
+            job_id=self.id,
+            status=self.status,
+            stage=self.stage,
+            created_at=self.created_at,
+            updated_at=self.updated_at,
+            result=with_download_url(self.result) if self.result else None,
+            error=self.error,
+            status_url=f"/api/jobs/{self.id}",
+            events_url=f"/api/jobs/{self.id}/events"
+        )
+
+class JobStore:
+    """Bounded job registry; finished jobs expire after a TTL and are evicted oldest-first"""
+    
+    def __init__(self, max_jobs: int, ttl_seconds: int):
+        self.max_jobs = max_jobs
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self._jobs: "OrderedDict[str, ProcessingJob]" = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._jobs)
+    
+    def _evict(self) -> None:
+        cutoff = datetime.now(timezone.utc) - self.ttl
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.updated_at < cutoff]:
+            del self._jobs[job_id]
+        # Still full: drop the oldest finished jobs; running jobs are never evicted
+        for job_id in [j.id for j in self._jobs.values() if j.finished]:
+            if len(self._jobs) < self.max_jobs:
+                break
+            del self._jobs[job_id]
+    
+    def add(self) -> ProcessingJob:
+        self._evict()
+        if len(self._jobs) >= self.max_jobs:
             raise HTTPException(
-                status_code=500, 
-                detail="Google Drive service not configured. Please contact administrator."
+                status_code=503,
+                detail="Too many photos are being processed. Please try again shortly.",
+                headers={"Retry-After": "5"}
             )
+        job = ProcessingJob()
+        self._jobs[job.id] = job
+        return job
+    
+    def get(self, job_id: str) -> Optional[ProcessingJob]:
+        job = self._jobs.get(job_id)
+        if job and job.finished and job.updated_at < datetime.now(timezone.utc) - self.ttl:
+            del self._jobs[job_id]
+            return None
+        return job
+
+JOBS = JobStore(JOB_STORE_MAX_JOBS, JOB_TTL_SECONDS)
+METRICS.register_gauge("jobs_tracked", lambda: len(JOBS))
+
+async def run_processing_job(job: ProcessingJob, execute) -> None:
+    """Drive one job to completion, recording each pipeline stage"""
+    def report(stage: str) -> None:
+        job.update(stage, status="running")
+    
+    try:
+        job.result = await execute(progress=report)
+        job.update("completed", status="succeeded")
+        METRICS.inc("jobs_total", status="succeeded")
+    except HTTPException as e:
+        job.error = str(e.detail)
+        job.update("failed", status="failed")
+        METRICS.inc("jobs_total", status="failed")
+    except Exception as e:
+        logger.error(f"Job {job.id} failed: {str(e)}")
+        job.error = f"Processing failed: {str(e)}"
+        job.update("failed", status="failed")
+        METRICS.inc("jobs_total", status="failed")
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def stream_job_events(job: ProcessingJob):
+    """Server-Sent Events: one 'stage' event per stage, then a 'result' or 'error' event"""
+    sent = 0
+    while True:
+        while sent < len(job.events):
+            yield _sse("stage", job.events[sent])
+            sent += 1
+        if job.finished:
+            if job.result is not None:
+                yield _sse("result", with_download_url(job.result).model_dump())
+            else:
+                yield _sse("error", {"error": job.error})
+            return
+        await job.wait_for_change(sent, timeout=JOB_SSE_HEARTBEAT_SECONDS)
+        if sent == len(job.events) and not job.finished:
+            # Comment line keeps proxies from closing an idle stream
+            yield ": keep-alive\n\n"
+
+# ============= WORK QUEUE =============
+
+async def ensure_queue_indexes() -> None:
+    await db.processing_queue.create_index([("status", 1), ("available_at", 1), ("created_at", 1)])
+    await db.processing_queue.create_index([("status", 1), ("lease_expires_at", 1)])
+    await db.processing_queue.create_index("expires_at", expireAfterSeconds=0)
+
+async def enqueue_processing_job(
+    image_bytes: bytes,
+    name: str,
+    header: ImageHeader,
+    original_filename: str,
+    face_hint: Optional[tuple] = None,
+    specs: tuple[str, ...] = (DEFAULT_PHOTO_SPEC,)
+) -> dict:
+    """Persist a processing request for any worker.py instance to pick up"""
+    now = datetime.now(timezone.utc)
+    doc = {
+        "_id": str(uuid.uuid4()),
+        "status": "queued",
+        "stage": "queued",
+        "events": [{"stage": "queued", "at": now.isoformat()}],
+        "image": image_bytes,
+        "header": asdict(header),
+        "name": name,
+        "original_filename": original_filename,
+        "face_hint": list(face_hint) if face_hint else None,
+        "specs": list(specs),
+        "attempts": 0,
+        "max_attempts": QUEUE_MAX_ATTEMPTS,
+        "available_at": now,
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.processing_queue.insert_one(doc)
+    METRICS.inc("queue_enqueued_total")
+    logger.info(f"Enqueued processing job {doc['_id']}")
+    return doc
+
+async def claim_processing_job(worker_id: str) -> Optional[dict]:
+    """Atomically lease the oldest runnable job, including ones whose worker's lease expired"""
+    now = datetime.now(timezone.utc)
+    # Jobs abandoned by crashed workers too many times are failed rather than retried forever
+    await db.processing_queue.update_many(
+        {"status": "running", "lease_expires_at": {"$lt": now}, "$expr": {"$gte": ["$attempts", "$max_attempts"]}},
+        {"$set": {"status": "failed", "stage": "failed", "error": "Processing worker stopped responding.",
+                  "error_status": 500, "updated_at": now,
+                  "expires_at": now + timedelta(seconds=JOB_TTL_SECONDS)},
+         "$unset": {"image": ""}}
+    )
+    job = await db.processing_queue.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "available_at": {"$lte": now}},
+            {"status": "running", "lease_expires_at": {"$lt": now}}
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": worker_id,
+                "lease_expires_at": now + timedelta(seconds=QUEUE_LEASE_SECONDS),
+                "heartbeat_at": now,
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    if job:
+        if job["attempts"] > 1:
+            METRICS.inc("queue_reclaimed_total")
+        METRICS.inc("queue_claimed_total")
+    return job
+
+async def heartbeat_processing_job(job_id: str, worker_id: str) -> bool:
+    """Extend a lease; False means another worker has taken the job over"""
+    now = datetime.now(timezone.utc)
+    result = await db.processing_queue.update_one(
+        {"_id": job_id, "worker_id": worker_id, "status": "running"},
+        {"$set": {"heartbeat_at": now, "lease_expires_at": now + timedelta(seconds=QUEUE_LEASE_SECONDS)}}
+    )
+    return result.matched_count == 1
+
+async def record_processing_job_stage(job_id: str, worker_id: str, stage: str) -> None:
+    now = datetime.now(timezone.utc)
+    await db.processing_queue.update_one(
+        {"_id": job_id, "worker_id": worker_id},
+        {"$set": {"stage": stage, "updated_at": now}, "$push": {"events": {"stage": stage, "at": now.isoformat()}}}
+    )
+
+async def complete_processing_job(job_id: str, worker_id: str, response: ProcessResponse) -> None:
+    now = datetime.now(timezone.utc)
+    await db.processing_queue.update_one(
+        {"_id": job_id, "worker_id": worker_id},
+        {
+            "$set": {"status": "succeeded", "stage": "completed", "result": stored_response_fields(response),
+                     "updated_at": now, "expires_at": now + timedelta(seconds=JOB_TTL_SECONDS)},
+            "$push": {"events": {"stage": "completed", "at": now.isoformat()}},
+            "$unset": {"image": ""}
+        }
+    )
+    METRICS.inc("queue_jobs_total", status="succeeded")
+
+async def fail_processing_job(job: dict, worker_id: str, error: str, status_code: int, retryable: bool) -> None:
+    """Requeue with backoff while the job's own attempts remain, otherwise mark it failed"""
+    now = datetime.now(timezone.utc)
+    job_id, attempts = job["_id"], job["attempts"]
+    # The limit recorded at enqueue, as claim_processing_job applies it, not today's QUEUE_MAX_ATTEMPTS
+    if retryable and attempts < job["max_attempts"]:
+        await db.processing_queue.update_one(
+            {"_id": job_id, "worker_id": worker_id},
+            {"$set": {"status": "queued", "stage": "retrying", "error": error, "updated_at": now,
+                      "available_at": now + timedelta(seconds=2 ** attempts)},
+             "$push": {"events": {"stage": "retrying", "at": now.isoformat()}}}
+        )
+        METRICS.inc("queue_retries_total")
+        return
+    await db.processing_queue.update_one(
+        {"_id": job_id, "worker_id": worker_id},
+        {
+            "$set": {"status": "failed", "stage": "failed", "error": error, "error_status": status_code,
+                     "updated_at": now, "expires_at": now + timedelta(seconds=JOB_TTL_SECONDS)},
+            "$push": {"events": {"stage": "failed", "at": now.isoformat()}},
+            "$unset": {"image": ""}
+        }
+    )
+    METRICS.inc("queue_jobs_total", status="failed")
+
+def queued_job_to_response(doc: dict) -> JobStatusResponse:
+    return JobStatusResponse(
+        job_id=doc["_id"],
+        status=doc["status"],
+        stage=doc["stage"],
+        created_at=doc["created_at"],
+        updated_at=doc["updated_at"],
+        result=with_download_url(ProcessResponse(**doc["result"])) if doc.get("result") else None,
+        error=doc.get("error") if doc["status"] == "failed" else None,
+        status_url=f"/api/jobs/{doc['_id']}",
+        events_url=f"/api/jobs/{doc['_id']}/events"
+    )
+
+QUEUE_JOB_PROJECTION = {"image": 0}
+
+async def wait_for_queued_job(job_id: str, timeout: float) -> ProcessResponse:
+    """Poll a queued job until a worker finishes it"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        doc = await db.processing_queue.find_one({"_id": job_id}, QUEUE_JOB_PROJECTION)
+        if doc and doc["status"] == "succeeded":
+            return with_download_url(ProcessResponse(**doc["result"]))
+        if doc and doc["status"] == "failed":
+            raise HTTPException(status_code=doc.get("error_status", 500), detail=doc.get("error"))
+        await asyncio.sleep(QUEUE_POLL_SECONDS)
+    raise HTTPException(
+        status_code=504,
+        detail=f"Photo is still processing. Check GET /api/jobs/{job_id} for the result."
+    )
+
+async def process_via_queue(
+    image_bytes: bytes,
+    name: str,
+    header: ImageHeader,
+    original_filename: str,
+    face_hint: Optional[tuple] = None,
+    specs: tuple[str, ...] = (DEFAULT_PHOTO_SPEC,)
+) -> ProcessResponse:
+    """Queue-mode counterpart of process_and_store_photo: enqueue, then wait for a worker"""
+    doc = await enqueue_processing_job(image_bytes, name, header, original_filename, face_hint, specs)
+    return await wait_for_queued_job(doc["_id"], QUEUE_RESULT_TIMEOUT_SECONDS)
+
+async def stream_queued_job_events(job_id: str):
+    """SSE stream for a queued job, polling MongoDB for new stage events"""
+    sent = 0
+    idle = 0.0
+    while True:
+        doc = await db.processing_queue.find_one({"_id": job_id}, QUEUE_JOB_PROJECTION)
+        if doc is None:
+            yield _sse("error", {"error": "Job not found"})
+            return
+        events = doc.get("events", [])
+        for event in events[sent:]:
+            yield _sse("stage", event)
+        if len(events) > sent:
+            sent, idle = len(events), 0.0
+        if doc["status"] == "succeeded":
+            yield _sse("result", with_download_url(ProcessResponse(**doc["result"])).model_dump())
+            return
+        if doc["status"] == "failed":
+            yield _sse("error", {"error": doc.get("error")})
+            return
+        await asyncio.sleep(QUEUE_POLL_SECONDS)
+        idle += QUEUE_POLL_SECONDS
+        if idle >= JOB_SSE_HEARTBEAT_SECONDS:
+            idle = 0.0
+            yield ": keep-alive\n\n"
+
+# ============= PRINT SHEETS =============
+
+class SheetCache:
+    """Byte-bounded LRU of composed print sheets"""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._sheets: OrderedDict[str, tuple[bytes, int]] = OrderedDict()
+    
+    def get(self, key: str) -> Optional[tuple[bytes, int]]:
+        entry = self._sheets.get(key)
+        if entry is not None:
+            self._sheets.move_to_end(key)
+        return entry
+    
+    def put(self, key: str, sheet: bytes, copies: int) -> None:
+        if len(sheet) > self.max_bytes or key in self._sheets:
+            return
+        self._sheets[key] = (sheet, copies)
+        self.size_bytes += len(sheet)
+        while self.size_bytes > self.max_bytes:
+            _, (evicted, _) = self._sheets.popitem(last=False)
+            self.size_bytes -= len(evicted)
+
+class DriveFileCache:
+    """
+    Byte-bounded LRU of Drive-stored photos on local disk, and of previews derived
+    from any stored photo. Entries are named by Drive file id (or, for a local
+    photo, its stem) and stored version, so a renamed photo is fetched and
+    previewed fresh and the stale copies age out. Every worker process on a node shares the directory, so
+    usage is measured from the directory itself and recency from file mtimes,
+    which hits refresh; the bound then holds however many processes fill it.
+    Concurrent misses for one file within a process share a single download.
+    """
+    
+    # A partial download this old was abandoned by a process that died mid-fetch
+    STALE_PART_SECONDS = 3600
+    
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # As of the last scan of the directory
+        self.size_bytes = 0
+        self.entries = 0
+        self._flights = SingleFlight("drive_cache")
+        directory.mkdir(parents=True, exist_ok=True)
+        self._evict()
+    
+    def __len__(self) -> int:
+        return self.entries
+    
+    @staticmethod
+    def cache_key(photo: dict) -> str:
+        return photo.get("drive_file_id") or Path(photo["filename"]).stem
+    
+    @classmethod
+    def entry_name(cls, photo: dict, suffix: str = ".jpg") -> str:
+        version = hashlib.sha1(str(photo["version"]).encode('utf-8')).hexdigest()[:12]
+        return f"{cls.cache_key(photo)}-{version}{suffix}"
+    
+    async def path(self, photo: dict) -> Path:
+        """Local path of a Drive-stored photo, downloading it on first access"""
+        name = self.entry_name(photo)
+        path = self.directory / name
+        try:
+            # Marks the entry recently used for every process's eviction
+            os.utime(path)
+        except FileNotFoundError:
+            METRICS.inc("drive_cache_total", result="miss")
+            return await self._flights.do(name, partial(self._fill, name, photo))
+        METRICS.inc("drive_cache_total", result="hit")
+        return path
+    
+    async def derived_path(self, photo: dict, suffix: str, render: Callable[[], Awaitable[bytes]]) -> Path:
+        """Local path of a file derived from a stored photo, such as a preview, rendered on first access"""
+        name = self.entry_name(photo, suffix)
+        path = self.directory / name
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            async def fill() -> Path:
+                return await self.store_derived(photo, suffix, await render())
+            return await self._flights.do(name, fill)
+        return path
+    
+    async def store_derived(self, photo: dict, suffix: str, data: bytes) -> Path:
+        """Cache a file derived from the photo's current version, such as a preview rendered along with it"""
+        name = self.entry_name(photo, suffix)
+        path = self.directory / name
+        partial_path = path.with_name(f"{name}.{os.getpid()}.part")
+        try:
+            await asyncio.to_thread(partial_path.write_bytes, data)
+            await asyncio.to_thread(partial_path.replace, path)
+        except OSError:
+            partial_path.unlink(missing_ok=True)
+            raise
+        await asyncio.to_thread(self._evict, name)
+        return path
+    
+    async def _fill(self, name: str, photo: dict) -> Path:
+        path = self.directory / name
+        # Per-process partial name, since another worker may be fetching the same file
+        partial_path = path.with_name(f"{name}.{os.getpid()}.part")
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(download_google_drive_file, photo["drive_file_id"], partial_path)
+            await asyncio.to_thread(partial_path.replace, path)
+        except Exception as e:
+            partial_path.unlink(missing_ok=True)
+            if isinstance(e, HTTPException):
+                raise
+            logger.error(f"Google Drive download failed for {photo['filename']}: {str(e)}")
+            raise HTTPException(status_code=502, detail=f"Failed to read {photo['filename']} from Google Drive.")
+        METRICS.observe("drive_cache_fill_seconds", time.perf_counter() - start)
+        await asyncio.to_thread(self._evict, name)
+        return path
+    
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """Measure the directory and remove least recently used entries, never keep, until it fits"""
+        now = time.time()
+        entries = []
+        for path in self.directory.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted or renamed by another process while scanning
+                continue
+            if path.suffix == '.part':
+                if now - stat.st_mtime > self.STALE_PART_SECONDS:
+                    path.unlink(missing_ok=True)
+            else:
+                entries.append((stat.st_mtime, path.name, stat.st_size))
+        entries.sort()
+        size_bytes = sum(size for _, _, size in entries)
+        count = len(entries)
+        for _, name, size in entries:
+            if size_bytes <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            (self.directory / name).unlink(missing_ok=True)
+            size_bytes -= size
+            count -= 1
+        self.size_bytes = size_bytes
+        self.entries = count
+    
+    def discard(self, cache_keys: set[str]) -> None:
+        """Drop every cached version of the given photos (see cache_key), and what was derived from them"""
+        for path in self.directory.iterdir():
+            if path.suffix != '.part' and path.name.rsplit('-', 1)[0] in cache_keys:
+                path.unlink(missing_ok=True)
+
+DRIVE_CACHE = DriveFileCache(DRIVE_CACHE_DIR, DRIVE_CACHE_MAX_BYTES)
+METRICS.register_gauge("drive_cache_bytes", lambda: DRIVE_CACHE.size_bytes)
+METRICS.register_gauge("drive_cache_entries", lambda: len(DRIVE_CACHE))
+
+SHEETS = SheetCache(SHEET_CACHE_MAX_BYTES)
+SHEET_FLIGHTS = SingleFlight("print_sheet")
+METRICS.register_gauge("print_sheet_cache_bytes", lambda: SHEETS.size_bytes)
+
+# Every processed photo is saved as passport_photo_<name>[_<spec>]_<timestamp>.jpg
+STORED_PHOTO_PATTERN = re.compile(r'passport_photo_[A-Za-z0-9_\s-]+\.jpg')
+
+def check_stored_photo_name(filename: str) -> None:
+    """404 for anything that cannot be a processed photo: traversal, directories such as drive_cache, stray files"""
+    if not STORED_PHOTO_PATTERN.fullmatch(filename):
+        raise HTTPException(status_code=404, detail=f"Photo not found: {filename}")
+
+def drive_version(doc: dict) -> str:
+    """Version of a Drive-stored photo; a rename changes its size and updated_at"""
+    return f"{doc.get('file_size_bytes')}:{doc.get('updated_at') or doc.get('upload_timestamp')}"
+
+async def find_stored_photos(filenames: list[str]) -> list[dict]:
+    """Resolve processed photos by filename; local files need no metadata record"""
+    docs = await db.passport_photos.find(
+        {"filename": {"$in": filenames}},
+        {"_id": 0, "filename": 1, "drive_file_id": 1, "file_size_bytes": 1, "upload_timestamp": 1, "updated_at": 1}
+    ).to_list(len(filenames))
+    by_filename = {doc["filename"]: doc for doc in docs}
+    
+    photos = []
+    for filename in filenames:
+        check_stored_photo_name(filename)
+        doc = by_filename.get(filename, {"filename": filename})
+        local_path = UPLOADS_DIR / filename
+        if local_path.is_file():
+            stat = local_path.stat()
+            doc = {**doc, "version": f"{stat.st_size}:{stat.st_mtime_ns}"}
+        elif doc.get("drive_file_id"):
+            doc = {**doc, "version": drive_version(doc)}
+        else:
+            raise HTTPException(status_code=404, detail=f"Photo not found: {filename}")
+        photos.append(doc)
+    return photos
+
+async def read_stored_photo(photo: dict) -> bytes:
+    """Stored output bytes: the local upload if present, otherwise the Drive copy through the disk cache"""
+    check_stored_photo_name(photo["filename"])
+    local_path = UPLOADS_DIR / photo["filename"]
+    if not local_path.is_file():
+        local_path = await DRIVE_CACHE.path(photo)
+    return await asyncio.to_thread(local_path.read_bytes)
+
+def print_sheet_key(photos: list[dict], layout: SheetLayout, copies: Optional[int]) -> str:
+    """Cache key over the exact stored versions of the inputs and the layout"""
+    digest = hashlib.sha256(json.dumps({
+        "photos": [[photo["filename"], photo["version"]] for photo in photos],
+        "layout": asdict(layout),
+        "copies": copies
+    }, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+# ============= DUPLICATE INDEX =============
+
+class PhotoHashIndex:
+    """
+    Multi-index hashing over 64-bit perceptual hashes. Each hash is split into four
+    16-bit chunks; two hashes within max_distance bits differ in at most
+    max_distance // 4 bits of some chunk, so a lookup probes each chunk's table
+    with that many flipped bits and compares only the entries it finds.
+    """
+    
+    CHUNKS = 4
+    CHUNK_BITS = 16
+    
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        radius = max_distance // self.CHUNKS
+        self._flips = [
+            sum(1 << bit for bit in bits)
+            for flipped in range(radius + 1)
+            for bits in combinations(range(self.CHUNK_BITS), flipped)
+        ]
+        self._tables: list[dict[int, dict[str, int]]] = [defaultdict(dict) for _ in range(self.CHUNKS)]
+        self._entries: dict[str, tuple[int, dict]] = {}
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _keys(self, value: int) -> list[int]:
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(value >> (index * self.CHUNK_BITS)) & mask for index in range(self.CHUNKS)]
+    
+    def add(self, entry: dict) -> None:
+        """Index a photo summary carrying metadata_id, spec and perceptual_hash"""
+        photo_id = entry["metadata_id"]
+        self.remove(photo_id)
+        value = int(entry["perceptual_hash"], 16)
+        self._entries[photo_id] = (value, entry)
+        for table, key in zip(self._tables, self._keys(value)):
+            table[key][photo_id] = value
+    
+    def remove(self, photo_id: str) -> None:
+        existing = self._entries.pop(photo_id, None)
+        if existing is None:
+            return
+        for table, key in zip(self._tables, self._keys(existing[0])):
+            bucket = table[key]
+            bucket.pop(photo_id, None)
+            if not bucket:
+                del table[key]
+    
+    def query(self, perceptual_hash: str, spec: Optional[str] = None, max_distance: Optional[int] = None) -> list[tuple[int, dict]]:
+        """Entries within max_distance bits (at most the index's own), closest first"""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        value = int(perceptual_hash, 16)
+        distances: dict[str, int] = {}
+        for table, key in zip(self._tables, self._keys(value)):
+            for flip in self._flips:
+                bucket = table.get(key ^ flip)
+                if not bucket:
+                    continue
+                for photo_id, other in bucket.items():
+                    distance = (value ^ other).bit_count()
+                    if distance <= max_distance:
+                        distances[photo_id] = distance
+        matches = [(distance, self._entries[photo_id][1]) for photo_id, distance in distances.items()]
+        if spec is not None:
+            matches = [match for match in matches if match[1]["spec"] == spec]
+        matches.sort(key=lambda match: match[0])
+        return matches
+    
+    def clusters(self, max_distance: Optional[int] = None) -> list[list[dict]]:
+        """Groups of two or more same-spec photos connected by near-duplicate links"""
+        parent = {photo_id: photo_id for photo_id in self._entries}
         
-        # Validate file type
-        if not file.content_type or not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
-        
-        allowed_types = ['image/jpeg', 'image/jpg', 'image/png']
-        if file.content_type not in allowed_types:
-            raise HTTPException(status_code=400, detail="Only JPG and PNG formats are supported.")
-        
-        # Validate name
-        if not name or len(name) > 50:
-            raise HTTPException(status_code=400, detail="Name is required and must be less than 50 characters.")
-        
-        # Validate name characters
-        if not re.match(r"^[a-zA-Z0-9\s\-\']+$", name):
-            raise HTTPException(status_code=400, detail="Name contains invalid characters.")
-        
-        # Read file
-        image_bytes = await file.read()
-        file_size = len(image_bytes)
+        def find(photo_id: str) -> str:
+            while parent[photo_id] != photo_id:
+                parent[photo_id] = parent[parent[photo_id]]
+                photo_id = parent[photo_id]
+            return photo_id
         
-        # Check file size (10MB limit)
-        if file_size > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit.")
+        for photo_id, (_, entry) in self._entries.items():
+            for _, match in self.query(entry["perceptual_hash"], entry["spec"], max_distance):
+                parent[find(match["metadata_id"])] = find(photo_id)
         
-        logger.info(f"Processing image: {file.filename}, size: {file_size} bytes")
+        groups: dict[str, list[dict]] = defaultdict(list)
+        for photo_id, (_, entry) in self._entries.items():
+            groups[find(photo_id)].append(entry)
+        return [members for members in groups.values() if len(members) > 1]
+
+PHOTO_HASHES = PhotoHashIndex(DUPLICATE_HASH_DISTANCE)
+METRICS.register_gauge("duplicate_index_entries", lambda: len(PHOTO_HASHES))
+
+PHOTO_HASH_FIELDS = {
+    "filename": 1, "spec": 1, "perceptual_hash": 1, "name_on_photo": 1, "drive_file_id": 1,
+    "drive_file_url": 1, "file_size_bytes": 1, "upload_timestamp": 1
+}
+
+def photo_hash_entry(doc: dict, metadata_id: str) -> dict:
+    """The part of a passport_photos document the duplicate index keeps in memory"""
+    entry = {field: doc.get(field) for field in PHOTO_HASH_FIELDS}
+    entry["spec"] = entry["spec"] or DEFAULT_PHOTO_SPEC
+    entry["metadata_id"] = metadata_id
+    return entry
+
+class PhotoHashSync:
+    """
+    Keeps PHOTO_HASHES in step with photos written by other processes. Each poll
+    reads photos whose ObjectId was generated since shortly before the previous
+    poll; the overlap covers clock skew between writers and ids generated just
+    before their insert landed, and re-adding a known photo is harmless.
+    """
+    
+    OVERLAP = timedelta(seconds=30)
+    
+    def __init__(self, index: PhotoHashIndex, interval: float):
+        self.index = index
+        self.interval = interval
+        self._since: Optional[datetime] = None
+        self._polled_at = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def _pull(self, query: dict) -> int:
+        started = datetime.now(timezone.utc)
+        count = 0
+        async for doc in db.passport_photos.find({"perceptual_hash": {"$type": "string"}, **query}, PHOTO_HASH_FIELDS):
+            self.index.add(photo_hash_entry(doc, str(doc["_id"])))
+            count += 1
+        self._since = started
+        self._polled_at = time.monotonic()
+        return count
+    
+    async def load(self) -> None:
+        """Fill the index from every hashed photo in MongoDB"""
+        start = time.perf_counter()
+        async with self._lock:
+            await self._pull({})
+        logger.info(f"Loaded {len(self.index)} photo hashes in {time.perf_counter() - start:.2f}s")
+    
+    async def refresh(self) -> None:
+        """Pull recently inserted photos, unless the last poll is younger than the refresh interval"""
+        if self._since is None or time.monotonic() - self._polled_at < self.interval:
+            return
+        async with self._lock:
+            if time.monotonic() - self._polled_at < self.interval:
+                return
+            try:
+                added = await self._pull({"_id": {"$gte": ObjectId.from_datetime(self._since - self.OVERLAP)}})
+            except Exception as e:
+                logger.warning(f"Duplicate index refresh failed, using the loaded entries: {str(e)}")
+                self._polled_at = time.monotonic()
+                return
+            METRICS.inc("duplicate_index_refreshed_total", added)
+
+PHOTO_HASH_SYNC = PhotoHashSync(PHOTO_HASHES, DUPLICATE_INDEX_REFRESH_SECONDS)
+
+async def load_photo_hash_index() -> None:
+    await PHOTO_HASH_SYNC.load()
+
+async def prune_photo_hashes(entries: list[dict]) -> list[dict]:
+    """
+    Entries whose photo still exists, re-indexed with its current name. Renames
+    and deletions by other processes are not polled for, so matches are checked
+    against MongoDB before they are used.
+    """
+    docs = await db.passport_photos.find(
+        {"_id": {"$in": [ObjectId(entry["metadata_id"]) for entry in entries]}}, PHOTO_HASH_FIELDS
+    ).to_list(len(entries))
+    current = {str(doc["_id"]): doc for doc in docs}
+    live = []
+    for entry in entries:
+        doc = current.get(entry["metadata_id"])
+        if doc is None or not doc.get("perceptual_hash"):
+            PHOTO_HASHES.remove(entry["metadata_id"])
+            continue
+        entry = photo_hash_entry(doc, entry["metadata_id"])
+        PHOTO_HASHES.add(entry)
+        live.append(entry)
+    return live
+
+async def find_reusable_photo(perceptual_hash: Optional[str], spec: str, name: str) -> Optional[dict]:
+    """A stored photo close enough to stand in for a new render with the same spec and name"""
+    if not DUPLICATE_REUSE or not perceptual_hash:
+        return None
+    await PHOTO_HASH_SYNC.refresh()
+    start = time.perf_counter()
+    matches = PHOTO_HASHES.query(perceptual_hash, spec, DUPLICATE_REUSE_DISTANCE)
+    METRICS.observe("duplicate_lookup_seconds", time.perf_counter() - start, (0.0001, 0.0005, 0.001, 0.005, 0.01))
+    if not matches:
+        return None
+    # The banner is part of the image, so only a photo rendered for the same name can be reused
+    live = await prune_photo_hashes([entry for _, entry in matches])
+    return next((entry for entry in live if entry["name_on_photo"] == name), None)
+
+# ============= RETENTION =============
+
+RETENTION_AGE_UNITS = {"d": 86400, "h": 3600, "m": 60}
+RETENTION_FIELDS = {"filename": 1, "storage_mode": 1, "drive_file_id": 1, "file_size_bytes": 1, "upload_timestamp": 1}
+
+@dataclass(frozen=True)
+class RetentionRule:
+    storage_mode: str  # "*" matches any
+    processing_status: str
+    max_age: timedelta
+    
+    def match(self) -> dict:
+        """Filter for the photos this rule governs, regardless of age"""
+        query = {}
+        if self.storage_mode != "*":
+            query["storage_mode"] = self.storage_mode
+        if self.processing_status != "*":
+            query["processing_status"] = self.processing_status
+        return query
+    
+    def __str__(self) -> str:
+        return f"{self.storage_mode}:{self.processing_status}={self.max_age.total_seconds() / 86400:g}d"
+
+def parse_retention_rules(raw: str) -> list[RetentionRule]:
+    """Parse RETENTION_RULES; malformed rules are skipped, which keeps the photos they would have expired"""
+    rules = []
+    for item in filter(None, (part.strip() for part in raw.split(','))):
+        match = re.fullmatch(r'([\w*]+)(?::([\w*]+))?=(\d+(?:\.\d+)?)([dhm]?)', item)
+        if not match:
+            logger.warning(f"Ignoring retention rule {item!r}: expected storage_mode[:status]=age, e.g. local=30d")
+            continue
+        storage_mode, status, amount, unit = match.groups()
+        rules.append(RetentionRule(
+            storage_mode, status or "*", timedelta(seconds=float(amount) * RETENTION_AGE_UNITS[unit or "d"])
+        ))
+    return rules
+
+def retention_queries(rules: list[RetentionRule]) -> list[tuple[RetentionRule, dict]]:
+    """One filter per rule, age aside, selecting the photos it governs: those not matched by an earlier rule"""
+    queries = []
+    for index, rule in enumerate(rules):
+        earlier = [other.match() for other in rules[:index]]
+        if {} in earlier:
+            break  # a catch-all rule shadows everything after it
+        query = rule.match()
+        if earlier:
+            query["$nor"] = earlier
+        queries.append((rule, query))
+    return queries
+
+def retention_cutoffs(cutoff: datetime) -> tuple:
+    """
+    upload_timestamp bounds to scan: a UTC ISO string, as photos are stored
+    (these sort chronologically), and a date for older records. Range and
+    keyset comparisons only match values of the same BSON type, so each type
+    is scanned on its own.
+    """
+    return cutoff.isoformat(), cutoff
+
+def existing_file_sizes(paths: list[Path]) -> dict[Path, int]:
+    sizes = {}
+    for path in paths:
+        try:
+            sizes[path] = path.stat().st_size
+        except FileNotFoundError:
+            pass
+    return sizes
+
+def unlink_files(paths) -> None:
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+async def ensure_retention_indexes() -> None:
+    # Sweeper keyset scans, the newest-first photo listing and filename lookups
+    await db.passport_photos.create_index([("upload_timestamp", 1), ("_id", 1)])
+    await db.passport_photos.create_index("filename")
+    # Bases have nothing outside MongoDB, so the TTL monitor can remove them on its own.
+    # A changed setting is applied to the existing index rather than failing on the option conflict.
+    ttl_index = (await db.photo_bases.index_information()).get("created_at_1")
+    if RETENTION_BASE_IMAGE_DAYS > 0:
+        expire_after = RETENTION_BASE_IMAGE_DAYS * 86400
+        if ttl_index is None:
+            await db.photo_bases.create_index("created_at", expireAfterSeconds=expire_after)
+        elif ttl_index.get("expireAfterSeconds") != expire_after:
+            await db.command("collMod", "photo_bases", index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": expire_after})
+    elif ttl_index is not None:
+        await db.photo_bases.drop_index("created_at_1")
+
+class RetentionSweeper:
+    """
+    Applies the retention rules on an interval. An expired photo loses its local
+    file and previews, its Drive copy, its cached copy, its base image and finally
+    its metadata, so an interrupted sweep is simply resumed by the next one. Photo
+    files no metadata points to (leftovers of sweeps on other nodes, failed
+    uploads, stray outputs) are reconciled in the same pass. A TTL index alone
+    would only remove the documents and leave every file behind.
+    """
+    
+    def __init__(self, rules: list[RetentionRule], mode: str, interval: float, directory: Path):
+        self.rules = rules
+        self.mode = mode
+        self.interval = interval
+        self.directory = directory
+        self.last_report: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+        self._warned_drive_unavailable = False
+    
+    async def sweep(self) -> dict:
+        """One pass over every rule and the uploads directory; in report mode nothing is deleted"""
+        start = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        report = {
+            "mode": self.mode, "started_at": now.isoformat(), "expired_photos": 0, "deleted_photos": 0,
+            "drive_delete_errors": 0, "reclaimed_bytes": {"local": 0, "drive": 0}, "orphan_files": 0, "orphan_bytes": 0,
+            "skipped_rules": []
+        }
+        drive_unavailable = RETENTION_DELETE_DRIVE and not GOOGLE_DRIVE_SERVICE
+        if drive_unavailable and not self._warned_drive_unavailable:
+            logger.warning("Retention cannot delete Drive copies while Google Drive is not configured; skipping Drive-stored photos")
+            self._warned_drive_unavailable = True
+        for rule, query in retention_queries(self.rules):
+            if drive_unavailable:
+                if rule.storage_mode == "google_drive":
+                    report["skipped_rules"].append(str(rule))
+                    continue
+                query = {**query, "drive_file_id": None}
+            for bound in retention_cutoffs(now - rule.max_age):
+                await self.scan(rule, {**query, "upload_timestamp": {"$lt": bound}}, report)
+        await self.reconcile_orphans(report)
         
-        # Detect face
-        face_coords = detect_face_opencv(image_bytes)
-        if not face_coords:
-            raise HTTPException(
-                status_code=400,
-                detail="No face detected in the photo. Please upload a clear, frontal face photo."
-            )
+        report["duration_seconds"] = round(time.perf_counter() - start, 3)
+        METRICS.observe("retention_sweep_seconds", report["duration_seconds"], (0.1, 0.5, 1, 5, 15, 60, 300, 900))
+        logger.info(
+            f"Retention sweep ({self.mode}): {report['expired_photos']} expired, {report['deleted_photos']} deleted, "
+            f"{report['orphan_files']} orphaned files, {report['reclaimed_bytes']['local'] + report['orphan_bytes']} "
+            f"local and {report['reclaimed_bytes']['drive']} Drive bytes "
+            f"{'reclaimed' if self.mode == 'enforce' else 'reclaimable'} in {report['duration_seconds']:.1f}s"
+        )
+        self.last_report = report
+        return report
+    
+    async def scan(self, rule: RetentionRule, query: dict, report: dict) -> None:
+        """Expire every photo matching query, a batch at a time in (upload_timestamp, _id) order"""
+        last = None
+        while True:
+            page = query
+            if last is not None:
+                # Keyset pagination: resume after the last photo seen, whether or not it was deleted
+                timestamp, photo_id = last
+                page = {"$and": [query, {"$or": [
+                    {"upload_timestamp": {"$gt": timestamp}},
+                    {"upload_timestamp": timestamp, "_id": {"$gt": photo_id}}
+                ]}]}
+            docs = await db.passport_photos.find(page, RETENTION_FIELDS).sort(
+                [("upload_timestamp", 1), ("_id", 1)]
+            ).limit(RETENTION_SWEEP_BATCH).to_list(RETENTION_SWEEP_BATCH)
+            if not docs:
+                return
+            await self.expire(docs, rule, report)
+            if len(docs) < RETENTION_SWEEP_BATCH:
+                return
+            last = (docs[-1]["upload_timestamp"], docs[-1]["_id"])
+    
+    async def expire(self, docs: list[dict], rule: RetentionRule, report: dict) -> None:
+        """Remove a batch of expired photos; in report mode only count them. Failed Drive deletes leave the photo for the next sweep"""
+        files = {
+            doc["_id"]: [self.directory / doc["filename"]]
+            + [self.directory / preview_filename(doc["filename"], fmt) for fmt in PREVIEW_PREFERENCE]
+            for doc in docs
+        }
+        sizes = await asyncio.to_thread(existing_file_sizes, [path for paths in files.values() for path in paths])
+        drive_docs = [doc for doc in docs if doc.get("drive_file_id")] if RETENTION_DELETE_DRIVE else []
+        report["expired_photos"] += len(docs)
+        if self.mode != "enforce":
+            report["reclaimed_bytes"]["local"] += sum(sizes.values())
+            report["reclaimed_bytes"]["drive"] += sum(doc.get("file_size_bytes") or 0 for doc in drive_docs)
+            return
         
-        # Process image
-        processed_bytes, processed_size = process_passport_photo(image_bytes, name, face_coords)
+        failed = await self.delete_drive_files([doc["drive_file_id"] for doc in drive_docs])
+        report["drive_delete_errors"] += len(failed)
+        deleted = [doc for doc in docs if doc.get("drive_file_id") not in failed]
         
-        # Generate filename
-        sanitized_name = sanitize_filename(name)
-        timestamp = int(time.time())
-        filename = f"passport_photo_{sanitized_name}_{timestamp}.jpg"
+        paths = [path for doc in deleted for path in files[doc["_id"]] if path in sizes]
+        await asyncio.to_thread(unlink_files, paths)
+        if deleted:
+            await asyncio.to_thread(DRIVE_CACHE.discard, {DriveFileCache.cache_key(doc) for doc in deleted})
+        ids = [doc["_id"] for doc in deleted]
+        await db.photo_bases.delete_many({"_id": {"$in": [str(photo_id) for photo_id in ids]}})
+        await db.passport_photos.delete_many({"_id": {"$in": ids}})
+        for photo_id in ids:
+            PHOTO_HASHES.remove(str(photo_id))
         
-        # Upload to Google Drive
+        local_bytes = sum(sizes[path] for path in paths)
+        drive_bytes = sum(doc.get("file_size_bytes") or 0 for doc in drive_docs if doc.get("drive_file_id") not in failed)
+        report["deleted_photos"] += len(deleted)
+        report["reclaimed_bytes"]["local"] += local_bytes
+        report["reclaimed_bytes"]["drive"] += drive_bytes
+        METRICS.inc("retention_photos_deleted_total", len(deleted), rule=str(rule))
+        METRICS.inc("retention_reclaimed_bytes_total", local_bytes, location="local")
+        METRICS.inc("retention_reclaimed_bytes_total", drive_bytes, location="drive")
+    
+    async def delete_drive_files(self, file_ids: list[str]) -> set[str]:
+        """Delete in batch requests paced to stay under Drive's rate limits; returns the ids that failed"""
+        failed = set()
+        for offset in range(0, len(file_ids), RETENTION_DRIVE_BATCH_SIZE):
+            if offset:
+                await asyncio.sleep(RETENTION_DRIVE_BATCH_PAUSE_SECONDS)
+            chunk = file_ids[offset:offset + RETENTION_DRIVE_BATCH_SIZE]
+            try:
+                results = await asyncio.to_thread(delete_google_drive_files, chunk)
+            except Exception as e:
+                results = {file_id: str(getattr(e, 'detail', e)) for file_id in chunk}
+            for file_id in chunk:
+                error = results.get(file_id, "no response")
+                if error:
+                    logger.error(f"Google Drive delete failed for {file_id}: {error}")
+                    METRICS.inc("retention_drive_delete_errors_total")
+                    failed.add(file_id)
+        return failed
+    
+    def orphan_candidates(self, cutoff: float) -> dict[Path, tuple[Optional[str], int]]:
+        """Photo files older than cutoff, with the filename of the photo each belongs to (None for partial writes)"""
+        candidates = {}
+        for path in self.directory.iterdir():
+            if not path.name.startswith("passport_photo_") or not path.is_file():
+                continue
+            stat = path.stat()
+            if stat.st_mtime < cutoff:
+                owner = None if path.suffix == ".part" else f"{path.stem}.jpg"
+                candidates[path] = (owner, stat.st_size)
+        return candidates
+    
+    async def reconcile_orphans(self, report: dict) -> None:
+        candidates = await asyncio.to_thread(self.orphan_candidates, time.time() - RETENTION_ORPHAN_GRACE_SECONDS)
+        owners = list({owner for owner, _ in candidates.values() if owner})
+        known = set()
+        for offset in range(0, len(owners), 1000):
+            chunk = owners[offset:offset + 1000]
+            async for doc in db.passport_photos.find({"filename": {"$in": chunk}}, {"_id": 0, "filename": 1}):
+                known.add(doc["filename"])
+        orphans = {path: size for path, (owner, size) in candidates.items() if owner not in known}
+        report["orphan_files"] = len(orphans)
+        report["orphan_bytes"] = sum(orphans.values())
+        if self.mode == "enforce" and orphans:
+            await asyncio.to_thread(unlink_files, orphans)
+            METRICS.inc("retention_orphans_deleted_total", len(orphans))
+            METRICS.inc("retention_reclaimed_bytes_total", report["orphan_bytes"], location="local")
+    
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Retention sweep failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+    
+    def start(self) -> None:
+        if self._task is None and self.mode in ("report", "enforce"):
+            self._task = asyncio.create_task(self.run())
+    
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+RETENTION = RetentionSweeper(
+    parse_retention_rules(RETENTION_RULES), RETENTION_MODE, RETENTION_SWEEP_INTERVAL_SECONDS, UPLOADS_DIR
+)
+
+# ============= API ENDPOINTS =============
+
+@api_router.get("/health")
+async def health_check():
+    """Health check endpoint, served from the background snapshot"""
+    snapshot = HEALTH.snapshot
+    reasons = HEALTH.not_ready_reasons()
+    return {
+        "status": "healthy" if not reasons else "degraded",
+        "mongodb": snapshot.get("mongodb", {}).get("status", "unknown"),
+        "google_drive": snapshot.get("google_drive", drive_token_status())["status"],
+        "ready": not reasons,
+        "reasons": reasons,
+        "snapshot_age_seconds": round(HEALTH.age, 3) if HEALTH.age is not None else None,
+        "checks": snapshot,
+        "load": processing_load()
+    }
+
+@api_router.get("/livez")
+async def liveness():
+    """The event loop is answering; nothing else is checked"""
+    return {"status": "alive"}
+
+@api_router.get("/readyz")
+async def readiness():
+    """503 while dependencies are down or this worker is overloaded, so the load balancer sheds traffic"""
+    reasons = HEALTH.not_ready_reasons()
+    if reasons:
+        return Response(
+            content=json.dumps({"ready": False, "reasons": reasons}),
+            status_code=503,
+            media_type="application/json",
+            headers={"Retry-After": str(max(1, round(HEALTH.interval)))}
+        )
+    return {"ready": True}
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """In-process metrics for this worker"""
+    return METRICS.snapshot()
+
+@api_router.get("/retention")
+async def get_retention_status():
+    """Retention rules in force and this worker's latest sweep report"""
+    return {
+        "mode": RETENTION.mode,
+        "rules": [str(rule) for rule in RETENTION.rules],
+        "sweep_interval_seconds": RETENTION.interval,
+        "last_sweep": RETENTION.last_report
+    }
+
+@api_router.get("/rate-limits")
+async def get_rate_limits():
+    """Bucket sizes and the clients this worker has rejected most"""
+    return {
+        "backend": RATE_LIMIT_BACKEND,
+        "tokens_per_minute": RATE_LIMITER.limits if RATE_LIMIT_BACKEND != "off" else {},
+        "rejections": RATE_LIMITER.top_rejections()
+    }
+
+async def read_validated_upload(file: UploadFile, name: str) -> tuple[bytes, ImageHeader]:
+    """Validate an upload and its name, returning the raw bytes and the parsed header"""
+    # Validate file type
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
+    
+    allowed_types = ['image/jpeg', 'image/jpg', 'image/png']
+    if file.content_type not in allowed_types:
+        raise HTTPException(status_code=400, detail="Only JPG and PNG formats are supported.")
+    
+    # Validate name
+    invalid_name = name_error(name)
+    if invalid_name:
+        raise HTTPException(status_code=400, detail=invalid_name)
+    
+    # Read file
+    image_bytes = await file.read()
+    file_size = len(image_bytes)
+    
+    # Check file size (10MB limit)
+    if file_size > 10 * 1024 * 1024:
+        raise HTTPException(status_code=400, detail="File size exceeds 10MB limit.")
+    
+    logger.info(f"Processing image: {file.filename}, size: {file_size} bytes")
+    
+    # Check format and dimensions from the header before any pixels are decoded
+    header = inspect_image_header(image_bytes)
+    return image_bytes, header
+
+def photo_filename(sanitized_name: str, spec: str, timestamp: int) -> str:
+    """Output filename; the default spec keeps the original naming scheme"""
+    if spec == DEFAULT_PHOTO_SPEC:
+        return f"passport_photo_{sanitized_name}_{timestamp}.jpg"
+    return f"passport_photo_{sanitized_name}_{spec}_{timestamp}.jpg"
+
+# Smallest first: picked in this order when the client accepts several equally
+PREVIEW_PREFERENCE = ("avif", "webp")
+
+def preview_filename(filename: str, fmt: str) -> str:
+    """Name a preview is served under; earlier releases also stored previews under it next to the master"""
+    return f"{Path(filename).stem}.{fmt}"
+
+def format_sizes(rendition_bytes: bytes, previews: dict[str, bytes]) -> dict[str, int]:
+    return {"jpeg": len(rendition_bytes), **{fmt: len(data) for fmt, data in previews.items()}}
+
+async def cache_previews(photo: dict, previews: dict[str, bytes]) -> None:
+    """Keep previews rendered with a photo in the node's bounded cache, under the photo's stored version"""
+    for fmt, data in previews.items():
         try:
-            drive_file_id, drive_file_url = upload_to_google_drive(processed_bytes, filename)
+            await DRIVE_CACHE.store_derived(photo, f".{fmt}", data)
+        except OSError as e:
+            logger.error(f"Failed to cache the {fmt} preview of {photo['filename']}: {str(e)}")
+
+async def stored_preview_name(filename: str, fmt: str) -> str:
+    """
+    Preview to serve, relative to the uploads directory. Previews are cached by
+    stored version, so a rename on any node is never answered with the old
+    banner; a node that did not render the current version encodes it from the
+    JPEG master on first request.
+    """
+    photo = (await find_stored_photos([filename]))[0]
+    
+    async def encode() -> bytes:
+        master = await read_stored_photo(photo)
+        previews = await run_in_processing_executor(encode_jpeg_previews, master, (fmt,))
+        METRICS.inc("preview_renders_total", format=fmt)
+        return previews[fmt]
+    
+    return str((await DRIVE_CACHE.derived_path(photo, f".{fmt}", encode)).relative_to(UPLOADS_DIR))
+
+def negotiate_image_format(accept: Optional[str], available: list[str]) -> str:
+    """Best available preview format the client explicitly accepts, else the JPEG master"""
+    accepted = {}
+    for part in (accept or "").split(','):
+        media_type, *params = [item.strip() for item in part.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type.lower()] = quality
+    # Wildcards do not count: clients that only send */* get the JPEG they always got
+    candidates = [fmt for fmt in available if accepted.get(PREVIEW_MEDIA_TYPES[fmt], 0) > 0]
+    if not candidates:
+        return "jpeg"
+    return max(candidates, key=lambda fmt: (accepted[PREVIEW_MEDIA_TYPES[fmt]], -PREVIEW_PREFERENCE.index(fmt)))
+
+async def process_and_store_photo(
+    image_bytes: bytes,
+    name: str,
+    header: ImageHeader,
+    original_filename: str,
+    face_hint: Optional[tuple] = None,
+    progress: Callable[[str], None] = no_progress,
+    specs: tuple[str, ...] = (DEFAULT_PHOTO_SPEC,),
+    fingerprint: Optional[str] = None
+) -> ProcessResponse:
+    """Run the pipeline, upload each rendered spec to Google Drive and record its metadata"""
+    # Pipeline stages report from an executor thread; hop back onto the loop
+    loop = asyncio.get_running_loop()
+    def report_from_worker(stage: str) -> None:
+        loop.call_soon_threadsafe(progress, stage)
+    
+    async def render() -> PipelineResult:
+        # Reserve the estimated decode memory, then decode, detect and render off the event loop
+        progress("waiting_for_capacity")
+        async with ADMISSION.reserve(estimate_peak_memory(header, len(image_bytes), specs)):
+            return await run_pipeline(image_bytes, name, header, face_hint, report_from_worker, specs)
+    
+    # Identical concurrent submissions share one render; upload and metadata stay per caller
+    if fingerprint is None:
+        fingerprint = await asyncio.to_thread(request_fingerprint, image_bytes, name, specs)
+    flight_key = f"{fingerprint}:{face_hint}:{RENDER_ENGINE}"
+    rendered = await PIPELINE_FLIGHTS.do(flight_key, render, progress)
+    
+    # Generate filenames
+    sanitized_name = sanitize_filename(name)
+    timestamp = int(time.time())
+    
+    # Upload to Google Drive, one file per spec, unless a near-identical photo is already stored
+    progress("uploading")
+    outputs = []
+    for rendition in rendered.renditions():
+        existing = await find_reusable_photo(rendered.perceptual_hash, rendition.spec, name)
+        if existing:
+            logger.info(f"Reusing {existing['filename']} for a near-duplicate {rendition.spec} upload")
+            METRICS.inc("duplicate_reused_total")
+            outputs.append({
+                "rendition": rendition, "filename": existing["filename"], "drive_file_id": existing["drive_file_id"],
+                "drive_file_url": existing["drive_file_url"], "metadata_id": existing["metadata_id"], "reused": True
+            })
+            continue
+        filename = photo_filename(sanitized_name, rendition.spec, timestamp)
+        try:
+            drive_file_id, drive_file_url = await asyncio.to_thread(upload_to_google_drive, rendition.processed_bytes, filename)
             logger.info(f"File uploaded to Google Drive: {drive_file_id}")
         except Exception as e:
             logger.error(f"Google Drive upload failed: {str(e)}")
@@ -419,38 +2124,204 @@ async def process_passport(
                 status_code=500,
                 detail=f"Failed to upload to Google Drive: {str(e)}"
             )
-        
-        # Save metadata to MongoDB
+        outputs.append({
+            "rendition": rendition, "filename": filename, "drive_file_id": drive_file_id,
+            "drive_file_url": drive_file_url, "metadata_id": None, "reused": False
+        })
+    
+    new_outputs = [output for output in outputs if not output["reused"]]
+    
+    # Save metadata to MongoDB
+    documents = []
+    for output in new_outputs:
+        rendition = output["rendition"]
+        spec = PHOTO_SPECS[rendition.spec]
         metadata = PassportPhotoMetadata(
-            filename=filename,
+            filename=output["filename"],
             storage_mode="google_drive",
-            drive_file_id=drive_file_id,
-            drive_file_url=drive_file_url,
+            drive_file_id=output["drive_file_id"],
+            drive_file_url=output["drive_file_url"],
             local_file_path=None,
             user_email=None,
             name_on_photo=name,
-            original_filename=file.filename or "unknown",
-            file_size_bytes=processed_size
+            image_dimensions=f"{spec.width}x{spec.height}",
+            original_filename=original_filename,
+            file_size_bytes=rendition.file_size,
+            # Framing measurements describe the primary spec's crop
+            compliance=rendered.compliance if rendition.spec == rendered.spec else None,
+            spec=rendition.spec,
+            perceptual_hash=rendered.perceptual_hash,
+            format_sizes=format_sizes(rendition.processed_bytes, rendition.previews)
         )
-        
         metadata_dict = metadata.model_dump()
         metadata_dict['upload_timestamp'] = metadata_dict['upload_timestamp'].isoformat()
+        documents.append(metadata_dict)
+    
+    if documents:
+        progress("saving_metadata")
+        result = await db.passport_photos.insert_many(documents)
+        for output, document, inserted_id in zip(new_outputs, documents, result.inserted_ids):
+            output["metadata_id"] = str(inserted_id)
+            if document["perceptual_hash"]:
+                PHOTO_HASHES.add(photo_hash_entry(document, output["metadata_id"]))
+            # Drive keeps only the JPEG master; previews live in the bounded cache
+            await cache_previews({**document, "version": drive_version(document)}, output["rendition"].previews)
+        logger.info(f"Metadata saved with ID(s): {', '.join(output['metadata_id'] for output in new_outputs)}")
         
-        result = await db.passport_photos.insert_one(metadata_dict)
-        metadata_id = str(result.inserted_id)
+        # Un-annotated bases let a name be corrected later without touching the source again
+        bases = [
+            {
+                "_id": output["metadata_id"],
+                "spec": output["rendition"].spec,
+                "face_coords": list(rendered.face_coords),
+                "engine": RENDER_ENGINE,
+                "image": output["rendition"].base_image,
+                "created_at": datetime.now(timezone.utc)
+            }
+            for output in new_outputs if output["rendition"].base_image
+        ]
+        if bases:
+            try:
+                await db.photo_bases.insert_many(bases)
+            except Exception as e:
+                # The photo itself is saved; only later name corrections lose their shortcut
+                logger.error(f"Failed to store base images: {str(e)}")
+    
+    renditions = None
+    if len(outputs) > 1:
+        renditions = [
+            RenditionResponse(
+                spec=output["rendition"].spec,
+                filename=output["filename"],
+                drive_file_id=output["drive_file_id"],
+                drive_file_url=output["drive_file_url"],
+                metadata_id=output["metadata_id"],
+                image_dimensions=f"{PHOTO_SPECS[output['rendition'].spec].width}x{PHOTO_SPECS[output['rendition'].spec].height}",
+                dpi=PHOTO_SPECS[output["rendition"].spec].dpi,
+                file_size_bytes=output["rendition"].file_size,
+                reused=output["reused"]
+            )
+            for output in outputs
+        ]
+    
+    # Return success response
+    primary = outputs[0]
+    if primary["reused"]:
+        message = "✓ This photo was already saved; returning the existing copy."
+    elif renditions is not None:
+        message = f"✓ {len(renditions)} photos saved successfully!"
+    else:
+        message = "✓ Photo saved successfully!"
+    response = ProcessResponse(
+        success=True,
+        mode="google_drive",
+        drive_file_id=primary["drive_file_id"],
+        drive_file_url=primary["drive_file_url"],
+        filename=primary["filename"],
+        download_url=signed_download_url(primary["filename"]) if DOWNLOAD_SIGNING_KEY else None,
+        metadata_id=primary["metadata_id"],
+        message=message,
+        compliance=rendered.compliance,
+        renditions=renditions,
+        reused=primary["reused"]
+    )
+    # Reused outputs are left out, so inline bodies carry the stored photo their filename points at
+    response._images = {
+        output["filename"]: output["rendition"].processed_bytes for output in outputs if not output["reused"]
+    }
+    return response
+
+async def response_images(response: ProcessResponse) -> list[tuple[str, bytes]]:
+    """(filename, JPEG) for every rendition in the response, from memory when this process rendered them"""
+    filenames = [rendition.filename for rendition in response.renditions or []] or [response.filename]
+    missing = [filename for filename in filenames if filename not in response._images]
+    # Replays, queue-processed and reused photos were rendered elsewhere or earlier; read their stored copies
+    stored = {}
+    if missing:
+        for photo in await find_stored_photos(missing):
+            stored[photo["filename"]] = await read_stored_photo(photo)
+    return [(filename, response._images.get(filename) or stored[filename]) for filename in filenames]
+
+def inline_photo_response(response: ProcessResponse, images: list[tuple[str, bytes]], mode: str) -> Response:
+    """The processed photo as the response body, without a second request to fetch it"""
+    if mode == "image":
+        # Primary photo only, metadata in headers; multipart carries every spec and the full JSON
+        filename, data = images[0]
+        headers = {
+            "Content-Disposition": f'inline; filename="{filename}"',
+            "X-Metadata-Id": response.metadata_id,
+            "X-Photo-Filename": filename,
+            "X-Reused": str(response.reused).lower()
+        }
+        if response.drive_file_id:
+            headers["X-Drive-File-Id"] = response.drive_file_id
+            headers["X-Drive-File-Url"] = response.drive_file_url or ""
+        if response.compliance:
+            headers["X-Compliance-Issues"] = str(len(response.compliance.issues))
+        return Response(content=data, media_type="image/jpeg", headers=headers)
+    
+    boundary = uuid.uuid4().hex
+    async def parts():
+        yield f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode()
+        yield response.model_dump_json().encode()
+        for filename, data in images:
+            yield (
+                f"\r\n--{boundary}\r\nContent-Type: image/jpeg\r\n"
+                f"Content-Disposition: inline; filename=\"{filename}\"\r\n\r\n"
+            ).encode()
+            yield data
+        yield f"\r\n--{boundary}--\r\n".encode()
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}")
+
+def require_google_drive() -> None:
+    """Fail fast when Drive uploads are not possible"""
+    if not GOOGLE_DRIVE_SERVICE:
+        raise HTTPException(
+            status_code=500, 
+            detail="Google Drive service not configured. Please contact administrator."
+        )
+
+@api_router.post("/process-passport")
+async def process_passport(
+    file: UploadFile = File(...),
+    name: str = Form(...),
+    face_box: Optional[str] = Form(None),
+    specs: Optional[str] = Form(None),
+    response_mode: Literal["json", "image", "multipart"] = Form("json"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Process uploaded image and upload to Google Drive"""
+    try:
+        # Check if Google Drive is configured (queue workers hold their own credentials)
+        if PROCESSING_BACKEND != "queue":
+            require_google_drive()
         
-        logger.info(f"Metadata saved with ID: {metadata_id}")
+        spec_keys = parse_photo_specs(specs)
+        image_bytes, header = await read_validated_upload(file, name)
+        # Hashed once and off the event loop; keys both the idempotency record and the shared render
+        fingerprint = await asyncio.to_thread(request_fingerprint, image_bytes, name, spec_keys)
         
-        # Return success response
-        return ProcessResponse(
-            success=True,
-            mode="google_drive",
-            drive_file_id=drive_file_id,
-            drive_file_url=drive_file_url,
-            filename=filename,
-            metadata_id=metadata_id,
-            message="✓ Photo saved successfully!"
-        )
+        if PROCESSING_BACKEND == "queue":
+            execute = partial(
+                process_via_queue, image_bytes, name, header, file.filename or "unknown",
+                parse_face_hint(face_box), specs=spec_keys
+            )
+        else:
+            execute = partial(
+                process_and_store_photo, image_bytes, name, header, file.filename or "unknown",
+                parse_face_hint(face_box), specs=spec_keys, fingerprint=fingerprint
+            )
+        
+        # Retries carrying the same key replay the first result instead of reprocessing
+        if idempotency_key:
+            response = await run_idempotent(idempotency_key, fingerprint, execute)
+        else:
+            response = await execute()
+        
+        if response_mode == "json":
+            return response
+        # Inline modes save the client's follow-up download round trip
+        return inline_photo_response(response, await response_images(response), response_mode)
         
     except HTTPException:
         raise
@@ -458,6 +2329,197 @@ async def process_passport(
         logger.error(f"Unexpected error in process_passport: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
+@api_router.post("/jobs", status_code=202, response_model=JobStatusResponse)
+async def create_processing_job(
+    file: UploadFile = File(...),
+    name: str = Form(...),
+    face_box: Optional[str] = Form(None),
+    specs: Optional[str] = Form(None)
+):
+    """Accept a photo for background processing and return a job id immediately"""
+    spec_keys = parse_photo_specs(specs)
+    if PROCESSING_BACKEND == "queue":
+        image_bytes, header = await read_validated_upload(file, name)
+        doc = await enqueue_processing_job(
+            image_bytes, name, header, file.filename or "unknown", parse_face_hint(face_box), spec_keys
+        )
+        return queued_job_to_response(doc)
+    
+    require_google_drive()
+    image_bytes, header = await read_validated_upload(file, name)
+    
+    job = JOBS.add()
+    execute = partial(
+        process_and_store_photo, image_bytes, name, header,
+        file.filename or "unknown", parse_face_hint(face_box), specs=spec_keys
+    )
+    job.task = asyncio.create_task(run_processing_job(job, execute))
+    logger.info(f"Queued processing job {job.id}")
+    return job.to_response()
+
+@api_router.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_processing_job(job_id: str):
+    """Current status of a processing job"""
+    job = JOBS.get(job_id)
+    if job:
+        return job.to_response()
+    doc = await db.processing_queue.find_one({"_id": job_id}, QUEUE_JOB_PROJECTION)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return queued_job_to_response(doc)
+
+@api_router.get("/jobs/{job_id}/events")
+async def processing_job_events(job_id: str):
+    """Stream stage progress for a job as Server-Sent Events until its final result"""
+    job = JOBS.get(job_id)
+    if job:
+        events = stream_job_events(job)
+    elif await db.processing_queue.count_documents({"_id": job_id}, limit=1):
+        events = stream_queued_job_events(job_id)
+    else:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/photo-specs")
+async def list_photo_specs():
+    """Photo formats that can be requested through the specs form field"""
+    specs = [{**asdict(spec), "aspect_ratio": round(spec.aspect_ratio, 4)} for spec in PHOTO_SPECS.values()]
+    return {"default": DEFAULT_PHOTO_SPEC, "specs": specs}
+
+@api_router.post("/print-sheet")
+async def create_print_sheet(request: PrintSheetRequest):
+    """Tile existing processed photos onto a printable 4x6 in sheet at 300 DPI"""
+    layout = SheetLayout(
+        orientation=request.orientation,
+        margin=request.margin_px,
+        gutter=request.gutter_px,
+        cut_guides=request.cut_guides
+    )
+    photos = await find_stored_photos(request.filenames)
+    key = print_sheet_key(photos, layout, request.copies)
+    
+    cached = SHEETS.get(key)
+    METRICS.inc("print_sheet_cache_total", result="hit" if cached else "miss")
+    if cached is None:
+        async def build() -> tuple[bytes, int]:
+            # Stored outputs are read back as-is; the pipeline is never re-run
+            stored = await asyncio.gather(*(read_stored_photo(photo) for photo in photos))
+            sheet, copies = await run_in_processing_executor(compose_print_sheet, list(stored), layout, request.copies)
+            SHEETS.put(key, sheet, copies)
+            return sheet, copies
+        cached = await SHEET_FLIGHTS.do(key, build)
+    sheet, copies = cached
+    
+    return Response(
+        content=sheet,
+        media_type="image/jpeg",
+        headers={
+            "Content-Disposition": f'inline; filename="print_sheet_{key[:12]}.jpg"',
+            "ETag": f'"{key}"',
+            "X-Sheet-Copies": str(copies)
+        }
+    )
+
+@api_router.get("/duplicates")
+async def list_duplicates(max_distance: int = DUPLICATE_HASH_DISTANCE):
+    """Clusters of near-identical photos (same spec, perceptual hashes within max_distance bits)"""
+    if max_distance < 0 or max_distance > DUPLICATE_HASH_DISTANCE:
+        raise HTTPException(status_code=400, detail=f"max_distance must be between 0 and {DUPLICATE_HASH_DISTANCE}.")
+    await PHOTO_HASH_SYNC.refresh()
+    members = [member for cluster in PHOTO_HASHES.clusters(max_distance) for member in cluster]
+    if members:
+        await prune_photo_hashes(members)
+    clusters = [
+        {
+            "spec": members[0]["spec"],
+            "count": len(members),
+            "wasted_bytes": sum(member["file_size_bytes"] or 0 for member in members[1:]),
+            "photos": sorted(members, key=lambda member: str(member["upload_timestamp"]))
+        }
+        for members in PHOTO_HASHES.clusters(max_distance)
+    ]
+    clusters.sort(key=lambda cluster: cluster["count"], reverse=True)
+    return {"success": True, "clusters": clusters, "count": len(clusters)}
+
+@api_router.patch("/photos/{metadata_id}", response_model=ProcessResponse)
+async def update_photo_name(metadata_id: str, request: NameUpdateRequest):
+    """Change the name on a processed photo by redrawing only the banner on its stored base image"""
+    invalid_name = name_error(request.name)
+    if invalid_name:
+        raise HTTPException(status_code=400, detail=invalid_name)
+    try:
+        doc = await db.passport_photos.find_one({"_id": ObjectId(metadata_id)})
+    except InvalidId:
+        doc = None
+    if not doc:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    base = await db.photo_bases.find_one({"_id": metadata_id})
+    if not base:
+        raise HTTPException(
+            status_code=409,
+            detail="No base image was kept for this photo. Please upload the original again."
+        )
+    
+    start = time.perf_counter()
+    spec = PHOTO_SPECS.get(base["spec"], PHOTO_SPECS[DEFAULT_PHOTO_SPEC])
+    processed_bytes, previews = await run_in_processing_executor(
+        rerender_name, base["image"], request.name, spec.dpi, base["engine"]
+    )
+    METRICS.observe("rerender_seconds", time.perf_counter() - start)
+    
+    # Same filename and Drive file id, so existing links keep working
+    filename = doc["filename"]
+    if doc.get("drive_file_id"):
+        try:
+            await asyncio.to_thread(update_google_drive_file, doc["drive_file_id"], processed_bytes)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Google Drive update failed for {filename}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Failed to update Google Drive copy: {str(e)}")
+    local_path = UPLOADS_DIR / filename
+    if STORED_PHOTO_PATTERN.fullmatch(filename) and local_path.is_file():
+        partial_path = local_path.with_suffix('.jpg.part')
+        await asyncio.to_thread(partial_path.write_bytes, processed_bytes)
+        await asyncio.to_thread(partial_path.replace, local_path)
+    
+    updated_at = datetime.now(timezone.utc).isoformat()
+    await db.passport_photos.update_one(
+        {"_id": doc["_id"]},
+        {"$set": {
+            "name_on_photo": request.name,
+            "file_size_bytes": len(processed_bytes),
+            "format_sizes": format_sizes(processed_bytes, previews),
+            "updated_at": updated_at
+        }}
+    )
+    # Drop the old version's cached copies here, and previews earlier releases kept next to the master;
+    # other nodes never serve theirs, since the stored version changed
+    await asyncio.to_thread(DRIVE_CACHE.discard, {DriveFileCache.cache_key(doc)})
+    await asyncio.to_thread(unlink_files, [UPLOADS_DIR / preview_filename(filename, fmt) for fmt in PREVIEW_PREFERENCE])
+    await cache_previews((await find_stored_photos([filename]))[0], previews)
+    if doc.get("perceptual_hash"):
+        PHOTO_HASHES.add(photo_hash_entry(
+            {**doc, "name_on_photo": request.name, "file_size_bytes": len(processed_bytes)}, metadata_id
+        ))
+    logger.info(f"Renamed {filename} to '{request.name}' in {time.perf_counter() - start:.3f}s")
+    
+    return ProcessResponse(
+        success=True,
+        mode=doc.get("storage_mode", "google_drive"),
+        drive_file_id=doc.get("drive_file_id"),
+        drive_file_url=doc.get("drive_file_url"),
+        filename=filename,
+        download_url=signed_download_url(filename) if DOWNLOAD_SIGNING_KEY else None,
+        metadata_id=metadata_id,
+        message="✓ Name updated successfully!",
+        compliance=doc.get("compliance")
+    )
+
 @api_router.get("/photos")
 async def get_photos(email: Optional[str] = None):
     """Get list of processed photos"""
@@ -536,19 +2598,40 @@ async def oauth_callback(code: Optional[str] = None, error: Optional[str] = None
 
 # Custom endpoint to serve uploaded files with correct MIME type
 @api_router.get("/download/{filename}")
-async def download_file(filename: str):
-    """Serve uploaded passport photos"""
+async def download_file(
+    filename: str,
+    format: Optional[Literal["jpeg", "webp", "avif"]] = None,
+    expires: Optional[int] = None,
+    signature: Optional[str] = None,
+    accept: Optional[str] = Header(None)
+):
+    """Serve uploaded passport photos, as a lighter preview when the client accepts one"""
+    # Checked before touching the disk, so unsigned filename guessing learns nothing
+    verify_download_signature(filename, expires, signature)
     try:
-        file_path = UPLOADS_DIR / filename
-        if not file_path.exists():
+        check_stored_photo_name(filename)
+        # Previews are negotiated only for JPEG masters; ?format=jpeg always returns the master.
+        # Only enabled formats are offered; a missing preview is encoded on demand.
+        available = [fmt for fmt in PREVIEW_PREFERENCE if fmt in PREVIEW_FORMATS]
+        chosen = format or negotiate_image_format(accept, available)
+        if chosen != "jpeg" and chosen not in available:
             raise HTTPException(status_code=404, detail="File not found")
+        served_name = filename if chosen == "jpeg" else preview_filename(filename, chosen)
+        stored_name = served_name
+        if chosen == "jpeg" and not (UPLOADS_DIR / filename).is_file():
+            # Drive-stored master: fetched once into the local cache, then served from disk
+            photo = (await find_stored_photos([filename]))[0]
+            stored_name = str((await DRIVE_CACHE.path(photo)).relative_to(UPLOADS_DIR))
+        elif chosen != "jpeg":
+            stored_name = await stored_preview_name(filename, chosen)
         
-        # Return the file with correct content type
-        return FileResponse(
-            path=str(file_path),
-            media_type="image/jpeg",
-            filename=filename
+        # Return the file with correct content type; the proxy streams it in nginx/apache delivery mode
+        return deliver_file(
+            UPLOADS_DIR, stored_name, PREVIEW_MEDIA_TYPES.get(chosen, "image/jpeg"), {"Vary": "Accept"},
+            filename=served_name
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error serving file {filename}: {str(e)}")
         raise HTTPException(status_code=404, detail="File not found")
@@ -556,18 +2639,49 @@ async def download_file(filename: str):
 # Include the router in the main app
 app.include_router(api_router)
 
-# Mount uploads directory AFTER API routes to avoid conflicts
-app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
+# Mount uploads directory AFTER API routes to avoid conflicts; with signed downloads it would be an unsigned bypass
+if not DOWNLOAD_SIGNING_KEY:
+    app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
 
+# Inside CORS, so browsers can read the 429 and its Retry-After
+if RATE_LIMIT_BACKEND != "off":
+    app.add_middleware(RateLimitMiddleware, limiter=RATE_LIMITER, count=METRICS.inc)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Retry-After"],
 )
+if MEMORY_PROFILING != "off":
+    app.add_middleware(MemoryProfilingMiddleware, observe=observe_memory)
+# Outermost, so every log line of a request, CORS included, carries its id
+app.add_middleware(RequestContextMiddleware)
+
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        await ensure_idempotency_indexes()
+        await ensure_queue_indexes()
+        await ensure_retention_indexes()
+        if isinstance(RATE_LIMITER, MongoRateLimiter):
+            await RATE_LIMITER.ensure_indexes()
+    except Exception as e:
+        logger.error(f"Failed to create indexes: {str(e)}")
+    try:
+        await load_photo_hash_index()
+    except Exception as e:
+        logger.error(f"Failed to load the duplicate index: {str(e)}")
+    HEALTH.start()
+    RETENTION.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    HEALTH.stop()
+    RETENTION.stop()
     client.close()
     logger.info("MongoDB client closed")
+    PROCESSING_EXECUTOR.shutdown(wait=False)
+    SHARED_BUFFERS.close()
+    LOG_LISTENER.stop()
@@ -0,0 +1,210 @@
+"""
+Zero-copy handoff of image buffers to process-pool workers.
+
+The API process copies each upload into a pooled shared-memory segment and
+submits only (name, length) descriptors to the pool. Workers map the segment,
+wrap it as a numpy array without copying, and write the encoded outputs (every
+spec's JPEG, base image and previews) into a second pooled segment; only what
+does not fit travels back pickled.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from multiprocessing import shared_memory
+from typing import Callable, Optional
+
+import numpy as np
+from fastapi import HTTPException
+
+from imaging import ImageHeader, PipelineResult, run_passport_pipeline
+
+logger = logging.getLogger(__name__)
+
+MIN_SEGMENT_BYTES = 1 << 20  # 1 MiB
+
+
+@dataclass
+class SegmentStats:
+    created_total: int = 0
+    reused_total: int = 0
+    leaked_total: int = 0
+    in_use: int = 0
+    idle: int = 0
+    mapped_bytes: int = 0
+
+
+class SharedBufferPool:
+    """Reusable shared-memory segments bucketed by power-of-two size class"""
+
+    def __init__(self, max_idle_per_class: int = 8, leak_after_seconds: float = 300.0):
+        self.max_idle_per_class = max_idle_per_class
+        self.leak_after_seconds = leak_after_seconds
+        self._lock = threading.Lock()
+        self._idle: dict[int, list[shared_memory.SharedMemory]] = defaultdict(list)
+        self._in_use: dict[str, tuple[shared_memory.SharedMemory, float]] = {}
+        self._stats = SegmentStats()
+
+    @staticmethod
+    def size_class(nbytes: int) -> int:
+        return max(MIN_SEGMENT_BYTES, 1 << max(0, nbytes - 1).bit_length())
+
+    def acquire(self, nbytes: int) -> shared_memory.SharedMemory:
+        self.reap_leaks()
+        size = self.size_class(nbytes)
+        with self._lock:
+            if self._idle[size]:
+                segment = self._idle[size].pop()
+                self._stats.reused_total += 1
+            else:
+                segment = shared_memory.SharedMemory(create=True, size=size)
+                self._stats.created_total += 1
+                self._stats.mapped_bytes += segment.size
+            self._in_use[segment.name] = (segment, time.monotonic())
+        return segment
+
+    def release(self, segment: shared_memory.SharedMemory) -> None:
+        with self._lock:
+            if self._in_use.pop(segment.name, None) is None:
+                # Already reaped as a leak and unlinked
+                return
+            size = self.size_class(segment.size)
+            if len(self._idle[size]) < self.max_idle_per_class:
+                self._idle[size].append(segment)
+                return
+            self._stats.mapped_bytes -= segment.size
+        self._destroy(segment)
+
+    def reap_leaks(self) -> int:
+        """Unlink segments held far longer than any request should take"""
+        cutoff = time.monotonic() - self.leak_after_seconds
+        with self._lock:
+            leaked = [seg for seg, acquired in self._in_use.values() if acquired < cutoff]
+            for segment in leaked:
+                del self._in_use[segment.name]
+                self._stats.leaked_total += 1
+                self._stats.mapped_bytes -= segment.size
+        for segment in leaked:
+            logger.warning(f"Reclaiming leaked shared memory segment {segment.name} ({segment.size} bytes)")
+            self._destroy(segment)
+        return len(leaked)
+
+    def stats(self) -> SegmentStats:
+        with self._lock:
+            return SegmentStats(
+                created_total=self._stats.created_total,
+                reused_total=self._stats.reused_total,
+                leaked_total=self._stats.leaked_total,
+                in_use=len(self._in_use),
+                idle=sum(len(segments) for segments in self._idle.values()),
+                mapped_bytes=self._stats.mapped_bytes
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            segments = [seg for seg, _ in self._in_use.values()]
+            segments += [seg for idle in self._idle.values() for seg in idle]
+            self._in_use.clear()
+            self._idle.clear()
+            self._stats.mapped_bytes = 0
+        for segment in segments:
+            self._destroy(segment)
+
+    @staticmethod
+    def _destroy(segment: shared_memory.SharedMemory) -> None:
+        try:
+            segment.close()
+            segment.unlink()
+        except (BufferError, FileNotFoundError) as e:
+            logger.error(f"Failed to destroy shared memory segment {segment.name}: {str(e)}")
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # The parent owns segment lifetimes; keep the worker's resource tracker out of it (Python 3.13+)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def map_result_buffers(result: PipelineResult, move: Callable[[bytes], bytes]) -> PipelineResult:
+    """The result with each encoded image of every spec replaced by move(image), visited in a fixed order"""
+    def moved(rendition) -> dict:
+        return {
+            "processed_bytes": move(rendition.processed_bytes),
+            "base_image": None if rendition.base_image is None else move(rendition.base_image),
+            "previews": {fmt: move(data) for fmt, data in rendition.previews.items()}
+        }
+    primary = moved(result)
+    extras = [replace(rendition, **moved(rendition)) for rendition in result.extra_renditions]
+    return replace(result, **primary, extra_renditions=extras)
+
+
+def write_result_buffers(result: PipelineResult, buf: memoryview) -> tuple[PipelineResult, list]:
+    """Pack the result's images into buf while they fit; returns the emptied result and each image's (offset, length), or None where it stayed in the result"""
+    layout = []
+    offset = 0
+
+    def move(data: bytes) -> bytes:
+        nonlocal offset
+        if offset + len(data) > len(buf):
+            layout.append(None)
+            return data
+        buf[offset:offset + len(data)] = data
+        layout.append((offset, len(data)))
+        offset += len(data)
+        return b""
+
+    return map_result_buffers(result, move), layout
+
+
+def read_result_buffers(result: PipelineResult, layout: list, buf: memoryview) -> PipelineResult:
+    """Copy the images write_result_buffers packed into buf back into the result"""
+    slots = iter(layout)
+
+    def move(data: bytes) -> bytes:
+        slot = next(slots)
+        return data if slot is None else bytes(buf[slot[0]:slot[0] + slot[1]])
+
+    return map_result_buffers(result, move)
+
+
+def render_from_shared_memory(
+    input_desc: tuple[str, int],
+    output_desc: tuple[str, int],
+    name: str,
+    header_fields: dict,
+    face_hint: Optional[tuple],
+    specs: tuple[str, ...]
+) -> tuple[list, Optional[PipelineResult], Optional[tuple[int, str]]]:
+    """
+    Pool-worker entry point: renders the upload in the input segment and packs
+    the encoded images into the output segment. Returns (layout, result, error)
+    for read_result_buffers; error is (status_code, detail) so no traceback
+    keeps the buffers mapped.
+    """
+    input_name, input_length = input_desc
+    output_name, output_capacity = output_desc
+    input_shm = _attach(input_name)
+    output_shm = _attach(output_name)
+    outcome = ([], None, None)
+    try:
+        image = np.ndarray((input_length,), dtype=np.uint8, buffer=input_shm.buf)
+        try:
+            result = run_passport_pipeline(image, name, ImageHeader(**header_fields), face_hint, specs=specs)
+        except HTTPException as e:
+            outcome = ([], None, (e.status_code, str(e.detail)))
+        except Exception as e:
+            outcome = ([], None, (500, f"Image processing failed: {str(e)}"))
+        else:
+            output = output_shm.buf[:output_capacity]
+            result, layout = write_result_buffers(result, output)
+            output.release()
+            outcome = (layout, result, None)
+        del image
+    finally:
+        input_shm.close()
+        output_shm.close()
+    return outcome
@@ -0,0 +1,169 @@
+"""
+Logging for the API: records are handed to a background thread through a queue
+and written there as one JSON object per line, tagged with the request id.
+
+Formatting is deferred to that thread, so a log call on the event loop only
+builds the record. Per-stage detail (DEBUG records from the imaging code) is
+kept for a sampled fraction of requests; INFO and above, and every error, are
+always written. Process-pool children configure the same pipeline in their
+initializer and run each task under the submitting request's id.
+"""
+
+import json
+import logging
+import multiprocessing.util
+import os
+import queue
+import random
+import re
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()  # "json" or "text"
+# Fraction of requests whose per-stage DEBUG detail is written (0 disables, 1 keeps all)
+LOG_DETAIL_SAMPLE_RATE = float(os.environ.get('LOG_DETAIL_SAMPLE_RATE', '0.05'))
+# Loggers whose DEBUG records are per-stage detail, subject to sampling
+DETAIL_LOGGERS = ("imaging", "shared_buffers")
+
+REQUEST_ID: ContextVar[str] = ContextVar("request_id", default="-")
+DETAIL_SAMPLED: ContextVar[bool] = ContextVar("detail_sampled", default=False)
+
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+# Attributes every LogRecord has; anything else came from `extra=` and is emitted as a field
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamp the request id; runs on the thread that logs, not the writer"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = REQUEST_ID.get()
+        return True
+
+
+class SampledDetailFilter(logging.Filter):
+    """Drop a detail logger's DEBUG records outside sampled requests"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or DETAIL_SAMPLED.get()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The base class formats here, on the caller's thread; records are only read by the listener
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging() -> QueueListener:
+    """Route all logging through one queue to a background writer; returns the started listener"""
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == "text":
+        stream.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+        ))
+    else:
+        stream.setFormatter(JsonFormatter())
+
+    handler = DeferredQueueHandler(queue.SimpleQueue())
+    handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    if LOG_DETAIL_SAMPLE_RATE > 0 and LOG_LEVEL != "DEBUG":
+        for name in DETAIL_LOGGERS:
+            detail_logger = logging.getLogger(name)
+            if not any(isinstance(f, SampledDetailFilter) for f in detail_logger.filters):
+                detail_logger.addFilter(SampledDetailFilter())
+            detail_logger.setLevel(logging.DEBUG)
+
+    listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def init_pool_worker() -> None:
+    """Process-pool initializer: spawned children log through their own queue and writer, in the same format"""
+    listener = configure_logging()
+    # Pool children leave through multiprocessing's exit hooks, not atexit; flush what is queued
+    multiprocessing.util.Finalize(None, listener.stop, exitpriority=10)
+
+
+def request_context() -> tuple[str, bool]:
+    """The current request id and sampling decision, to hand to a pool process"""
+    return REQUEST_ID.get(), DETAIL_SAMPLED.get()
+
+
+def run_in_request_context(context: tuple[str, bool], fn, *args, **kwargs):
+    """Pool-side wrapper: run fn under the logging context of the request that submitted it"""
+    request_id, sampled = context
+    tokens = REQUEST_ID.set(request_id), DETAIL_SAMPLED.set(sampled)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        reset_request(tokens)
+
+
+def bind_request(request_id: Optional[str] = None) -> tuple:
+    """Start a request's logging context; returns tokens for reset_request"""
+    if not request_id or not _REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+    sampled = LOG_DETAIL_SAMPLE_RATE > 0 and random.random() < LOG_DETAIL_SAMPLE_RATE
+    return REQUEST_ID.set(request_id), DETAIL_SAMPLED.set(sampled)
+
+
+def reset_request(tokens: tuple) -> None:
+    request_token, sampled_token = tokens
+    REQUEST_ID.reset(request_token)
+    DETAIL_SAMPLED.reset(sampled_token)
+
+
+class RequestContextMiddleware:
+    """ASGI middleware: one request id per HTTP request, taken from X-Request-ID or generated, echoed back"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = next((value.decode('latin-1') for key, value in scope["headers"] if key == b"x-request-id"), None)
+        tokens = bind_request(incoming)
+        request_id = REQUEST_ID.get().encode('latin-1')
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id)]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            reset_request(tokens)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Standalone processing worker for the Passport Photo Generator.
+
+Claims jobs from the MongoDB `processing_queue` collection, runs the same
+passport pipeline as the API, uploads the result and records it back on the
+job. Run API nodes with PROCESSING_BACKEND=queue so they only enqueue work,
+then start as many workers as you need on any machine:
+
+    cd backend
+    python worker.py --concurrency 4
+
+The job loop lives in queue_worker.py. With PROCESSING_EXECUTOR=process,
+spawned pool children re-run this script as __mp_main__, so it imports
+nothing at module level beyond the standard library; the children only need
+the pool entry points in shared_buffers and structured_logging.
+"""
+
+import argparse
+import asyncio
+
+
+def main() -> None:
+    from queue_worker import run_worker
+    from server import PROCESSING_WORKERS
+
+    parser = argparse.ArgumentParser(description="Run passport photo jobs from the MongoDB queue")
+    parser.add_argument('--concurrency', type=int, default=PROCESSING_WORKERS,
+                        help="Jobs processed at once (default: PROCESSING_WORKERS)")
+    args = parser.parse_args()
+    asyncio.run(run_worker(args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ function App() {
   const [imageFile, setImageFile] = useState(null);
   const [faceDetected, setFaceDetected] = useState(null);
   const [faceConfidence, setFaceConfidence] = useState(0);
+  const [faceBox, setFaceBox] = useState(null);
   const [detecting, setDetecting] = useState(false);
   const [name, setName] = useState('');
   const [processing, setProcessing] = useState(false);
@@ -110,6 +111,7 @@ function App() {
 
       if (detections.length === 0) {
         setFaceDetected(false);
+        setFaceBox(null);
         toast.error('No face detected. Please upload a clear, frontal face photo.');
       } else {
         const largestFace = detections.reduce((prev, current) => 
@@ -118,6 +120,17 @@ function App() {
         
         setFaceDetected(true);
         setFaceConfidence(Math.round(largestFace.detection.score * 100));
+
+        // Sent to the backend as a hint so it can skip full-frame detection
+        const { box, imageWidth, imageHeight } = largestFace.detection;
+        setFaceBox({
+          x: Math.round(box.x),
+          y: Math.round(box.y),
+          width: Math.round(box.width),
+          height: Math.round(box.height),
+          image_width: imageWidth,
+          image_height: imageHeight
+        });
         
         if (detections.length > 1) {
           toast.warning('Multiple faces detected. Using the most prominent one.');
@@ -130,6 +143,7 @@ function App() {
     } catch (err) {
       console.error('Face detection error:', err);
       setFaceDetected(false);
+      setFaceBox(null);
       toast.error('Face detection failed');
     } finally {
       setDetecting(false);
@@ -154,6 +168,9 @@ function App() {
       const formData = new FormData();
       formData.append('file', imageFile);
       formData.append('name', name);
+      if (faceBox) {
+        formData.append('face_box', JSON.stringify(faceBox));
+      }
 
       const response = await axios.post(`${API}/process-passport`, formData, {
         responseType: 'json'
@@ -178,6 +195,7 @@ function App() {
     setImageFile(null);
     setFaceDetected(null);
     setFaceConfidence(0);
+    setFaceBox(null);
     setName('');
     setSuccess(false);
     setError('');
@@ -0,0 +1,12 @@
+import os
+import sys
+from pathlib import Path
+
+# The backend is a flat set of modules run from backend/, not an installed package
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# server.py reads these at import time; the units under test never connect
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+os.environ.setdefault("LOG_FORMAT", "text")
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from server import AdmissionTimeout, MemoryAdmissionController
+
+
+def test_waiters_are_granted_in_arrival_order():
+    async def scenario():
+        admission = MemoryAdmissionController(100, timeout=5)
+        granted = []
+
+        async def request(name, need):
+            reserved = await admission.acquire(need)
+            granted.append(name)
+            return reserved
+
+        first = await admission.acquire(80)
+        # "large" arrives first and does not fit; "small" would fit but must not overtake it
+        large = asyncio.create_task(request("large", 60))
+        await asyncio.sleep(0)
+        small = asyncio.create_task(request("small", 10))
+        await asyncio.sleep(0)
+        assert granted == [] and admission.queue_depth == 2
+
+        admission.release(first)
+        await asyncio.gather(large, small)
+        assert granted == ["large", "small"]
+        assert admission.used_bytes == 70
+
+    asyncio.run(scenario())
+
+
+def test_oversized_request_runs_alone():
+    async def scenario():
+        admission = MemoryAdmissionController(100, timeout=5)
+        reserved = await admission.acquire(500)
+        assert reserved == 100
+        waiter = asyncio.create_task(admission.acquire(1))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        admission.release(reserved)
+        assert await waiter == 1
+
+    asyncio.run(scenario())
+
+
+def test_timeout_leaves_queue_and_unblocks_followers():
+    async def scenario():
+        admission = MemoryAdmissionController(100, timeout=0.05)
+        held = await admission.acquire(90)
+        with pytest.raises(AdmissionTimeout):
+            await admission.acquire(50)
+        assert admission.queue_depth == 0
+        assert admission.used_bytes == 90
+        admission.release(held)
+        assert await admission.acquire(100) == 100
+
+    asyncio.run(scenario())
+
+
+def test_reserve_answers_503_with_retry_after_and_releases():
+    async def scenario():
+        admission = MemoryAdmissionController(100, timeout=0.05)
+        async with admission.reserve(100):
+            with pytest.raises(HTTPException) as excinfo:
+                async with admission.reserve(1):
+                    pass
+        assert excinfo.value.status_code == 503
+        assert excinfo.value.headers["Retry-After"] == "1"
+        assert admission.used_bytes == 0
+
+    asyncio.run(scenario())
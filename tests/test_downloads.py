@@ -0,0 +1,56 @@
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from fastapi import HTTPException
+
+import downloads
+from downloads import signed_download_url, verify_download_signature
+
+
+@pytest.fixture
+def signing_key(monkeypatch):
+    monkeypatch.setattr(downloads, "DOWNLOAD_SIGNING_KEY", b"test-secret")
+
+
+def url_params(url: str) -> tuple[str, int, str]:
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    return parts.path, int(query["expires"][0]), query["signature"][0]
+
+
+def rejection(filename, expires, signature) -> str:
+    with pytest.raises(HTTPException) as excinfo:
+        verify_download_signature(filename, expires, signature)
+    assert excinfo.value.status_code == 403
+    return excinfo.value.detail
+
+
+def test_unsigned_when_no_key_is_configured(monkeypatch):
+    monkeypatch.setattr(downloads, "DOWNLOAD_SIGNING_KEY", b"")
+    assert signed_download_url("photo one.jpg") == "/api/download/photo%20one.jpg"
+    verify_download_signature("photo one.jpg", None, None)
+
+
+def test_signed_url_verifies(signing_key):
+    path, expires, signature = url_params(signed_download_url("photo.jpg", ttl_seconds=60))
+    assert path == "/api/download/photo.jpg"
+    assert 0 < expires - time.time() <= 60
+    verify_download_signature("photo.jpg", expires, signature)
+
+
+def test_forged_signatures_are_rejected(signing_key, monkeypatch):
+    _, expires, signature = url_params(signed_download_url("photo.jpg"))
+    assert rejection("other.jpg", expires, signature) == "Download link is invalid."
+    assert rejection("photo.jpg", expires + 3600, signature) == "Download link is invalid."
+    assert rejection("photo.jpg", expires, signature[:-1] + ("A" if signature[-1] != "A" else "B")) == "Download link is invalid."
+    assert rejection("photo.jpg", None, signature) == "Download link is missing its signature."
+    assert rejection("photo.jpg", expires, "") == "Download link is missing its signature."
+    monkeypatch.setattr(downloads, "DOWNLOAD_SIGNING_KEY", b"another-secret")
+    assert rejection("photo.jpg", expires, signature) == "Download link is invalid."
+
+
+def test_expired_signatures_are_rejected(signing_key):
+    expires = int(time.time()) - 1
+    signature = downloads.download_signature("photo.jpg", expires)
+    assert rejection("photo.jpg", expires, signature) == "Download link has expired."
@@ -0,0 +1,84 @@
+import random
+
+from server import PhotoHashIndex
+
+
+def photo(photo_id: str, value: int, spec: str = "standard") -> dict:
+    return {"metadata_id": photo_id, "perceptual_hash": f"{value:016x}", "spec": spec}
+
+
+def flip_bits(value: int, count: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def build_index(max_distance: int, seed: int = 7):
+    rng = random.Random(seed)
+    index = PhotoHashIndex(max_distance)
+    entries = {}
+    centers = [rng.getrandbits(64) for _ in range(40)]
+    for center in centers:
+        # Neighbours on both sides of the threshold, so misses and false hits both show up
+        for distance in range(max_distance + 3):
+            value = flip_bits(center, distance, rng)
+            photo_id = f"p{len(entries)}"
+            entries[photo_id] = value
+            index.add(photo(photo_id, value))
+    return index, entries, centers
+
+
+def brute_force(entries: dict, value: int, max_distance: int) -> dict:
+    return {
+        photo_id: (value ^ other).bit_count()
+        for photo_id, other in entries.items()
+        if (value ^ other).bit_count() <= max_distance
+    }
+
+
+def test_query_matches_brute_force_at_max_distance():
+    index, entries, centers = build_index(6)
+    for center in centers:
+        found = {entry["metadata_id"]: distance for distance, entry in index.query(f"{center:016x}")}
+        assert found == brute_force(entries, center, 6)
+
+
+def test_query_sorts_closest_first_and_caps_the_distance():
+    index, entries, centers = build_index(6)
+    matches = index.query(f"{centers[0]:016x}", max_distance=2)
+    distances = [distance for distance, _ in matches]
+    assert distances == sorted(distances)
+    assert {entry["metadata_id"] for _, entry in matches} == set(brute_force(entries, centers[0], 2))
+    # A wider radius than the index was built for is clamped, never silently incomplete
+    assert len(index.query(f"{centers[0]:016x}", max_distance=20)) == len(index.query(f"{centers[0]:016x}"))
+
+
+def test_query_filters_by_spec():
+    index = PhotoHashIndex(6)
+    index.add(photo("a", 0x0123456789ABCDEF, "standard"))
+    index.add(photo("b", 0x0123456789ABCDEE, "us_2x2"))
+    assert [entry["metadata_id"] for _, entry in index.query("0123456789abcdef", "us_2x2")] == ["b"]
+
+
+def test_remove_and_readd_keep_tables_consistent():
+    index = PhotoHashIndex(6)
+    index.add(photo("a", 0x0123456789ABCDEF))
+    index.add(photo("a", 0xFEDCBA9876543210))
+    assert len(index) == 1
+    assert index.query("0123456789abcdef") == []
+    index.remove("a")
+    assert len(index) == 0
+    assert index.query("fedcba9876543210") == []
+    assert all(not table for table in index._tables)
+
+
+def test_clusters_group_transitive_links_per_spec():
+    index = PhotoHashIndex(6)
+    base = 0x0123456789ABCDEF
+    index.add(photo("a", base))
+    index.add(photo("b", base ^ 0b111))  # 3 bits from a
+    index.add(photo("c", base ^ 0b111111000))  # 6 bits from b, 9 from a
+    index.add(photo("d", base, "us_2x2"))
+    index.add(photo("far", ~base & (2**64 - 1)))
+    clusters = [sorted(entry["metadata_id"] for entry in members) for members in index.clusters()]
+    assert clusters == [["a", "b", "c"]]
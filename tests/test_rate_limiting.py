@@ -0,0 +1,109 @@
+import asyncio
+import ipaddress
+
+import pytest
+
+import rate_limiting
+from rate_limiting import MemoryRateLimiter, RateLimitMiddleware, client_ip, request_cost
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiting.time, "monotonic", clock)
+    return clock
+
+
+def acquire(limiter, cost=1, client="ip:1.2.3.4", bucket="processing") -> float:
+    return asyncio.run(limiter.acquire(bucket, client, cost))
+
+
+def test_bucket_allows_burst_then_reports_wait(clock):
+    limiter = MemoryRateLimiter({"processing": 60})
+    assert [acquire(limiter) for _ in range(60)] == [0.0] * 60
+    assert acquire(limiter) == pytest.approx(1.0)
+    # A rejected request takes nothing, so the wait does not grow while the client retries
+    assert acquire(limiter, cost=5) == pytest.approx(5.0)
+
+
+def test_bucket_refills_at_its_rate_up_to_capacity(clock):
+    limiter = MemoryRateLimiter({"processing": 60})
+    acquire(limiter, cost=60)
+    clock.now += 10
+    assert acquire(limiter, cost=10) == 0.0
+    assert acquire(limiter) == pytest.approx(1.0)
+    clock.now += 3600
+    assert acquire(limiter, cost=60) == 0.0
+    assert acquire(limiter) > 0
+
+
+def test_buckets_are_per_client_and_cost_is_capped(clock):
+    limiter = MemoryRateLimiter({"processing": 10})
+    assert acquire(limiter, cost=50, client="ip:a") == 0.0
+    assert acquire(limiter, client="ip:a") > 0
+    assert acquire(limiter, client="ip:b") == 0.0
+
+
+def test_request_cost_counts_started_megabytes():
+    assert request_cost("GET", None) == 1
+    assert request_cost("POST", b"0") == 1
+    assert request_cost("POST", b"1") == 2
+    assert request_cost("POST", str(3 * 1024 * 1024 + 1).encode()) == 5
+    assert request_cost("POST", None) == 11
+
+
+@pytest.fixture
+def trusted(monkeypatch):
+    networks = (ipaddress.ip_network("10.0.0.0/8"), ipaddress.ip_network("192.0.2.7/32"))
+    monkeypatch.setattr(rate_limiting, "RATE_LIMIT_TRUSTED_PROXIES", networks)
+
+
+def test_forwarded_for_ignored_from_untrusted_peer(trusted):
+    assert client_ip({"client": ("203.0.113.5", 1234)}, b"198.51.100.1") == "203.0.113.5"
+
+
+def test_forwarded_for_resolves_nearest_untrusted_hop(trusted):
+    scope = {"client": ("10.1.1.1", 1234)}
+    # The leftmost entry is whatever the client sent; only hops appended by trusted proxies count
+    assert client_ip(scope, b"6.6.6.6, 198.51.100.1, 192.0.2.7, 10.2.2.2") == "198.51.100.1"
+    assert client_ip(scope, b"not-an-ip") == "not-an-ip"
+    assert client_ip(scope, None) == "10.1.1.1"
+
+
+def test_middleware_answers_429_with_retry_after(clock):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    counted = []
+    middleware = RateLimitMiddleware(app, MemoryRateLimiter({"listing": 120}), lambda *a, **kw: counted.append(a[0]))
+    scope = {"type": "http", "method": "GET", "path": "/api/photos", "headers": [], "client": ("203.0.113.5", 1)}
+
+    def call():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(middleware(scope, receive, send))
+        return sent[0]
+
+    assert all(call()["status"] == 200 for _ in range(120))
+    clock.now += 0.1
+    rejected = call()
+    assert rejected["status"] == 429
+    # 0.4s away is still advertised as a whole second, never 0
+    assert dict(rejected["headers"])[b"retry-after"] == b"1"
+    assert counted == ["rate_limit_rejections_total"]
+    assert middleware.limiter.top_rejections() == [{"client": "ip:203.0.113.5", "bucket": "listing", "rejections": 1}]
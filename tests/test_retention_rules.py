@@ -0,0 +1,43 @@
+from datetime import timedelta
+
+from server import RetentionRule, parse_retention_rules, retention_queries
+
+
+def test_parses_modes_statuses_and_units():
+    rules = parse_retention_rules(" local=30d, drive:failed=12h ,*=90, *:completed=1.5m")
+    assert rules == [
+        RetentionRule("local", "*", timedelta(days=30)),
+        RetentionRule("drive", "failed", timedelta(hours=12)),
+        RetentionRule("*", "*", timedelta(days=90)),
+        RetentionRule("*", "completed", timedelta(seconds=90)),
+    ]
+
+
+def test_malformed_rules_are_skipped_not_fatal():
+    rules = parse_retention_rules("local=30d,local=-1d,drive=soon,=5d,drive:=1d,,drive=7w,drive=2h")
+    assert rules == [
+        RetentionRule("local", "*", timedelta(days=30)),
+        RetentionRule("drive", "*", timedelta(hours=2)),
+    ]
+    assert parse_retention_rules("") == []
+
+
+def test_earlier_rules_take_precedence():
+    rules = parse_retention_rules("local:failed=1d,local=30d,*=90d")
+    queries = retention_queries(rules)
+    assert [rule for rule, _ in queries] == rules
+    assert queries[0][1] == {"storage_mode": "local", "processing_status": "failed"}
+    assert queries[1][1] == {
+        "storage_mode": "local",
+        "$nor": [{"storage_mode": "local", "processing_status": "failed"}],
+    }
+    assert queries[2][1] == {
+        "$nor": [{"storage_mode": "local", "processing_status": "failed"}, {"storage_mode": "local"}],
+    }
+
+
+def test_catch_all_shadows_later_rules():
+    rules = parse_retention_rules("drive=7d,*=30d,local=1d")
+    queries = retention_queries(rules)
+    assert [str(rule) for rule, _ in queries] == ["drive:*=7d", "*:*=30d"]
+    assert queries[1][1] == {"$nor": [{"storage_mode": "drive"}]}